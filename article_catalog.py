@@ -0,0 +1,157 @@
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+from article_store import ARTICLE_STORE_PATH, ArticleStore
+
+RSS_DATE_FORMAT = "%a, %d %b %Y %H:%M:%S %z"
+DISPLAY_DATE_FORMAT = "%b %d, %Y"
+
+
+def prepare_article(record):
+    """Returns a copy of an article record with its parsed timestamp, display date and prompt line"""
+    published = datetime.strptime(record["publish_date"], RSS_DATE_FORMAT)
+    article = dict(record)
+    article["timestamp"] = published.timestamp()
+    article["display_date"] = published.strftime(DISPLAY_DATE_FORMAT)
+    article["prompt_line"] = f"{record['title']} ({article['display_date']})"
+    return article
+
+
+class _Snapshot:
+    """Immutable view of the catalog at one version of the article store"""
+
+    def __init__(self, version, articles):
+        self.version = version
+        self.articles = articles
+        self.titles = [article["title"] for article in articles]
+        self.by_title = {article["title"]: article for article in articles}
+        self.by_url = {article["public_url"]: article for article in articles}
+        self.articles_format = [
+            f"{i + 1}. {article['prompt_line']}" for i, article in enumerate(articles)
+        ]
+
+
+class ArticleCatalog:
+    """In-memory index of the articles in the article store, loaded on first use and reloaded when
+    articles are added"""
+
+    def __init__(self, store=ARTICLE_STORE_PATH, check_interval=1.0):
+        self.store = ArticleStore(store) if isinstance(store, str) else store
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._last_check = 0.0
+        self._snapshot = _Snapshot(None, [])
+
+    def reload_if_changed(self, force=False):
+        """Reloads the catalog if the article store changed, checking at most once per check_interval"""
+        now = time.monotonic()
+        loaded = self._snapshot.version is not None
+        if not force and loaded and now - self._last_check < self.check_interval:
+            return False
+        with self._lock:
+            self._last_check = now
+            if self.store.version == self._snapshot.version:
+                return False
+
+            # Usually only the records appended since the last load are read and parsed
+            records, version = self.store.appended_since(self._snapshot.version)
+            if records is None:
+                articles = self._load_all()
+            else:
+                added = {record["title"]: prepare_article(record) for record in records}
+                articles = [
+                    article for article in self._snapshot.articles if article["title"] not in added
+                ]
+                articles.extend(added.values())
+            # Nearly sorted already, so this is close to linear
+            articles.sort(key=lambda article: article["timestamp"], reverse=True)
+
+            self._snapshot = _Snapshot(version, articles)
+            return True
+
+    def _load_all(self):
+        """Reads every record, after the log was compacted. Unchanged ones keep their prepared entry."""
+        previous = self._snapshot.by_title
+        articles = []
+        for record in self.store:
+            article = previous.get(record["title"])
+            if article is None or any(
+                article.get(key) != value for key, value in record.items()
+            ):
+                article = prepare_article(record)
+            articles.append(article)
+        return articles
+
+    @property
+    def snapshot(self):
+        self.reload_if_changed()
+        return self._snapshot
+
+    @property
+    def version(self):
+        return self.snapshot.version
+
+    @property
+    def articles(self):
+        """Articles from most recent to oldest"""
+        return self.snapshot.articles
+
+    @property
+    def titles(self):
+        return self.snapshot.titles
+
+    @property
+    def articles_format(self):
+        """Numbered "title (date)" lines for every article, most recent first"""
+        return self.snapshot.articles_format
+
+    def get(self, title):
+        """Returns the article with the given title, or None"""
+        return self.snapshot.by_title.get(title)
+
+    def get_by_url(self, url):
+        """Returns the article with the given public url, or None"""
+        return self.snapshot.by_url.get(url)
+
+    def __len__(self):
+        return len(self.snapshot.articles)
+
+
+class CatalogEmbeddings:
+    """Normalized embeddings of one text per catalog article, embedding only texts not seen before"""
+
+    def __init__(self, catalog, embed, text_for_article):
+        self.catalog = catalog
+        self.embed = embed
+        self.text_for_article = text_for_article
+        self._embeddings = {}
+        self._matrix = (None, [], None)
+        self._lock = threading.Lock()
+
+    def matrix(self):
+        """Returns the catalog titles and a matrix of their normalized embeddings, in catalog order"""
+        with self._lock:
+            snapshot = self.catalog.snapshot
+            if self._matrix[0] != snapshot.version:
+                texts = [
+                    self.text_for_article(article) for article in snapshot.articles
+                ]
+                missing = list({text for text in texts if text not in self._embeddings})
+                if missing:
+                    self._embeddings.update(zip(missing, self.embed(missing)))
+                matrix = np.array(
+                    [self._embeddings[text] for text in texts], dtype=np.float32
+                )
+                matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+                self._matrix = (snapshot.version, snapshot.titles, matrix)
+            return self._matrix[1], self._matrix[2]
+
+    def rank(self, query_embedding):
+        """Returns (title, cosine similarity) pairs for every article, most similar first"""
+        titles, matrix = self.matrix()
+        query = np.asarray(query_embedding, dtype=np.float32)
+        scores = matrix @ (query / np.linalg.norm(query))
+        return [(titles[i], float(scores[i])) for i in np.argsort(-scores)]
@@ -0,0 +1,267 @@
+import bisect
+import json
+import os
+import threading
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+
+try:
+    import fcntl
+except ImportError:  # Windows, where appends from concurrent processes are not serialized
+    fcntl = None
+
+ARTICLE_STORE_PATH = os.getenv("ARTICLE_STORE_PATH", "./articles.jsonl")
+
+
+def publish_timestamp(record):
+    return parsedate_to_datetime(record["publish_date"]).timestamp()
+
+
+class ArticleStore:
+    """Append-only JSON Lines log of article records, indexed in memory by title, URL and publish date.
+
+    Adding a record whose title is already in the log supersedes the earlier line, and compact() rewrites
+    the log with only the current records. An append is a single locked write of whole lines, so readers
+    never see part of a record, and the indexes only read the bytes appended since they were last synced.
+    Lookups seek straight to the record's line instead of keeping every record in memory."""
+
+    def __init__(self, path=ARTICLE_STORE_PATH):
+        self.path = path
+        self._lock = threading.RLock()
+        self._reset(None)
+
+    def _reset(self, identity):
+        self._identity = identity
+        self._size = 0
+        self._lines = 0
+        self._offsets = {}
+        self._urls = {}
+        self._titles_by_url = {}
+        self._timestamps = {}
+        self._by_date = []
+
+    def _unindex(self, title):
+        timestamp = self._timestamps.pop(title)
+        del self._by_date[bisect.bisect_left(self._by_date, (timestamp, title))]
+        url = self._urls.pop(title)
+        if self._titles_by_url.get(url) == title:
+            del self._titles_by_url[url]
+
+    def _index(self, record, offset):
+        title = record["title"]
+        if title in self._offsets:
+            self._unindex(title)
+        timestamp = publish_timestamp(record)
+        self._offsets[title] = offset
+        self._urls[title] = record["public_url"]
+        self._titles_by_url[record["public_url"]] = title
+        self._timestamps[title] = timestamp
+        bisect.insort(self._by_date, (timestamp, title))
+        self._lines += 1
+
+    def _sync(self, file):
+        """Brings the indexes up to date with an open log file, reindexing from the start if the file
+        was replaced by compact(). A trailing line without a newline is an interrupted append and is ignored."""
+        stat = os.fstat(file.fileno())
+        identity = (stat.st_dev, stat.st_ino)
+        if identity != self._identity or stat.st_size < self._size:
+            self._reset(identity)
+        if stat.st_size == self._size:
+            return
+        file.seek(self._size)
+        offset = self._size
+        for line in file:
+            if not line.endswith(b"\n"):
+                break
+            self._index(json.loads(line), offset)
+            offset += len(line)
+        self._size = offset
+
+    @contextmanager
+    def _open(self):
+        """Opens the log for reading with the indexes synced to it, holding the lock so the offsets match the file"""
+        with self._lock:
+            try:
+                file = open(self.path, "rb")
+            except FileNotFoundError:
+                self._reset(None)
+                yield None
+                return
+            with file:
+                self._sync(file)
+                yield file
+
+    @contextmanager
+    def _open_for_write(self):
+        """Opens the log for appending under an exclusive lock shared with other processes"""
+        with self._lock:
+            while True:
+                file = open(self.path, "ab+")
+                if fcntl is not None:
+                    fcntl.flock(file, fcntl.LOCK_EX)
+                # compact() may have replaced the file while this process waited for the lock
+                if os.fstat(file.fileno()).st_ino == os.stat(self.path).st_ino:
+                    break
+                file.close()
+            with file:
+                self._sync(file)
+                yield file
+
+    def _read(self, file, title):
+        file.seek(self._offsets[title])
+        return json.loads(file.readline())
+
+    def refresh(self):
+        """Indexes any records appended by other processes since the last read"""
+        with self._open():
+            pass
+
+    @property
+    def version(self):
+        """A token that changes whenever records are added or the log is compacted"""
+        with self._open():
+            return self._identity, self._size
+
+    def appended_since(self, version):
+        """Returns (records appended since the given version, current version). The records are None if
+        the log was compacted or replaced since then, and every record has to be read again."""
+        with self._open() as file:
+            current = (self._identity, self._size)
+            if file is None:
+                return [], current
+            if version is None or version[0] != self._identity or version[1] > self._size:
+                return None, current
+            file.seek(version[1])
+            data = file.read(self._size - version[1])
+            return [json.loads(line) for line in data.splitlines()], current
+
+    def __len__(self):
+        with self._open():
+            return len(self._offsets)
+
+    def __contains__(self, title):
+        with self._open():
+            return title in self._offsets
+
+    @property
+    def superseded(self):
+        """Number of lines in the log holding an outdated version of a record"""
+        with self._open():
+            return self._lines - len(self._offsets)
+
+    def unstored(self, records):
+        """Returns the records whose title and public url are both not in the store"""
+        with self._open():
+            return [
+                record
+                for record in records
+                if record["title"] not in self._offsets
+                and record["public_url"] not in self._titles_by_url
+            ]
+
+    def get(self, title):
+        """Returns the record with the given title, or None"""
+        with self._open() as file:
+            return self._read(file, title) if title in self._offsets else None
+
+    def get_by_url(self, url):
+        """Returns the record with the given public url, or None"""
+        with self._open() as file:
+            title = self._titles_by_url.get(url)
+            return self._read(file, title) if title is not None else None
+
+    def between(self, start=None, end=None):
+        """Returns the records published from the start timestamp up to but excluding end, most recent first"""
+        with self._open() as file:
+            low = 0 if start is None else bisect.bisect_left(self._by_date, (start,))
+            high = (
+                len(self._by_date)
+                if end is None
+                else bisect.bisect_left(self._by_date, (end,))
+            )
+            return [
+                self._read(file, title) for _, title in reversed(self._by_date[low:high])
+            ]
+
+    def newest(self, n):
+        """Returns the n most recently published records, most recent first"""
+        with self._open() as file:
+            return [
+                self._read(file, title)
+                for _, title in reversed(self._by_date[max(len(self._by_date) - n, 0) :])
+            ]
+
+    def __iter__(self):
+        """Streams the current version of every record in log order, one line at a time"""
+        try:
+            file = open(self.path, "rb")
+        except FileNotFoundError:
+            return
+        with file:
+            with self._lock:
+                self._sync(file)
+                offsets, size = dict(self._offsets), self._size
+            # The open file keeps reading the same log even if compact() replaces it meanwhile
+            file.seek(0)
+            offset = 0
+            for line in file:
+                if offset >= size:
+                    break
+                record = json.loads(line)
+                if offsets.get(record["title"]) == offset:
+                    yield record
+                offset += len(line)
+
+    def append(self, records):
+        """Atomically appends records, superseding any earlier record with the same title"""
+        records = list(records)
+        lines = [json.dumps(record).encode() + b"\n" for record in records]
+        if not lines:
+            return
+        with self._open_for_write() as file:
+            # Drop what an interrupted append left behind, so the new lines start on a line boundary
+            if os.fstat(file.fileno()).st_size > self._size:
+                file.truncate(self._size)
+            file.write(b"".join(lines))
+            file.flush()
+            os.fsync(file.fileno())
+            offset = self._size
+            for record, line in zip(records, lines):
+                self._index(record, offset)
+                offset += len(line)
+            self._size = offset
+
+    def compact(self):
+        """Rewrites the log with only the current version of each record, oldest first.
+        Returns the number of superseded lines dropped."""
+        with self._open_for_write() as file:
+            dropped = self._lines - len(self._offsets)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "wb") as compacted:
+                for _, title in self._by_date:
+                    file.seek(self._offsets[title])
+                    compacted.write(file.readline())
+                compacted.flush()
+                os.fsync(compacted.fileno())
+            os.replace(tmp_path, self.path)
+        self.refresh()
+        return dropped
+
+    def maybe_compact(self, max_superseded_ratio=0.25):
+        """Compacts the log once superseded lines make up more than the given share of it"""
+        with self._open():
+            superseded = self._lines - len(self._offsets)
+            if superseded == 0 or superseded <= max_superseded_ratio * self._lines:
+                return 0
+        return self.compact()
+
+    @classmethod
+    def load_or_create(cls, path=ARTICLE_STORE_PATH, json_file_name="data.json"):
+        """Opens the store, importing the articles from a data.json file the first time it is missing"""
+        store = cls(path)
+        if not os.path.exists(path) and os.path.exists(json_file_name):
+            with open(json_file_name, "r") as file:
+                articles = json.load(file)
+            print(f"Importing {len(articles)} articles from {json_file_name} into {path}")
+            store.append(sorted(articles, key=publish_timestamp))
+        return store
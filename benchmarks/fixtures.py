@@ -0,0 +1,220 @@
+"""Synthetic corpus and local stub servers so the benchmarks run without network access"""
+
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import urllib.parse
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TOPICS = [
+    ("CPI Inflation", ["CPI", "core services", "shelter", "used vehicles", "food"]),
+    ("PPI", ["PPI", "3-month rate", "final demand", "seasonal adjustments"]),
+    ("Fed Balance Sheet", ["QT", "reserve balances", "ON RRPs", "MBS", "Treasuries"]),
+    ("Housing", ["mortgage rates", "existing home sales", "inventory", "median price"]),
+    ("Jobs", ["nonfarm payrolls", "unemployment rate", "benchmark revisions", "JOLTS"]),
+    ("Retail Sales", ["ecommerce", "auto dealers", "restaurants", "drunken sailors"]),
+    ("Treasury Yields", ["10-year yield", "2-year yield", "yield curve", "T-bills"]),
+    (
+        "Commercial Real Estate",
+        ["office CMBS", "delinquency rate", "special servicing"],
+    ),
+]
+WORDS = (
+    "the of and to in a is that for it as was with be by on not he this are or his from at "
+    "which but have an they you were their one all we can her has there been if more when will "
+    "would who so no prices rates spending consumers economy market billion percent year month"
+).split()
+
+
+def _sentence(rng, terms):
+    words = rng.choices(WORDS, k=rng.randint(12, 28))
+    words.insert(rng.randrange(len(words)), rng.choice(terms))
+    words.insert(rng.randrange(len(words)), f"{rng.uniform(-5, 12):.1f}%")
+    return " ".join(words).capitalize() + "."
+
+
+def synthetic_article_markdown(rng, title, terms, sections=5):
+    parts = [f"# {title}\n"]
+    for section in range(sections):
+        parts.append(f"## {rng.choice(terms).title()} {section + 1}\n")
+        for _ in range(rng.randint(2, 4)):
+            parts.append(
+                " ".join(_sentence(rng, terms) for _ in range(rng.randint(3, 6))) + "\n"
+            )
+        image = hashlib.md5(f"{title}{section}".encode()).hexdigest()[:10]
+        parts.append(
+            f"[![chart](https://wolfstreet.com/wp-content/uploads/{image}.png)](https://wolfstreet.com/wp-content/uploads/{image}.png)\n"
+        )
+    parts.append("* * *\nComments and donation links")
+    return "\n".join(parts)
+
+
+def build_corpus(directory, num_articles=200, seed=7, first_post_id=100000):
+    """Writes articles.jsonl and the article markdown files for a synthetic corpus, returning the article
+    list from most recent to oldest"""
+    rng = random.Random(seed)
+    os.makedirs(os.path.join(directory, "data"), exist_ok=True)
+    newest = datetime(2025, 11, 5, 12, 0, tzinfo=timezone.utc)
+    articles = []
+    for i in range(num_articles):
+        topic, terms = TOPICS[i % len(TOPICS)]
+        post_id = first_post_id + num_articles - i
+        title = f"{topic} Update {post_id}: {rng.choice(terms).title()} {rng.choice(['Jumps', 'Drops', 'Stalls', 'Spikes'])}"
+        markdown = synthetic_article_markdown(
+            rng, title, terms, sections=rng.randint(3, 8)
+        )
+        file_location = f"./data/{title}.md"
+        with open(os.path.join(directory, file_location), "w") as file:
+            file.write(markdown)
+        articles.append(
+            {
+                "title": title,
+                "public_url": f"https://wolfstreet.com/?p={post_id}",
+                "publish_date": format_datetime(newest - timedelta(hours=13 * i)),
+                "file_location": file_location,
+                "summary": " ".join(_sentence(rng, terms) for _ in range(6)),
+            }
+        )
+    # The article store log is kept oldest first
+    with open(os.path.join(directory, "articles.jsonl"), "w") as file:
+        for article in reversed(articles):
+            file.write(json.dumps(article) + "\n")
+    return articles
+
+
+class HashEmbeddingFunction:
+    """Deterministic bag-of-words hashing embeddings, for runs where the ONNX model cannot be downloaded"""
+
+    def __init__(self, dimensions=384):
+        self.dimensions = dimensions
+
+    def __call__(self, input):
+        embeddings = []
+        for text in input:
+            vector = [0.0] * self.dimensions
+            for word in text.lower().split():
+                digest = int(hashlib.md5(word.encode()).hexdigest(), 16)
+                vector[digest % self.dimensions] += 1.0 if digest & 1 else -1.0
+            norm = sum(v * v for v in vector) ** 0.5 or 1.0
+            embeddings.append([v / norm for v in vector])
+        return embeddings
+
+
+class StubServer:
+    """Serves an RSS feed, urltomarkdown responses, chart images and OpenAI chat completions from one local port"""
+
+    def __init__(
+        self, feed_articles, markdown_by_url, completion_delay=0.0, feed_page_size=None
+    ):
+        self.feed_articles = feed_articles
+        self.markdown_by_url = markdown_by_url
+        self.completion_delay = completion_delay
+        # Like WordPress, ?paged=N serves the N-th page of feed_page_size items
+        self.feed_page_size = feed_page_size
+        self.requests = {
+            "rss": 0,
+            "rss_not_modified": 0,
+            "markdown": 0,
+            "images": 0,
+            "completions": 0,
+        }
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.url = f"http://127.0.0.1:{self._server.server_port}"
+
+    def __enter__(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def rss(self, page=1):
+        articles = self.feed_articles
+        if self.feed_page_size:
+            start = (page - 1) * self.feed_page_size
+            articles = articles[start : start + self.feed_page_size]
+        elif page > 1:
+            articles = []
+        items = "".join(
+            f"<item><title>{article['title']}</title><link>{article['public_url']}</link>"
+            f"<guid>{article['public_url']}</guid><pubDate>{article['publish_date']}</pubDate></item>"
+            for article in articles
+        )
+        return f'<?xml version="1.0"?><rss version="2.0"><channel><title>Wolf Street</title>{items}</channel></rss>'
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, body, content_type, headers=None):
+                body = body.encode() if isinstance(body, str) else body
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                parsed = urllib.parse.urlparse(self.path)
+                query = urllib.parse.parse_qs(parsed.query)
+                if parsed.path == "/feed/":
+                    rss = stub.rss(int(query.get("paged", ["1"])[0]))
+                    if "<item>" not in rss:
+                        return self._send(404, "not found", "text/plain")
+                    etag = f'"{hashlib.md5(rss.encode()).hexdigest()}"'
+                    if self.headers.get("If-None-Match") == etag:
+                        stub.requests["rss_not_modified"] += 1
+                        return self._send(304, b"", "application/rss+xml")
+                    stub.requests["rss"] += 1
+                    return self._send(200, rss, "application/rss+xml", {"ETag": etag})
+                if parsed.path.startswith("/wp-content/uploads/"):
+                    stub.requests["images"] += 1
+                    image = b"\x89PNG\r\n\x1a\n" + hashlib.md5(parsed.path.encode()).digest()
+                    return self._send(200, image, "image/png")
+                url = query.get("url", [""])[0]
+                markdown = stub.markdown_by_url.get(url)
+                if markdown is None:
+                    return self._send(404, "not found", "text/plain")
+                stub.requests["markdown"] += 1
+                return self._send(200, markdown, "text/plain", {"X-Title": "stub"})
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                stub.requests["completions"] += 1
+                time.sleep(stub.completion_delay)
+                prompt = json.dumps(body["messages"])[-200:]
+                content = f"Stub summary of {len(prompt)} characters."
+                response = {
+                    "id": "chatcmpl-stub",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": body["model"],
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": content},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": {
+                        "prompt_tokens": 100,
+                        "completion_tokens": 10,
+                        "total_tokens": 110,
+                    },
+                }
+                return self._send(200, json.dumps(response), "application/json")
+
+        return Handler
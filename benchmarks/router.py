@@ -0,0 +1,74 @@
+"""Tunes the retrieval router's similarity thresholds on labelled questions.
+
+Embeds each question with the app's embedding model, ranks it against the real article catalog
+(ARTICLE_STORE_PATH) and prints its top similarity and whether it hits a topic keyword, then the
+share of questions each pair of thresholds routes confidently and how many of those are wrong.
+Run from the repo root:
+
+    python -m benchmarks.router
+"""
+
+import argparse
+
+from benchmarks.run import QUERIES
+
+# Questions that do not need the articles: about the bot, general knowledge or unrelated to the economy
+NO_RETRIEVAL_QUERIES = [
+    "What is your name?",
+    "Can you help me write a cover letter?",
+    "What is the capital of France?",
+    "How do I bake sourdough bread?",
+    "What is a good rate to tip at a restaurant?",
+    "I think my home wifi is slow, how do I fix it?",
+    "Summarize this article for me in one sentence",
+    "Tell me a joke",
+    "What's the weather like today?",
+    "Translate good morning into Spanish",
+]
+
+THRESHOLDS = [0.2, 0.25, 0.3, 0.35, 0.4, 0.45, 0.5, 0.55, 0.6, 0.65]
+
+
+def score(questions, router):
+    """Returns (question, top similarity, has keyword) for each question"""
+    from retrieval_router import RETRIEVAL_KEYWORD_PATTERN
+
+    scores = []
+    for question in questions:
+        ranked = router.article_index.rank(router.embed_query(question))
+        top_similarity = ranked[0][1] if ranked else 0.0
+        scores.append((question, top_similarity, RETRIEVAL_KEYWORD_PATTERN.search(question) is not None))
+    return scores
+
+
+def confident(similarity, has_keyword, high, low):
+    return similarity >= high or (has_keyword and similarity >= low)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--questions", nargs="*", default=[], help="more questions that need retrieval")
+    args = parser.parse_args()
+
+    import chatbot_helper
+
+    router = chatbot_helper.retrieval_router
+    retrieval = score(QUERIES + args.questions, router)
+    no_retrieval = score(NO_RETRIEVAL_QUERIES, router)
+
+    for label, scores in [("needs retrieval", retrieval), ("no retrieval", no_retrieval)]:
+        print(f"\n{label}:")
+        for question, similarity, has_keyword in sorted(scores, key=lambda row: row[1]):
+            print(f"  {similarity:.3f} {'keyword' if has_keyword else '       '} {question}")
+
+    print("\nhigh  low   confident  wrong")
+    for high in THRESHOLDS:
+        for low in [threshold for threshold in THRESHOLDS if threshold < high]:
+            right = sum(confident(similarity, keyword, high, low) for _, similarity, keyword in retrieval)
+            wrong = sum(confident(similarity, keyword, high, low) for _, similarity, keyword in no_retrieval)
+            print(f"{high:.2f}  {low:.2f}  {right:>4}/{len(retrieval):<4}  {wrong:>2}/{len(no_retrieval)}")
+    print(f"\nCurrent: ROUTER_HIGH_SIMILARITY={router.high_similarity} ROUTER_LOW_SIMILARITY={router.low_similarity}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,406 @@
+"""Offline micro-benchmarks for ingestion and retrieval.
+
+Runs against a synthetic corpus in the article store format with local stub servers standing in for
+urltomarkdown, the RSS feed and OpenAI, so no network access is needed. Run from the repo root:
+
+    python -m benchmarks.run --articles 200 --compare benchmarks/results/baseline.json
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from benchmarks.fixtures import HashEmbeddingFunction, StubServer, build_corpus
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(REPO_ROOT, "benchmarks", "results")
+
+QUERIES = [
+    "What does Wolf think about inflation in the United States?",
+    "Provide the key points in Wolf Street's analysis of the most recent CPI report",
+    "What is the likely floor on the Federal Reserve Bank's balance sheet?",
+    "3-month PPI rate",
+    "Fed balance sheet floor reserve balances",
+    "existing home sales inventory and median price",
+    "office CMBS delinquency rate",
+    "nonfarm payrolls benchmark revisions",
+    "10-year yield and the yield curve",
+    "retail sales drunken sailors ecommerce",
+]
+
+
+def percentiles(samples_ms):
+    ordered = sorted(samples_ms)
+
+    def nearest_rank(p):
+        return ordered[min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))]
+
+    return {
+        "mean_ms": sum(ordered) / len(ordered),
+        "p50_ms": nearest_rank(50),
+        "p90_ms": nearest_rank(90),
+        "p99_ms": nearest_rank(99),
+        "max_ms": ordered[-1],
+    }
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix="wolfstreet-bench-")
+    articles = build_corpus(workdir, args.articles)
+    new_articles = build_corpus(
+        os.path.join(workdir, "new"), args.new_articles, seed=11, first_post_id=900000
+    )
+    markdown_by_url = {}
+    for article in new_articles:
+        with open(os.path.join(workdir, "new", article["file_location"])) as file:
+            markdown_by_url[article["public_url"]] = file.read()
+
+    with StubServer(new_articles, markdown_by_url, args.completion_delay) as stub:
+        # Charts in fetched articles link to the stub, so chart extraction never leaves the machine
+        for url, markdown in markdown_by_url.items():
+            markdown_by_url[url] = markdown.replace(
+                "https://wolfstreet.com/wp-content/", f"{stub.url}/wp-content/"
+            )
+        os.environ.update(
+            {
+                "OPENAI_API_KEY": "stub",
+                "OPENAI_BASE_URL": f"{stub.url}/v1",
+                "URLTOMARKDOWN_URL": f"{stub.url}/",
+                "LLM_CACHE_PATH": os.path.join(workdir, "llm_cache.db"),
+                "BM25_INDEX_PATH": os.path.join(workdir, "bm25_index.json"),
+                "FEED_INDEX_PATH": os.path.join(workdir, "feed_index.json"),
+                "LANGCHAIN_TRACING_V2": "false",
+            }
+        )
+        # The app modules use paths relative to the working directory
+        os.chdir(workdir)
+        sys.path.insert(0, REPO_ROOT)
+        import chatbot_helper
+        import data
+        from article_store import ArticleStore
+        from chart_index import ChartIndex
+        import fetcher
+        import summarize
+        import chromadb.utils.embedding_functions as embedding_functions
+        from context_packer import count_tokens
+        from embedding_batcher import EmbeddingBatcher
+
+        if args.embedding == "onnx":
+            embedding_function = embedding_functions.DefaultEmbeddingFunction()
+        else:
+            embedding_function = HashEmbeddingFunction()
+
+        data.CHROMA_CLIENT = chatbot_helper.vector_backend.client
+        data.EMBEDDING_FUNCTION = embedding_function
+        data.CHROMA_COLLECTION = data.CHROMA_CLIENT.get_or_create_collection(
+            name="wolfstreet_articles", embedding_function=embedding_function
+        )
+        chatbot_helper.embedding_function = embedding_function
+        fetcher._default_fetcher = fetcher.ArticleFetcher(
+            base_url=f"{stub.url}/", requests_per_minute=10**6, burst=100, max_workers=8
+        )
+        summarize.set_request_limits(requests_per_minute=10**6)
+
+        results = {}
+
+        # Chunking
+        markdowns = []
+        for article in articles:
+            with open(article["file_location"]) as file:
+                markdowns.append((article, file.read()))
+        data.split_article_into_chunks(markdowns[0][1], markdowns[0][0]["title"])
+        start = time.perf_counter()
+        chunk_count = 0
+        for article, markdown in markdowns:
+            chunk_count += len(
+                data.split_article_into_chunks(markdown, article["title"])
+            )
+        elapsed = time.perf_counter() - start
+        results["split_article_into_chunks"] = {
+            "articles_per_s": len(markdowns) / elapsed,
+            "chunks_per_s": chunk_count / elapsed,
+            "mb_per_s": sum(len(m) for _, m in markdowns) / elapsed / 1e6,
+        }
+
+        chunk_records = []
+        for article, markdown in markdowns:
+            chunk_records.extend(data.article_chunk_records(article, markdown))
+
+        # Embedding, one chunk per call and batched
+        single = chunk_records[: args.single_chunks]
+        start = time.perf_counter()
+        for record in single:
+            data.embed_and_save_in_chroma(
+                record["chunk_id"],
+                record["page_content"],
+                record["url"],
+                record["title"],
+                record["date"],
+            )
+        elapsed = time.perf_counter() - start
+        results["embed_and_save_in_chroma"] = {"chunks_per_s": len(single) / elapsed}
+
+        start = time.perf_counter()
+        data.embed_and_save_chunks_in_chroma(chunk_records, diff=False)
+        elapsed = time.perf_counter() - start
+        # Compare EMBED_WORKERS settings with --embedding onnx, the hashing embeddings cost no CPU to speak of
+        results["embed_and_save_chunks_in_chroma"] = {
+            "chunks_per_s": len(chunk_records) / elapsed,
+            "workers": data.EMBED_WORKERS,
+        }
+
+        # Re-ingesting every article after editing one section in 10% of them
+        edited_records = []
+        for i, (article, markdown) in enumerate(markdowns):
+            if i % 10 == 0:
+                markdown = markdown.replace(
+                    "\n\n", "\n\nUpdate: revised figures.\n\n", 1
+                )
+            edited_records.extend(data.article_chunk_records(article, markdown))
+        start = time.perf_counter()
+        reembedded = data.embed_and_save_chunks_in_chroma(edited_records)
+        results["reingest_after_edits"] = {
+            "seconds": time.perf_counter() - start,
+            "chunks_reembedded": reembedded,
+            "chunks_total": len(edited_records),
+        }
+
+        # RSS polling with new articles to fetch, summarize and embed
+        shutil.copy("articles.jsonl", "ingest.jsonl")
+        ingest_store = ArticleStore("ingest.jsonl")
+        start = time.perf_counter()
+        ingested = data.check_for_latest_articles(
+            f"{stub.url}/feed/", ingest_store, embed=True
+        )
+        elapsed = time.perf_counter() - start
+        results["check_for_latest_articles"] = {
+            "articles_per_s": len(ingested) / elapsed,
+            "seconds": elapsed,
+        }
+        start = time.perf_counter()
+        data.check_for_latest_articles(f"{stub.url}/feed/", ingest_store, embed=True)
+        results["check_for_latest_articles_nothing_new"] = {
+            "seconds": time.perf_counter() - start
+        }
+
+        # Article store: appending one article, the app picking it up, and lookups
+        store = ArticleStore("articles.jsonl")
+        catalog = chatbot_helper.ARTICLE_CATALOG
+        catalog.reload_if_changed(force=True)
+        append_ms = timed(store.append, [dict(new_articles[0], title="Appended")])[1]
+        results["article_store"] = {
+            "append_ms": append_ms,
+            "catalog_reload_ms": timed(catalog.reload_if_changed, force=True)[1],
+            "get_by_title_ms": timed(store.get, articles[len(articles) // 2]["title"])[1],
+            "get_by_url_ms": timed(store.get_by_url, articles[-1]["public_url"])[1],
+            "stream_articles_per_s": len(store) / (timed(list, store)[1] / 1000),
+        }
+
+        # Retrieval latency, cold caches and warm caches
+        queries = [QUERIES[i % len(QUERIES)] for i in range(args.queries)]
+        for name, function in [
+            ("query_articles", chatbot_helper.query_articles),
+            (
+                "fetch_article_chunks_from_query_search",
+                chatbot_helper.fetch_article_chunks_from_query_search,
+            ),
+        ]:
+            cold = []
+            for query in queries:
+                chatbot_helper.query_embedding_cache.clear()
+                chatbot_helper.retrieval_cache.clear()
+                cold.append(timed(function, query)[1])
+            for query in set(queries):
+                function(query)
+            warm = [timed(function, query)[1] for query in queries]
+            results[f"{name}_cold"] = percentiles(cold)
+            results[f"{name}_warm"] = percentiles(warm)
+
+        # Query embedding from concurrent sessions, one model call per query and micro-batched
+        texts = [f"{QUERIES[i % len(QUERIES)]} {i}" for i in range(args.queries * 4)]
+        batcher = EmbeddingBatcher(embedding_function)
+        for name, embed in [
+            ("unbatched", lambda text: embedding_function([text])[0]),
+            ("batched", batcher.embed),
+        ]:
+            with ThreadPoolExecutor(max_workers=args.sessions) as pool:
+                start = time.perf_counter()
+                list(pool.map(embed, texts))
+                elapsed = time.perf_counter() - start
+            results[f"concurrent_query_embedding_{name}"] = {
+                "queries_per_s": len(texts) / elapsed
+            }
+        results["query_embedding_batched_single_session"] = percentiles(
+            [timed(batcher.embed, text)[1] for text in texts[: args.queries]]
+        )
+
+        # Prompt tokens of the tool message, unpacked and packed for each model budget
+        unpacked, packed = [], {}
+        for query in QUERIES:
+            chunks = chatbot_helper.fetch_article_chunks_from_query_search(query)
+            summaries = chatbot_helper.fetch_article_summaries(list(chunks)[:3])
+            unpacked.append(
+                count_tokens(
+                    chatbot_helper.combine_summaries_and_chunks(
+                        summaries, {title: dict(info) for title, info in chunks.items()}
+                    )
+                )
+            )
+            for model in chatbot_helper.CONTEXT_TOKEN_BUDGETS:
+                content = chatbot_helper.combine_summaries_and_chunks(
+                    summaries,
+                    {title: dict(info) for title, info in chunks.items()},
+                    chatbot_helper.context_token_budget(model),
+                    model,
+                )
+                packed.setdefault(model, []).append(count_tokens(content, model))
+        results["combine_summaries_and_chunks_tokens"] = {
+            "mean_tokens": sum(unpacked) / len(unpacked),
+            "max_tokens": max(unpacked),
+            **{
+                f"{model}_packed_mean_tokens": sum(counts) / len(counts)
+                for model, counts in packed.items()
+            },
+        }
+        # Chart extraction as its own stage: images downloaded and analyzed concurrently, then the
+        # chunks that gained a chart table re-embedded. The second run finds everything cached.
+        for article, markdown in markdowns:
+            with open(article["file_location"], "w") as file:
+                file.write(
+                    markdown.replace(
+                        "https://wolfstreet.com/wp-content/", f"{stub.url}/wp-content/"
+                    )
+                )
+        chart_index = ChartIndex("chart_index.json", "image_cache")
+        image_fetcher = fetcher.ArticleFetcher(
+            requests_per_minute=10**6, burst=100, max_workers=data.CHART_WORKERS
+        )
+        for name in ("extract_charts", "extract_charts_cached"):
+            start = time.perf_counter()
+            analyzed = data.extract_charts(
+                store, chart_index, image_fetcher, max_images=None
+            )
+            elapsed = time.perf_counter() - start
+            results[name] = {"seconds": elapsed, "images_analyzed": analyzed}
+        results["extract_charts"]["images_per_s"] = (
+            results["extract_charts"]["images_analyzed"]
+            / results["extract_charts"]["seconds"]
+        )
+
+        results["stub_requests"] = dict(stub.requests)
+
+    os.chdir(REPO_ROOT)
+    shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "git_commit": git_commit(),
+        "config": {
+            "articles": args.articles,
+            "new_articles": args.new_articles,
+            "queries": args.queries,
+            "single_chunks": args.single_chunks,
+            "sessions": args.sessions,
+            "embedding": args.embedding,
+            "completion_delay": args.completion_delay,
+            "cpu_count": os.cpu_count(),
+        },
+        "results": results,
+    }
+
+
+def higher_is_better(metric):
+    return metric.endswith("_per_s")
+
+
+def compare(current, baseline, threshold):
+    """Prints the change of every metric against a baseline run, returning the regressions"""
+    regressions = []
+    for name, metrics in current["results"].items():
+        for metric, value in metrics.items():
+            previous = baseline["results"].get(name, {}).get(metric)
+            if not previous or name == "stub_requests":
+                continue
+            change = (value - previous) / previous
+            worse = -change if higher_is_better(metric) else change
+            flag = "REGRESSION" if worse > threshold else ""
+            print(
+                f"{name}.{metric}: {previous:.3f} -> {value:.3f} ({change:+.1%}) {flag}"
+            )
+            if flag:
+                regressions.append(f"{name}.{metric}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--articles", type=int, default=200)
+    parser.add_argument("--new-articles", type=int, default=20)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--single-chunks", type=int, default=200)
+    parser.add_argument(
+        "--sessions",
+        type=int,
+        default=8,
+        help="concurrent sessions for the query embedding benchmark",
+    )
+    parser.add_argument(
+        "--embedding",
+        choices=["hash", "onnx"],
+        default="hash",
+        help="hash needs no model download, onnx measures the real MiniLM model",
+    )
+    parser.add_argument("--completion-delay", type=float, default=0.0)
+    parser.add_argument(
+        "--output", default=None, help="defaults to benchmarks/results/<timestamp>.json"
+    )
+    parser.add_argument(
+        "--compare", default=None, help="a previous results file to compare against"
+    )
+    parser.add_argument("--threshold", type=float, default=0.2)
+    args = parser.parse_args()
+
+    report = run(args)
+    print(json.dumps(report, indent=2))
+
+    output = args.output or os.path.join(
+        RESULTS_DIR, datetime.now().strftime("%Y%m%d-%H%M%S") + ".json"
+    )
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"Saved results to {output}")
+
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(report, json.load(file), args.threshold)
+        if regressions:
+            print(
+                f"{len(regressions)} metric(s) regressed by more than {args.threshold:.0%}"
+            )
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+"""Compares the Chroma and memory-mapped NumPy retrieval backends.
+
+Builds a synthetic corpus, stores its chunks both in a Chroma PersistentClient and as a vector
+snapshot, then measures each backend in a fresh process: cold start (imports, opening the store
+and the first query), single-query latency percentiles, batched query throughput and resident
+memory. Run from the repo root:
+
+    python -m benchmarks.vector_backends --articles 500 --dtype float32
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from benchmarks.fixtures import HashEmbeddingFunction, build_corpus
+from benchmarks.run import QUERIES, REPO_ROOT, RESULTS_DIR, git_commit, percentiles
+
+
+def resident_memory_mb():
+    """Returns (current, peak) resident set size in MB"""
+    current = peak = None
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmRSS:"):
+                    current = int(line.split()[1]) / 1024
+                elif line.startswith("VmHWM:"):
+                    peak = int(line.split()[1]) / 1024
+    except OSError:
+        import resource
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return current, peak
+
+
+def build_stores(workdir, args):
+    """Embeds the synthetic corpus into a Chroma collection and exports it as a snapshot"""
+    sys.path.insert(0, REPO_ROOT)
+    import data
+    from vector_backends import ChromaBackend
+    from vector_snapshot import export_snapshot, normalize_rows, read_collection
+
+    if args.embedding == "onnx":
+        import chromadb.utils.embedding_functions as embedding_functions
+
+        embedding_function = embedding_functions.DefaultEmbeddingFunction()
+    else:
+        embedding_function = HashEmbeddingFunction()
+
+    articles = build_corpus(workdir, args.articles)
+    records = []
+    for article in articles:
+        with open(os.path.join(workdir, article["file_location"])) as file:
+            records.extend(data.article_chunk_records(article, file.read()))
+
+    client = ChromaBackend(os.path.join(workdir, "chroma.db")).client
+    collection = client.get_or_create_collection("wolfstreet_articles")
+    for start in range(0, len(records), client.max_batch_size):
+        batch = records[start : start + client.max_batch_size]
+        collection.upsert(
+            ids=[record["chunk_id"] for record in batch],
+            embeddings=embedding_function([record["page_content"] for record in batch]),
+            documents=[record["page_content"] for record in batch],
+            metadatas=[data.chunk_metadata(record) for record in batch],
+        )
+    manifest = export_snapshot(
+        collection, os.path.join(workdir, "snapshot"), args.dtype
+    )
+
+    queries = embedding_function(
+        [QUERIES[i % len(QUERIES)] for i in range(args.queries)]
+    )
+    with open(os.path.join(workdir, "queries.json"), "w") as file:
+        json.dump([list(map(float, query)) for query in queries], file)
+
+    # Exact float32 scores, the reference both backends' results are checked against
+    ids, embeddings, _, _ = read_collection(collection)
+    exact_scores = normalize_rows(queries) @ normalize_rows(embeddings).T
+    return len(records), manifest, ids, exact_scores
+
+
+def recall_against_exact(top_ids, ids, exact_scores, k):
+    """Fraction of returned ids within the exact top-k, counting ties with the k-th score as hits"""
+    rows = {chunk_id: i for i, chunk_id in enumerate(ids)}
+    hits = total = 0
+    for returned, scores in zip(top_ids, exact_scores):
+        kth_score = sorted(scores, reverse=True)[k - 1]
+        hits += sum(scores[rows[chunk_id]] >= kth_score - 1e-6 for chunk_id in returned)
+        total += k
+    return hits / total
+
+
+def worker(args):
+    """Runs in a fresh process so import time and memory belong to one backend"""
+    with open(os.path.join(args.workdir, "queries.json")) as file:
+        queries = json.load(file)
+    rss_before, _ = resident_memory_mb()
+
+    start = time.perf_counter()
+    sys.path.insert(0, REPO_ROOT)
+    from vector_backends import create_backend
+
+    if args.worker == "chroma":
+        backend = create_backend("chroma", path=os.path.join(args.workdir, "chroma.db"))
+    else:
+        backend = create_backend("numpy", path=os.path.join(args.workdir, "snapshot"))
+    first = backend.query(queries[:1], args.n_results)
+    cold_start_ms = (time.perf_counter() - start) * 1000
+
+    latencies, top_ids = [], []
+    for query in queries:
+        query_start = time.perf_counter()
+        result = backend.query([query], args.n_results)
+        latencies.append((time.perf_counter() - query_start) * 1000)
+        top_ids.append(result["ids"][0])
+
+    batch_start = time.perf_counter()
+    for start in range(0, len(queries), args.batch_size):
+        backend.query(queries[start : start + args.batch_size], args.n_results)
+    batch_elapsed = time.perf_counter() - batch_start
+
+    rss, peak_rss = resident_memory_mb()
+    print(
+        json.dumps(
+            {
+                "cold_start_ms": cold_start_ms,
+                "first_result_count": len(first["ids"][0]),
+                "query": percentiles(latencies),
+                f"batched_{args.batch_size}_queries_per_s": len(queries)
+                / batch_elapsed,
+                "rss_mb": rss,
+                "rss_growth_mb": rss - rss_before if rss is not None else None,
+                "peak_rss_mb": peak_rss,
+                "top_ids": top_ids,
+            }
+        )
+    )
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix="wolfstreet-vector-bench-")
+    try:
+        chunk_count, manifest, ids, exact_scores = build_stores(workdir, args)
+        results = {}
+        for backend in ("chroma", "numpy"):
+            command = [
+                sys.executable, "-m", "benchmarks.vector_backends",
+                "--worker", backend,
+                "--workdir", workdir,
+                "--n-results", str(args.n_results),
+                "--batch-size", str(args.batch_size),
+            ]  # fmt: skip
+            start = time.perf_counter()
+            output = subprocess.check_output(command, cwd=REPO_ROOT, text=True)
+            results[backend] = json.loads(output.strip().splitlines()[-1])
+            results[backend]["process_wall_ms"] = (time.perf_counter() - start) * 1000
+
+            results[backend]["recall_at_k"] = recall_against_exact(
+                results[backend].pop("top_ids"), ids, exact_scores, args.n_results
+            )
+        results["snapshot"] = {
+            key: manifest.get(key)
+            for key in (
+                "dtype",
+                "count",
+                "unique_documents",
+                "embedding_bytes",
+                "recall_at_k",
+            )
+        }
+        results["snapshot"]["disk_bytes"] = directory_size(
+            os.path.join(workdir, "snapshot")
+        )
+        results["chroma_disk_bytes"] = directory_size(
+            os.path.join(workdir, "chroma.db")
+        )
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "git_commit": git_commit(),
+        "config": {
+            "articles": args.articles,
+            "chunks": chunk_count,
+            "queries": args.queries,
+            "n_results": args.n_results,
+            "batch_size": args.batch_size,
+            "dtype": args.dtype,
+            "embedding": args.embedding,
+            "cpu_count": os.cpu_count(),
+        },
+        "results": results,
+    }
+
+
+def directory_size(path):
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(path)
+        for name in names
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--articles", type=int, default=500)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--n-results", type=int, default=7)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument(
+        "--dtype", choices=["float32", "float16", "int8"], default="float32"
+    )
+    parser.add_argument("--embedding", choices=["hash", "onnx"], default="hash")
+    parser.add_argument(
+        "--output",
+        default=None,
+        help="defaults to benchmarks/results/vector-backends-<timestamp>.json",
+    )
+    parser.add_argument("--worker", choices=["chroma", "numpy"], help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(args)
+        return
+
+    report = run(args)
+    print(json.dumps(report, indent=2))
+    output = args.output or os.path.join(
+        RESULTS_DIR,
+        "vector-backends-" + datetime.now().strftime("%Y%m%d-%H%M%S") + ".json",
+    )
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"Saved results to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+import json
+import math
+import os
+import re
+import threading
+from collections import Counter
+
+BM25_INDEX_PATH = os.getenv("BM25_INDEX_PATH", "./bm25_index.json")
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[.\-'][a-z0-9]+)*")
+STOP_WORDS = {
+    "a",
+    "an",
+    "and",
+    "are",
+    "as",
+    "at",
+    "be",
+    "by",
+    "for",
+    "from",
+    "has",
+    "have",
+    "in",
+    "is",
+    "it",
+    "its",
+    "of",
+    "on",
+    "or",
+    "that",
+    "the",
+    "this",
+    "to",
+    "was",
+    "were",
+    "what",
+    "which",
+    "with",
+    "does",
+    "do",
+    "about",
+    "how",
+    "wolf",
+    "think",
+}
+
+
+def tokenize(text):
+    """Lowercases text into terms, keeping compounds like "3-month" and "4.5" along with their parts"""
+    terms = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        if token in STOP_WORDS:
+            continue
+        terms.append(token)
+        if "-" in token or "." in token:
+            terms.extend(
+                part for part in re.split(r"[.\-]", token) if part not in STOP_WORDS
+            )
+    return terms
+
+
+class BM25Index:
+    """Inverted index over article chunks scored with Okapi BM25, updated incrementally as chunks are upserted"""
+
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.doc_lengths = {}
+        self.postings = {}
+        self._total_length = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.doc_lengths)
+
+    def upsert(self, ids, documents):
+        """Adds chunks to the index, replacing any chunks already indexed under the same ids"""
+        with self._lock:
+            self._remove(set(ids) & self.doc_lengths.keys())
+            for doc_id, document in zip(ids, documents):
+                terms = tokenize(document)
+                self.doc_lengths[doc_id] = len(terms)
+                self._total_length += len(terms)
+                for term, count in Counter(terms).items():
+                    self.postings.setdefault(term, {})[doc_id] = count
+
+    def remove(self, ids):
+        """Removes chunks from the index"""
+        with self._lock:
+            self._remove(set(ids) & self.doc_lengths.keys())
+
+    def _remove(self, ids):
+        if not ids:
+            return
+        for doc_id in ids:
+            self._total_length -= self.doc_lengths.pop(doc_id)
+        for term in list(self.postings):
+            docs = self.postings[term]
+            for doc_id in ids & docs.keys():
+                del docs[doc_id]
+            if not docs:
+                del self.postings[term]
+
+    def search(self, query_text, n_results=20):
+        """Returns (chunk id, score) pairs for the best matching chunks, highest score first"""
+        with self._lock:
+            num_docs = len(self.doc_lengths)
+            if not num_docs:
+                return []
+            average_length = self._total_length / num_docs
+            scores = Counter()
+            for term in set(tokenize(query_text)):
+                docs = self.postings.get(term)
+                if not docs:
+                    continue
+                idf = math.log(1 + (num_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+                for doc_id, count in docs.items():
+                    length_norm = (
+                        1 - self.b + self.b * self.doc_lengths[doc_id] / average_length
+                    )
+                    scores[doc_id] += (
+                        idf * count * (self.k1 + 1) / (count + self.k1 * length_norm)
+                    )
+            return scores.most_common(n_results)
+
+    def save(self, path=BM25_INDEX_PATH):
+        """Writes the index to disk, storing chunk ids once and postings as [chunk number, count] pairs"""
+        with self._lock:
+            doc_ids = list(self.doc_lengths)
+            doc_numbers = {doc_id: i for i, doc_id in enumerate(doc_ids)}
+            data = {
+                "k1": self.k1,
+                "b": self.b,
+                "doc_ids": doc_ids,
+                "doc_lengths": [self.doc_lengths[doc_id] for doc_id in doc_ids],
+                "postings": {
+                    term: [
+                        [doc_numbers[doc_id], count] for doc_id, count in docs.items()
+                    ]
+                    for term, docs in self.postings.items()
+                },
+            }
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(data, file, separators=(",", ":"))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path=BM25_INDEX_PATH):
+        """Reads an index written by save"""
+        with open(path, "r") as file:
+            data = json.load(file)
+        index = cls(data["k1"], data["b"])
+        doc_ids = data["doc_ids"]
+        index.doc_lengths = dict(zip(doc_ids, data["doc_lengths"]))
+        index._total_length = sum(data["doc_lengths"])
+        index.postings = {
+            term: {doc_ids[number]: count for number, count in docs}
+            for term, docs in data["postings"].items()
+        }
+        return index
+
+    @classmethod
+    def load_or_create(cls, path=BM25_INDEX_PATH):
+        return cls.load(path) if os.path.exists(path) else cls()
+
+
+def reciprocal_rank_fusion(*rankings, k=60):
+    """Fuses ranked lists of ids into one list of (id, score) pairs, best first"""
+    scores = Counter()
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            scores[doc_id] += 1 / (k + rank + 1)
+    return scores.most_common()
@@ -0,0 +1,87 @@
+import hashlib
+import json
+import os
+import threading
+
+CHART_INDEX_PATH = os.getenv("CHART_INDEX_PATH", "./chart_index.json")
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", "./image_cache")
+
+
+class ChartIndex:
+    """Persistent record of the chart images linked from articles: the content hash of each image url and
+    the table extracted from each distinct image. Downloaded images are kept in image_dir under their
+    content hash, so an image is downloaded once per url and analyzed once per content."""
+
+    def __init__(self, path=CHART_INDEX_PATH, image_dir=IMAGE_CACHE_DIR):
+        self.path = path
+        self.image_dir = image_dir
+        self.images = {}
+        self.tables = {}
+        self._lock = threading.Lock()
+
+    def image_hash(self, url):
+        """Returns the content hash of a downloaded image url, or None if it was never downloaded"""
+        image = self.images.get(url)
+        return image["sha256"] if image else None
+
+    def image_path(self, digest):
+        return os.path.join(self.image_dir, digest)
+
+    def add_image(self, url, content, content_type):
+        """Stores a downloaded image and returns its content hash"""
+        digest = hashlib.sha256(content).hexdigest()
+        path = self.image_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(self.image_dir, exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as file:
+                file.write(content)
+            os.replace(tmp_path, path)
+        with self._lock:
+            self.images[url] = {"sha256": digest, "content_type": content_type}
+        return digest
+
+    def read_image(self, url):
+        """Returns (content, content type) of a downloaded image url, or None if it is not cached"""
+        image = self.images.get(url)
+        if image is None or not os.path.exists(self.image_path(image["sha256"])):
+            return None
+        with open(self.image_path(image["sha256"]), "rb") as file:
+            return file.read(), image["content_type"]
+
+    def table(self, url):
+        """Returns the table extracted from the image at url, "" if it is not a chart, or None if it has
+        not been analyzed"""
+        digest = self.image_hash(url)
+        return self.tables.get(digest) if digest else None
+
+    def set_table(self, digest, table):
+        with self._lock:
+            self.tables[digest] = table
+
+    def tables_for(self, urls):
+        """Returns {url: table} for the urls whose images are charts and have been analyzed"""
+        tables = {url: self.table(url) for url in urls}
+        return {url: table for url, table in tables.items() if table}
+
+    def save(self):
+        with self._lock:
+            # Copied so workers still adding images can't change the dicts while they are written
+            data = {"images": dict(self.images), "tables": dict(self.tables)}
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(data, file, indent=1)
+        os.replace(tmp_path, self.path)
+
+    @classmethod
+    def load(cls, path=CHART_INDEX_PATH, image_dir=IMAGE_CACHE_DIR):
+        with open(path, "r") as file:
+            data = json.load(file)
+        index = cls(path, image_dir)
+        index.images = data["images"]
+        index.tables = data["tables"]
+        return index
+
+    @classmethod
+    def load_or_create(cls, path=CHART_INDEX_PATH, image_dir=IMAGE_CACHE_DIR):
+        return cls.load(path, image_dir) if os.path.exists(path) else cls(path, image_dir)
@@ -1,9 +1,7 @@
-import random
-import time
 import streamlit as st
-from chatbot_helper import (SYSTEM_MESSAGE, NUM_ARTICLES, MOST_RECENT_ARTICLE_TITLE, MOST_RECENT_ARTICLE_DATE,
-                            MOST_RECENT_ARTICLE_URL, create_chat_completion_with_rag)
-from openai import OpenAI
+from chatbot_helper import (get_system_message, get_articles_info, stream_chat_completion_with_rag,
+                            new_conversation_history, history_messages_for_model, compact_history, start_warm_up,
+                            start_metrics_server)
 
 st.set_page_config(
     page_title="WolfStreet Chatbot",
@@ -12,19 +10,48 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-with open("styles/styles.css") as css:
-    css_content = css.read()
-    st.markdown(f"<style>{css_content}</style>", unsafe_allow_html=True)
+STARTER_QUESTIONS = [
+    "What does Wolf think about inflation in the United States?",
+    "Provide the key points in Wolf Street's analysis of the most recent CPI report",
+    "What is the likely floor on the Federal Reserve Bank's balance sheet?",
+]
+
+# Loads the embedding model and caches the starter questions' retrieval in the background, once per process
+start_warm_up(STARTER_QUESTIONS)
+
+
+# Started once per process, chatbot_helper can be reloaded on a rerun but the port stays bound
+@st.cache_resource
+def metrics_server():
+    return start_metrics_server()
+
+
+metrics_server()
+
+
+# Read once per process instead of on every rerun
+@st.cache_resource
+def load_styles():
+    with open("styles/styles.css") as css:
+        return css.read()
+
+
+st.markdown(f"<style>{load_styles()}</style>", unsafe_allow_html=True)
+
+# Read from the in-memory article catalog on every rerun, so newly ingested articles show up without a restart
+(NUM_ARTICLES, _, _, MOST_RECENT_ARTICLE_TITLE, MOST_RECENT_ARTICLE_DATE,
+ MOST_RECENT_ARTICLE_URL, _) = get_articles_info()
 
 if "messages" not in st.session_state:
-    st.session_state.messages = [{"role": "system", "content": SYSTEM_MESSAGE}]
+    st.session_state.messages = [{"role": "system", "content": get_system_message()}]
+if "history" not in st.session_state:
+    st.session_state.history = new_conversation_history()
 
 # SIDEBAR
 APP_DESCRIPTION = f"""
 Chatbot that summarizes and analyzes posts from the WolfStreet.com site - It is *not* approved by Wolf Richter or any Wolf Street affiliates.
 """
 
-openai_client = OpenAI()
 with st.sidebar:
     gpt_model = st.selectbox('Select a Model', ('gpt-4o', 'gpt-4o-mini', 'gpt-4-turbo'))
     st.divider()
@@ -41,7 +68,7 @@ with st.sidebar:
         st.write(f"""
         Imagine trying to copy & paste all Wolf Street articles into ChatGPT... you'll get an error! This is because GPT's _context_ can only fit so much.
         RAG solves this by being a simple search engine: based on the user's text, RAG finds the most similar chunks of text from all Wolf Street articles. We then
-        copy & paste those into GPT's context. RAG is far from perfect! That is why I augmented my RAG approach by inserting [metadata about Wolf Street](https://github.com/gweakliem/WolfRichterChatbot/blob/master/chatbot_helper.py#L49) and relevant [pre-summarized articles](https://github.com/gweakliem/WolfRichterChatbot/blob/master/data.json) into context.
+        copy & paste those into GPT's context. RAG is far from perfect! That is why I augmented my RAG approach by inserting [metadata about Wolf Street](https://github.com/gweakliem/WolfRichterChatbot/blob/master/chatbot_helper.py#L49) and relevant [pre-summarized articles](https://github.com/gweakliem/WolfRichterChatbot/blob/master/articles.jsonl) into context.
         
         As context windows increase (Gemini 1.5 [can fit 700,000 words in its context](https://blog.google/technology/ai/google-gemini-next-generation-model-february-2024/#context-window)), RAG will likely become [a historic solution](https://medium.com/@erisco_and/the-end-of-retrieval-augmented-generation-emerging-architectures-signal-a-shift-fdf0aad74d50).
         But for now, it makes my solution more cost effective.
@@ -68,34 +95,22 @@ def add_message_and_respond(prompt):
     with st.chat_message("user"):
         st.markdown(prompt)
     with st.chat_message("assistant"):
-        with st.spinner(""):
-            stream = create_chat_completion_with_rag(prompt,
-                                                     [{"role": msg["role"], "content": msg["content"]} for msg in
-                                                      st.session_state.messages],
-                                                     gpt_model)
-        if type(stream) is str:
-            def stream_data():
-                for word in stream.split():
-                    yield word + " "
-                    time.sleep(random.uniform(0.01, 0.03))
-
-            st.write_stream(stream_data())
-            response = stream
-        else:
-            response = st.write_stream(stream)
+        # The prompt itself is appended by the chat pipeline, so only the earlier messages are passed in
+        message_chain = history_messages_for_model(
+            st.session_state.history,
+            [{"role": msg["role"], "content": get_system_message() if msg["role"] == "system" else msg["content"]}
+             for msg in st.session_state.messages[:-1]],
+            gpt_model)
+        # Tokens are written as soon as the model produces them, for the tool-call turn and the answer
+        response = st.write_stream(stream_chat_completion_with_rag(prompt, message_chain, gpt_model))
     st.session_state.messages.append({"role": "assistant", "content": response})
-
+    compact_history(st.session_state.history, st.session_state.messages)
 
 button_container = st.empty()
 button_string = ""
 with button_container:
     col1, col2 = st.columns(2, gap="small")
-    questions = [
-        "What does Wolf think about inflation in the United States?",
-        "Provide the key points in Wolf Street's analysis of the most recent CPI report",
-        "What is the likely floor on the Federal Reserve Bank's balance sheet?",
-        f"Summarize \"{MOST_RECENT_ARTICLE_TITLE}\""
-    ]
+    questions = STARTER_QUESTIONS + [f"Summarize \"{MOST_RECENT_ARTICLE_TITLE}\""]
     with col1:
         if st.button(questions[0], use_container_width=True):
             button_string = questions[0]
@@ -2,56 +2,267 @@ from pprint import pprint
 import dotenv
 import os
 import json
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 from langsmith.run_helpers import traceable
 import requests
-from datetime import datetime
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from article_catalog import ArticleCatalog, CatalogEmbeddings
+from article_store import ARTICLE_STORE_PATH
+from chart_index import CHART_INDEX_PATH
+from retrieval_router import RetrievalRouter
+from bm25_index import BM25_INDEX_PATH, BM25Index, reciprocal_rank_fusion
+from context_packer import pack_context
+from history import SUMMARY_MESSAGE_NAME, ConversationHistory, message_content, message_role
+from metrics import METRICS
+import contextvars
 
 dotenv.load_dotenv()
 
-#if os.getenv('IS_CLOUD') == 'true':
-__import__('pysqlite3')
-import sys
-sys.modules['sqlite3'] = sys.modules.pop('pysqlite3')
+from vector_backends import create_backend, use_compatible_sqlite
+from query_cache import TTLCache, SemanticAnswerCache
+from embedding_batcher import EmbeddingBatcher
+from time_scope import detect_time_scope, in_time_scope
 
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
-openai_client = OpenAI()
 
-import chromadb
-chroma_client = chromadb.PersistentClient('./chroma.db')
+# Clients and the embedding model are created on first use and shared by every Streamlit session in the process,
+# so importing this module stays cheap. start_warm_up() loads them ahead of the first query.
+_openai_client = None
+_async_openai_client = None
+_embedding_model = None
+# Each resource is checked before taking its lock, so callers only wait on the lock while it is being
+# created, and the slow model load has a lock of its own that cheap lookups never queue behind
+_resource_lock = threading.Lock()
+_embedding_model_lock = threading.Lock()
+
+
+def get_openai_client():
+    global _openai_client
+    if _openai_client is None:
+        with _resource_lock:
+            if _openai_client is None:
+                _openai_client = OpenAI()
+    return _openai_client
+
+
+def get_async_openai_client():
+    global _async_openai_client
+    if _async_openai_client is None:
+        with _resource_lock:
+            if _async_openai_client is None:
+                _async_openai_client = AsyncOpenAI()
+    return _async_openai_client
+
+
+def get_embedding_model():
+    """Returns the MiniLM ONNX embedding function, importing chromadb and loading the model on first use"""
+    global _embedding_model
+    if _embedding_model is not None:
+        return _embedding_model
+    with _embedding_model_lock:
+        if _embedding_model is None:
+            # The embedding function comes from chromadb, which needs a newer SQLite than some hosts ship
+            use_compatible_sqlite()
+            import chromadb.utils.embedding_functions as embedding_functions
+            model = embedding_functions.DefaultEmbeddingFunction()
+            # The ONNX session and tokenizer load on the first call, done here so concurrent callers wait for one load
+            model(['warm up'])
+            _embedding_model = model
+    return _embedding_model
+
+
+def embedding_function(texts):
+    return get_embedding_model()(texts)
+
+
+# RETRIEVAL_BACKEND=numpy serves chunks from a memory-mapped snapshot written by `python vector_snapshot.py export`
+# (at VECTOR_SNAPSHOT_PATH) instead of the Chroma PersistentClient, which is only opened when it is queried
+vector_backend = create_backend()
+
+# Loaded once and kept in memory, reloads itself when articles are appended to the article store
+ARTICLE_CATALOG = ArticleCatalog(ARTICLE_STORE_PATH)
+
+# The starter questions are asked over and over, so query embeddings and retrieval results are cached.
+# Answers to near-duplicate first-turn questions can also be cached by setting ANSWER_CACHE_ENABLED=true.
+query_embedding_cache = TTLCache(max_entries=1024, ttl_seconds=24 * 3600)
+retrieval_cache = TTLCache(max_entries=512, ttl_seconds=3600)
+ANSWER_CACHE_ENABLED = os.getenv('ANSWER_CACHE_ENABLED', 'false').lower() == 'true'
+answer_cache = SemanticAnswerCache(similarity_threshold=float(os.getenv('ANSWER_CACHE_SIMILARITY', 0.95)))
+
+
+def normalize_query(query_text):
+    return ' '.join(query_text.lower().split())
+
+
+def file_version(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def corpus_version():
+    """Returns a token that changes whenever the chunks retrieval can return may have changed: articles
+    ingested into the store, a rebuilt collection or snapshot switched in, or chunks re-embedded with
+    chart tables (each re-embed also rewrites the BM25 index)"""
+    return (
+        ARTICLE_CATALOG.version,
+        vector_backend.version,
+        file_version(CHART_INDEX_PATH),
+        file_version(BM25_INDEX_PATH),
+    )
+
+
+# Query embeddings from concurrent sessions are run through the model together, see EmbeddingBatcher
+EMBEDDING_BATCHING_ENABLED = os.getenv('EMBEDDING_BATCHING_ENABLED', 'true').lower() == 'true'
+query_embedder = EmbeddingBatcher(lambda texts: embedding_function(texts),
+                                  max_batch_size=int(os.getenv('EMBEDDING_BATCH_SIZE', 32)),
+                                  max_wait_ms=float(os.getenv('EMBEDDING_BATCH_MAX_WAIT_MS', 2)))
+
+
+def _embed_query_uncached(query_text):
+    with METRICS.span('query_embedding'):
+        if EMBEDDING_BATCHING_ENABLED:
+            return query_embedder.embed(query_text)
+        return embedding_function([query_text])[0]
+
+
+def embed_query(query_text):
+    """Returns the embedding for a query, reusing it if the same query was embedded recently"""
+    return query_embedding_cache.get_or_compute(normalize_query(query_text), lambda: _embed_query_uncached(query_text))
+
+
+# Vector and BM25 results are fused with reciprocal rank fusion when the prebuilt BM25 index is present,
+# which surfaces chunks matching specific numbers, tickers and report names that embeddings miss
+HYBRID_RETRIEVAL_ENABLED = os.getenv('HYBRID_RETRIEVAL_ENABLED', 'true').lower() == 'true'
+HYBRID_CANDIDATES = int(os.getenv('HYBRID_CANDIDATES', 20))
+RETRIEVAL_N_RESULTS = int(os.getenv('RETRIEVAL_N_RESULTS', 7))
+
+_bm25_index = (None, None)
+_bm25_lock = threading.Lock()
+
+
+def get_bm25_index():
+    """Returns the BM25 index, reloading it when the file on disk changes, or None if there is no index
+    or it does not cover the same chunks as the vector store, where fusing would skew results"""
+    global _bm25_index
+    with _bm25_lock:
+        try:
+            mtime = os.stat(BM25_INDEX_PATH).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        # Checked again when either the index or the corpus changes
+        key = (mtime, corpus_version())
+        if _bm25_index[0] != key:
+            bm25_index = BM25Index.load(BM25_INDEX_PATH)
+            chunks = vector_backend.count()
+            if len(bm25_index) != chunks:
+                print(f'Not using the BM25 index: it holds {len(bm25_index)} chunks, the vector store {chunks}')
+                bm25_index = None
+            _bm25_index = (key, bm25_index)
+        return _bm25_index[1]
+
+
+# Time-bound questions ("the latest CPI report", "last month's retail sales") only search the chunks
+# published in the period they ask about, see time_scope.detect_time_scope
+TIME_SCOPED_RETRIEVAL_ENABLED = os.getenv('TIME_SCOPED_RETRIEVAL_ENABLED', 'true').lower() == 'true'
+
+
+def detect_query_time_scope(query_text):
+    """Returns the publish time range the question is about, relative phrases counting back from the newest article"""
+    if not TIME_SCOPED_RETRIEVAL_ENABLED:
+        return None
+    articles = ARTICLE_CATALOG.articles
+    return detect_time_scope(query_text, articles[0]['timestamp'] if articles else None)
+
+
+def vector_query_articles(query_text, n_results, scope=None):
+    query_embedding = embed_query(query_text)
+    with METRICS.span('vector_query') as span:
+        if scope is None:
+            return vector_backend.query([query_embedding], n_results)
+        results = vector_backend.query([query_embedding], n_results, start=scope.start, end=scope.end)
+        span.set(time_scope=scope.reason, scoped_results=len(results['ids'][0]))
+        if len(results['ids'][0]) < n_results:
+            # Too few chunks in the period, or chunks stored before they had timestamps: fill up from everything
+            everything = vector_backend.query([query_embedding], n_results)
+            seen = set(results['ids'][0])
+            for key in ('ids', 'documents', 'metadatas', 'distances'):
+                results[key][0] = list(results[key][0]) + [
+                    value for doc_id, value in zip(everything['ids'][0], everything[key][0]) if doc_id not in seen
+                ]
+                results[key][0] = results[key][0][:n_results]
+        return results
+
+
+def fetch_chunks(chunks, doc_ids):
+    """Adds the (document, metadata) of the given chunk ids that are not in chunks yet"""
+    missing = [doc_id for doc_id in doc_ids if doc_id not in chunks]
+    if missing:
+        fetched = vector_backend.get(missing, include=["documents", "metadatas"])
+        chunks.update(zip(fetched['ids'], zip(fetched['documents'], fetched['metadatas'])))
+
+
+def hybrid_query_articles(query_text, n_results, bm25_index, scope=None):
+    """Returns the top chunks from fusing vector and BM25 rankings, in the same shape as a Chroma query"""
+    vector_results = vector_query_articles(query_text, HYBRID_CANDIDATES, scope)
+    with METRICS.span('bm25_query'):
+        lexical_results = bm25_index.search(query_text, HYBRID_CANDIDATES)
+    chunks = dict(zip(vector_results['ids'][0], zip(vector_results['documents'][0], vector_results['metadatas'][0])))
+    lexical_ids = [doc_id for doc_id, _ in lexical_results]
+    if scope is not None:
+        # The BM25 index has no dates, so lexical matches are checked against their metadata, and ones
+        # outside the period only rank after those inside it
+        fetch_chunks(chunks, lexical_ids)
+        lexical_ids = [doc_id for doc_id in lexical_ids if doc_id in chunks]
+        in_scope = {doc_id for doc_id in lexical_ids if in_time_scope(chunks[doc_id][1], scope)}
+        lexical_ids = [doc_id for doc_id in lexical_ids if doc_id in in_scope] + [
+            doc_id for doc_id in lexical_ids if doc_id not in in_scope
+        ]
+    fused = reciprocal_rank_fusion(vector_results['ids'][0], lexical_ids)
+    fused_ids = [doc_id for doc_id, _ in fused[:n_results]]
+    fetch_chunks(chunks, fused_ids)
+
+    fused_ids = [doc_id for doc_id in fused_ids if doc_id in chunks]
+    return {
+        'ids': [fused_ids],
+        'documents': [[chunks[doc_id][0] for doc_id in fused_ids]],
+        'metadatas': [[chunks[doc_id][1] for doc_id in fused_ids]],
+        # Fused results have no distance, their rank stands in so callers can still sort by it
+        'distances': [[float(rank) for rank in range(len(fused_ids))]],
+    }
 
 
-def query_articles(query_text, n_results=7):
-    q = chroma_client.get_collection("wolfstreet_articles").query(query_texts=query_text, n_results=n_results)
-    return q
+def query_articles(query_text, n_results=RETRIEVAL_N_RESULTS):
+    bm25_index = get_bm25_index() if HYBRID_RETRIEVAL_ENABLED else None
+    scope = detect_query_time_scope(query_text)
+    key = (corpus_version(), bm25_index is not None, normalize_query(query_text), n_results, scope)
+    if bm25_index is not None:
+        return retrieval_cache.get_or_compute(key, lambda: hybrid_query_articles(query_text, n_results, bm25_index, scope))
+    return retrieval_cache.get_or_compute(key, lambda: vector_query_articles(query_text, n_results, scope))
 
 
-def get_articles_info_from_json(json_file_name):
-    with open(json_file_name, 'r') as file:
-        articles = json.load(file)
-    articles_format = []
-    article_titles = [article['title'] for article in articles]
-    for i, article in enumerate(articles):
-        article['publish_date'] = datetime.strptime(article['publish_date'], "%a, %d %b %Y %H:%M:%S %z").strftime("%b %d, %Y")
-        articles_format.append(f"{i+1}. {article['title']} ({article['publish_date']})")
-    most_recent_article_title = articles[0]['title']
-    most_recent_article_date = articles[0]['publish_date']
-    most_recent_article_url = articles[0]['public_url']
-    oldest_article_date = articles[-1]['publish_date']
-    return (len(articles), articles_format, article_titles,
-            most_recent_article_title, most_recent_article_date, most_recent_article_url, oldest_article_date)
+def get_articles_info(catalog=ARTICLE_CATALOG):
+    articles = catalog.articles
+    return (len(articles), catalog.articles_format, catalog.titles,
+            articles[0]['title'], articles[0]['display_date'], articles[0]['public_url'], articles[-1]['display_date'])
 
 
-(NUM_ARTICLES, ARTICLES_FORMAT, ARTICLE_TITLES,
- MOST_RECENT_ARTICLE_TITLE, MOST_RECENT_ARTICLE_DATE, MOST_RECENT_ARTICLE_URL, OLDEST_ARTICLE_DATE) = get_articles_info_from_json('data.json')
+FULL_ARTICLE_LIST_HEADING = "Here are their names and publish dates from most recent to oldest"
+ARTICLE_WINDOW_HEADING = ("Here are the names and publish dates of the most recent articles and of the articles "
+                          "most related to the question, from most recent to oldest")
 
 
-SYSTEM_MESSAGE = f"""* You are a bot that knows everything about Wolf Richter's writing for Wolf Street (https://wolfstreet.com/). 
+def build_system_message(num_articles, oldest_article_date, articles_format, articles_heading=FULL_ARTICLE_LIST_HEADING):
+    return f"""* You are a bot that knows everything about Wolf Richter's writing for Wolf Street (https://wolfstreet.com/). 
 * You are very knowledgeable about business, finance, and money! You write in a frank and direct manner, and are generally dismissive of major financial news media and commenters who provide what you consider misleading commentary.
 * Your voice is generally factual and data-driven, although you can be acerbically dismissive of commenters who do not appear to have read the article they're commenting on, and generally respond to them with "RTGDFA" which is understood as an exhortation to read the article before commenting, and dismiss what you consider misleading information as "clickbait BS".
 * You are not a licensed financial advisor and do not provide investment advice.
-* You are trained on the {NUM_ARTICLES} most recent Wolf STreet articles. The oldest article is {OLDEST_ARTICLE_DATE}. 
-* Here are their names and publish dates from most recent to oldest: {ARTICLES_FORMAT}
+* You are trained on the {num_articles} most recent Wolf STreet articles. The oldest article is {oldest_article_date}. 
+* {articles_heading}: {articles_format}
 * You will answer questions using Wolf Street articles. You will always respond in markdown. You will always refer to the specific name of the article you are citing and hyperlink to its url, as such: [Article Title](Article URL).
 * If you are referring to Wolf Richter, just say "Wolf". If you can't answer, you will explain why and suggest visiting the comment section at Wolf Street where Wolf can answer it directly!
 * A user's questions may be followed by a bunch of possible answers from Wolf Streed articles. Each article is is separated by `-----` and is formatted as such: `[Article Title](Article URL)\\n[Chunk of Article Content]`. Use your best judgement to answer the user's query based on the articles provided.
@@ -61,61 +272,163 @@ SYSTEM_MESSAGE = f"""* You are a bot that knows everything about Wolf Richter's
 * Gordon Weakliem (https://github.com/gweakliem/) created you. Your code can be found at https://github.com/gweakliem/WolfRichterChatbot. You are not approved by Wolf Richter.
 """
 
-TOOLS = [
-    {
-        "type": "function",
-        "function": {
-            "name": "fetch_article_chunks_for_rag",
-            "description": "This function provides chunks of text from Wolf Street articles that are relevant to the query. "
-                           "ONLY use this function if the existing information in your message history is not enough.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                  "articles": {
-                    "type": "array",
-                    "items": {
-                        "type": "string",
-                        "enum": ARTICLE_TITLES
+
+def build_tools(article_titles):
+    return [
+        {
+            "type": "function",
+            "function": {
+                "name": "fetch_article_chunks_for_rag",
+                "description": "This function provides chunks of text from Wolf Street articles that are relevant to the query. "
+                               "ONLY use this function if the existing information in your message history is not enough.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                      "articles": {
+                        "type": "array",
+                        "items": {
+                            "type": "string",
+                            "enum": article_titles
+                        },
+                        "description": "A list of articles you think is most relevant to the given query from your system message. Provide no more than the top 3 most likely and recent (e.g. ['Two Things about the PPI Today: The March Seasonal Adjustments Were Huge, and the 3-Month Rates All Jumped', 'Beneath the Skin of CPI Inflation, March: Inflation Behaves Very Badly, Saga Far from Over']).",
+                      }
                     },
-                    "description": "A list of articles you think is most relevant to the given query from your system message. Provide no more than the top 3 most likely and recent (e.g. ['Two Things about the PPI Today: The March Seasonal Adjustments Were Huge, and the 3-Month Rates All Jumped', 'Beneath the Skin of CPI Inflation, March: Inflation Behaves Very Badly, Saga Far from Over']).",
-                  }
+                    "required": ["articles"],
                 },
-                "required": ["articles"],
-            },
+            }
         }
-    }
-]
+    ]
+
+
+_prompt_cache = {}
+
+
+def _build_for_catalog_version(name, build):
+    # Prompt strings are rebuilt only when the catalog reloads a new version of the article store
+    version = ARTICLE_CATALOG.version
+    cached = _prompt_cache.get(name)
+    if cached is None or cached[0] != version:
+        cached = (version, build())
+        _prompt_cache[name] = cached
+    return cached[1]
+
+
+def get_system_message():
+    """Returns the system message for the current version of the article catalog"""
+    return _build_for_catalog_version('system_message', lambda: build_system_message(
+        len(ARTICLE_CATALOG), ARTICLE_CATALOG.articles[-1]['display_date'], ARTICLE_CATALOG.articles_format))
+
+
+def get_tools():
+    """Returns the tool schema for the current version of the article catalog"""
+    return _build_for_catalog_version('tools', lambda: build_tools(ARTICLE_CATALOG.titles))
+
+
+# With the article window enabled, the model only sees a bounded list of recent and query-related articles
+# instead of every article in the store, so the prompt stays the same size as the corpus grows
+ARTICLE_WINDOW_ENABLED = os.getenv('ARTICLE_WINDOW_ENABLED', 'false').lower() == 'true'
+ARTICLE_WINDOW_RECENT = int(os.getenv('ARTICLE_WINDOW_RECENT', 15))
+ARTICLE_WINDOW_RANKED = int(os.getenv('ARTICLE_WINDOW_RANKED', 15))
+
+title_index = CatalogEmbeddings(ARTICLE_CATALOG, lambda texts: embedding_function(texts),
+                                lambda article: article['title'])
+
+
+def select_article_window(query_text, n_recent=None, n_ranked=None):
+    """Returns the most recent articles plus those whose titles best match the query, most recent first"""
+    n_recent = ARTICLE_WINDOW_RECENT if n_recent is None else n_recent
+    n_ranked = ARTICLE_WINDOW_RANKED if n_ranked is None else n_ranked
+    articles = ARTICLE_CATALOG.articles
+    selected = {article['title'] for article in articles[:n_recent]}
+
+    ranked = 0
+    for title, _ in title_index.rank(embed_query(query_text)):
+        if ranked >= n_ranked:
+            break
+        if title not in selected:
+            selected.add(title)
+            ranked += 1
+
+    return [article for article in articles if article['title'] in selected]
+
+
+def build_windowed_prompt(query_text):
+    """Returns a system message and tool schema that only list the article window for the query"""
+    window = select_article_window(query_text)
+    window_format = [f"{i + 1}. {article['prompt_line']}" for i, article in enumerate(window)]
+    system_message = build_system_message(len(ARTICLE_CATALOG), ARTICLE_CATALOG.articles[-1]['display_date'],
+                                          window_format, ARTICLE_WINDOW_HEADING)
+    return system_message, build_tools([article['title'] for article in window])
+
+
+# The local router answers the "does this need retrieval?" question without a model call when it is
+# confident, so those turns go straight to one streamed completion with the context attached
+ROUTER_ENABLED = os.getenv('ROUTER_ENABLED', 'false').lower() == 'true'
+article_index = CatalogEmbeddings(ARTICLE_CATALOG, lambda texts: embedding_function(texts),
+                                  lambda article: f"{article['title']}. {article.get('summary', '')}")
+# The similarity thresholds depend on the embedding model, `python -m benchmarks.router` tunes them on real questions
+retrieval_router = RetrievalRouter(article_index, lambda query_text: embed_query(query_text),
+                                   high_similarity=float(os.getenv('ROUTER_HIGH_SIMILARITY', 0.55)),
+                                   low_similarity=float(os.getenv('ROUTER_LOW_SIMILARITY', 0.35)))
+
+
+def route_query(query_text, message_chain):
+    """Returns the router's decision for a query, or None when the router is disabled"""
+    if not ROUTER_ENABLED:
+        return None
+    with METRICS.span('route') as span:
+        decision = retrieval_router.route(query_text, first_turn=is_first_turn(message_chain))
+        span.set(reason=decision.reason, confident=decision.confident)
+    return decision
+
+
+# Retrieval only depends on the query, so it is started alongside the first model call and
+# used if the model asks for it. Summaries are looked up after the tool call since they depend
+# on the titles the model picks, which is a dictionary lookup in the article catalog.
+SPECULATIVE_RETRIEVAL_ENABLED = os.getenv('SPECULATIVE_RETRIEVAL_ENABLED', 'true').lower() == 'true'
+retrieval_executor = ThreadPoolExecutor(max_workers=int(os.getenv('RETRIEVAL_WORKERS', 4)),
+                                        thread_name_prefix='retrieval')
 
 
 @traceable(run_type="llm")
-def call_openai(messages, model):
-    return openai_client.chat.completions.create(
-        model=model,
-        messages=messages,
-        tools=TOOLS
-    )
+def call_openai(messages, model, tools=None):
+    with METRICS.span('first_completion', model=model):
+        completion = get_openai_client().chat.completions.create(
+            model=model,
+            messages=messages,
+            tools=tools or get_tools()
+        )
+    METRICS.record_usage(completion.usage, model, 'first')
+    return completion
 
 
-def fetch_article_summaries(articles_to_summarize, json_file_name='data.json'):
-    """Returns a list of dicts with article titles, summaries, and URLs"""
-    with open(json_file_name, 'r') as file:
-        articles = json.load(file)
+def run_in_executor(loop, func, *args):
+    """loop.run_in_executor on the retrieval pool, carrying the current context so spans keep their request id"""
+    return loop.run_in_executor(retrieval_executor, contextvars.copy_context().run, func, *args)
+
 
+def fetch_article_summaries(articles_to_summarize, catalog=ARTICLE_CATALOG):
+    """Returns a list of dicts with article titles, summaries, and URLs"""
     summaries = []
-    for article_title in articles_to_summarize:
-        article_dict = next(item for item in articles if item["title"] == article_title)
-        summaries.append({
-            "title": article_title,
-            "summary": article_dict["summary"],
-            "url": article_dict["public_url"]
-        })
+    with METRICS.span('summary_lookup') as span:
+        for article_title in articles_to_summarize:
+            article_dict = catalog.get(article_title)
+            if article_dict is None:
+                continue
+            summaries.append({
+                "title": article_title,
+                "summary": article_dict["summary"],
+                "url": article_dict["public_url"]
+            })
+        span.set(requested=len(articles_to_summarize), found=len(summaries))
 
     return summaries
 
 
 def fetch_article_chunks_from_query_search(query_text):
     """Returns an organized list of article chunks from a given query"""
-    q = query_articles(query_text, n_results=7)
+    with METRICS.span('retrieval'):
+        q = query_articles(query_text)
 
     documents = q['documents'][0]
     distances = q['distances'][0]
@@ -126,17 +439,62 @@ def fetch_article_chunks_from_query_search(query_text):
     combined.sort(key=lambda x: x[0])
 
     grouped_chunks = {}
-    for distance, document, metadata, article_id in combined:
+    for rank, (distance, document, metadata, article_id) in enumerate(combined):
         article_title = metadata['title']
         if article_title not in grouped_chunks:
-            grouped_chunks[article_title] = {'url': metadata['url'], 'documents': []}
+            grouped_chunks[article_title] = {'url': metadata['url'], 'documents': [], 'ranks': []}
         grouped_chunks[article_title]['documents'].append(document)
+        grouped_chunks[article_title]['ranks'].append(rank)
 
     return grouped_chunks
 
 
-def combine_summaries_and_chunks(summaries, chunks):
-    """Combines article summaries and chunks into a single string"""
+# Token budget for the summaries and chunks sent with each answer, per model in the chatbot.py selectbox
+CONTEXT_TOKEN_BUDGETS = {
+    'gpt-4o': 6000,
+    'gpt-4o-mini': 4000,
+    'gpt-4-turbo': 6000,
+}
+DEFAULT_CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', 4000))
+
+
+def context_token_budget(openai_model):
+    return CONTEXT_TOKEN_BUDGETS.get(openai_model, DEFAULT_CONTEXT_TOKEN_BUDGET)
+
+
+def pack_summaries_and_chunks(summaries, chunks, token_budget, model):
+    """Keeps the most relevant, least redundant summaries and chunks that fit in the token budget"""
+    candidates = []
+    # Summaries of the articles the model asked for come first, then chunks in retrieval order
+    for summary in summaries:
+        candidates.append({'title': summary['title'], 'url': summary['url'], 'text': summary['summary'],
+                           'header': f"[{summary['title']}]({summary['url']})", 'relevance': 1.0,
+                           'summary': summary})
+    num_chunks = sum(len(info['documents']) for info in chunks.values()) or 1
+    for title, info in chunks.items():
+        ranks = info.get('ranks') or range(len(info['documents']))
+        for rank, document in zip(ranks, info['documents']):
+            candidates.append({'title': title, 'url': info['url'], 'text': document,
+                               'header': f"[{title}]({info['url']})", 'relevance': 1 - rank / num_chunks,
+                               'rank': rank})
+
+    packed = pack_context(candidates, token_budget, model)
+
+    packed_summaries = [candidate['summary'] for candidate in packed if 'summary' in candidate]
+    packed_chunks = {}
+    for candidate in sorted((c for c in packed if 'rank' in c), key=lambda c: c['rank']):
+        if candidate['title'] not in packed_chunks:
+            packed_chunks[candidate['title']] = {'url': candidate['url'], 'documents': [], 'ranks': []}
+        packed_chunks[candidate['title']]['documents'].append(candidate['text'])
+        packed_chunks[candidate['title']]['ranks'].append(candidate['rank'])
+    return packed_summaries, packed_chunks
+
+
+def combine_summaries_and_chunks(summaries, chunks, token_budget=None, model='gpt-4o'):
+    """Combines article summaries and chunks into a single string, packed into token_budget if one is given"""
+    if token_budget is not None:
+        summaries, chunks = pack_summaries_and_chunks(summaries, chunks, token_budget, model)
+
     result = []
     for summary in summaries:
         title = summary['title']
@@ -156,24 +514,145 @@ def combine_summaries_and_chunks(summaries, chunks):
     return "\n".join(result).strip("-----\n")
 
 
-@traceable(run_type="chain")
-def create_chat_completion_with_rag(query_text, message_chain, openai_model):
+# Long conversations keep the most recent turns verbatim and fold older ones into a summary made in the
+# background, so prompt size per turn stays under a per-model ceiling
+HISTORY_KEEP_MESSAGES = int(os.getenv('HISTORY_KEEP_MESSAGES', 6))
+HISTORY_SUMMARY_MODEL = os.getenv('HISTORY_SUMMARY_MODEL', 'gpt-4o-mini')
+HISTORY_TOKEN_CEILINGS = {
+    'gpt-4o': 8000,
+    'gpt-4o-mini': 8000,
+    'gpt-4-turbo': 8000,
+}
+DEFAULT_HISTORY_TOKEN_CEILING = int(os.getenv('HISTORY_TOKEN_CEILING', 6000))
+history_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='history')
+
+
+def summarize_conversation(previous_summary, messages):
+    """Folds conversation turns into the running summary of a conversation"""
+    transcript = "\n".join(f"{message_role(m)}: {message_content(m)}" for m in messages)
+    completion = get_openai_client().chat.completions.create(
+        model=HISTORY_SUMMARY_MODEL,
+        messages=[
+            {
+                "role": "system",
+                "content": "You maintain a running summary of a conversation between a user and a chatbot about "
+                           "Wolf Street articles. Update the summary with the new turns. Keep the questions asked, "
+                           "the key facts and numbers given, and the article titles and links cited. "
+                           "Return a plain text paragraph of no more than 250 words.",
+            },
+            {"role": "user", "content": f"Summary so far: {previous_summary or 'None'}\n\nNew turns:\n{transcript}"},
+        ],
+    )
+    return completion.choices[0].message.content
+
+
+def new_conversation_history():
+    return ConversationHistory(summarize_conversation, keep_messages=HISTORY_KEEP_MESSAGES)
+
+
+def history_messages_for_model(history, messages, openai_model):
+    """Returns the compacted message chain to send for a conversation"""
+    ceiling = HISTORY_TOKEN_CEILINGS.get(openai_model, DEFAULT_HISTORY_TOKEN_CEILING)
+    return history.messages_for_model(messages, openai_model, ceiling)
+
+
+def compact_history(history, messages):
+    """Starts folding older turns into the conversation summary off the request path"""
+    return history.compact_in_background(messages, history_executor)
+
+
+def cache_stats():
+    """Returns hit/miss counters for the query embedding, retrieval and answer caches"""
+    return {
+        'query_embeddings': query_embedding_cache.stats(),
+        'retrieval': retrieval_cache.stats(),
+        'answers': answer_cache.stats(),
+    }
+
+
+def cache_stat_gauge(stat):
+    return lambda: {(('cache', name),): stats[stat] for name, stats in cache_stats().items()}
+
+
+for _stat in ('hits', 'misses', 'hit_rate', 'entries'):
+    METRICS.register_gauges(f'cache_{_stat}', cache_stat_gauge(_stat))
+
+
+def start_metrics_server():
+    """Serves the Prometheus metrics on METRICS_PORT, if set. Called once per process from chatbot.py,
+    as Streamlit re-executes and reloads modules and a second bind would fail."""
+    if os.getenv('METRICS_PORT'):
+        return METRICS.start_http_server(int(os.getenv('METRICS_PORT')))
+    return None
+
+
+def remember_streamed_answer(stream, on_complete):
+    """Passes a completion stream through unchanged and calls on_complete with the full text at the end"""
+    parts = []
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            parts.append(chunk.choices[0].delta.content)
+        yield chunk
+    on_complete(''.join(parts))
+
+
+def is_first_turn(message_chain):
+    return not any(message_role(m) == 'assistant' or (isinstance(m, dict) and m.get('name') == SUMMARY_MESSAGE_NAME)
+                   for m in message_chain)
+
+
+def prepare_message_chain(query_text, message_chain):
+    """Appends the user's query to the message chain and returns the tool schema to send with it"""
+    tools = None
+    if ARTICLE_WINDOW_ENABLED:
+        system_message, tools = build_windowed_prompt(query_text)
+        if message_chain and isinstance(message_chain[0], dict) and message_chain[0]['role'] == 'system':
+            message_chain[0] = {"role": "system", "content": system_message}
+
     message_chain.append({"role": "user", "content": query_text})
+    return tools
+
 
-    completion = call_openai(message_chain, openai_model)
+def build_tool_content(tool_arguments, article_chunks, openai_model):
+    """Combines the summaries of the articles the model asked for with the retrieved chunks"""
+    if 'articles' in tool_arguments:
+        article_titles = json.loads(tool_arguments)['articles']
+        article_summaries = fetch_article_summaries(article_titles)
+    else:
+        article_summaries = []
+    with METRICS.span('context_packing', model=openai_model):
+        return combine_summaries_and_chunks(article_summaries, article_chunks,
+                                            context_token_budget(openai_model), openai_model)
+
+
+@traceable(run_type="chain")
+def create_chat_completion_with_rag(query_text, message_chain, openai_model):
+    # Only first-turn answers are cached, later answers depend on the conversation so far
+    use_answer_cache = ANSWER_CACHE_ENABLED and is_first_turn(message_chain)
+    if use_answer_cache:
+        version = corpus_version()
+        query_embedding = embed_query(query_text)
+        cached_answer = answer_cache.get(query_embedding, openai_model, version)
+        if cached_answer is not None:
+            return cached_answer
+
+    tools = prepare_message_chain(query_text, message_chain)
+
+    speculative_chunks = None
+    if SPECULATIVE_RETRIEVAL_ENABLED:
+        speculative_chunks = retrieval_executor.submit(fetch_article_chunks_from_query_search, query_text)
+
+    completion = call_openai(message_chain, openai_model, tools)
     response_message = completion.choices[0].message
     tool_calls = response_message.tool_calls
     print("\n\n")
     print(tool_calls)
     if tool_calls and tool_calls[0].function.name == "fetch_article_chunks_for_rag":
-        if 'articles' in tool_calls[0].function.arguments:
-            article_titles = json.loads(tool_calls[0].function.arguments)['articles']
-            article_summaries = fetch_article_summaries(article_titles)
+        if speculative_chunks is not None:
+            article_chunks = speculative_chunks.result()
         else:
-            article_summaries = []
-
-        article_chunks = fetch_article_chunks_from_query_search(query_text)
-        combined_content = combine_summaries_and_chunks(article_summaries, article_chunks)
+            article_chunks = fetch_article_chunks_from_query_search(query_text)
+        combined_content = build_tool_content(tool_calls[0].function.arguments, article_chunks, openai_model)
 
         message_chain.append(response_message)
         message_chain.append(
@@ -184,19 +663,230 @@ def create_chat_completion_with_rag(query_text, message_chain, openai_model):
                 "content": combined_content,
             }
         )
-        second_response = openai_client.chat.completions.create(
+        second_response = get_openai_client().chat.completions.create(
             model=openai_model,
             messages=message_chain,
             stream=True
         )
+        if use_answer_cache:
+            return remember_streamed_answer(
+                second_response, lambda answer: answer_cache.set(query_embedding, openai_model, version, answer))
         return second_response
     else:
+        if use_answer_cache:
+            answer_cache.set(query_embedding, openai_model, version, completion.choices[0].message.content)
         return completion.choices[0].message.content
 
 
+# Token usage arrives on a final chunk with no choices; only requested when metrics are recorded
+STREAM_USAGE_OPTIONS = {'stream_options': {'include_usage': True}} if METRICS.enabled else {}
+
+
+def elapsed_ms(start):
+    return (time.perf_counter() - start) * 1000
+
+
+async def astream_chat_completion_with_rag(query_text, message_chain, openai_model):
+    """Streams the answer to a query as text deltas, including the first completion and its tool call"""
+    loop = asyncio.get_running_loop()
+    request_start = time.perf_counter()
+    first_token_at = None
+    use_answer_cache = ANSWER_CACHE_ENABLED and is_first_turn(message_chain)
+    if use_answer_cache:
+        version = corpus_version()
+        query_embedding = await run_in_executor(loop, embed_query, query_text)
+        cached_answer = answer_cache.get(query_embedding, openai_model, version)
+        if cached_answer is not None:
+            METRICS.observe('request_total', elapsed_ms(request_start), model=openai_model, answer_cache_hit=True)
+            yield cached_answer
+            return
+
+    decision = await run_in_executor(loop, route_query, query_text, message_chain)
+    tools = await run_in_executor(loop, prepare_message_chain, query_text, message_chain)
+
+    speculative_chunks = None
+    routed_retrieval = decision is not None and decision.confident and decision.needs_retrieval
+    skip_retrieval = decision is not None and decision.confident and not decision.needs_retrieval
+    if routed_retrieval or (SPECULATIVE_RETRIEVAL_ENABLED and not skip_retrieval):
+        speculative_chunks = run_in_executor(loop, fetch_article_chunks_from_query_search, query_text)
+
+    answer_parts = []
+    if routed_retrieval:
+        # The router already picked the articles, so the tool call the model would have made is filled in locally
+        tool_call = {'id': 'router_fetch_article_chunks', 'name': "fetch_article_chunks_for_rag",
+                     'arguments': json.dumps({'articles': decision.titles})}
+    else:
+        # Text deltas go straight to the caller, tool call deltas are assembled as they arrive
+        tool_calls = {}
+        first_start = time.perf_counter()
+        first_response = await get_async_openai_client().chat.completions.create(
+            model=openai_model,
+            messages=message_chain,
+            tools=tools or get_tools(),
+            stream=True,
+            **STREAM_USAGE_OPTIONS
+        )
+        first_chunk = True
+        async for chunk in first_response:
+            if first_chunk:
+                METRICS.observe('first_completion_ttft', elapsed_ms(first_start), model=openai_model)
+                first_chunk = False
+            if chunk.usage:
+                METRICS.record_usage(chunk.usage, openai_model, 'first')
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            if delta.content:
+                if first_token_at is None:
+                    first_token_at = elapsed_ms(request_start)
+                answer_parts.append(delta.content)
+                yield delta.content
+            for tool_call_delta in delta.tool_calls or []:
+                tool_call = tool_calls.setdefault(tool_call_delta.index, {'id': None, 'name': '', 'arguments': ''})
+                if tool_call_delta.id:
+                    tool_call['id'] = tool_call_delta.id
+                if tool_call_delta.function and tool_call_delta.function.name:
+                    tool_call['name'] += tool_call_delta.function.name
+                if tool_call_delta.function and tool_call_delta.function.arguments:
+                    tool_call['arguments'] += tool_call_delta.function.arguments
+        tool_call = tool_calls.get(min(tool_calls)) if tool_calls else None
+        METRICS.observe('first_completion', elapsed_ms(first_start), model=openai_model,
+                        tool_call=tool_call['name'] if tool_call else None)
+
+    if tool_call and tool_call['name'] == "fetch_article_chunks_for_rag":
+        if speculative_chunks is not None:
+            with METRICS.span('retrieval_wait'):
+                article_chunks = await speculative_chunks
+        else:
+            article_chunks = await run_in_executor(loop, fetch_article_chunks_from_query_search, query_text)
+        combined_content = build_tool_content(tool_call['arguments'], article_chunks, openai_model)
+
+        message_chain.append(
+            {
+                "role": "assistant",
+                "content": ''.join(answer_parts) or None,
+                "tool_calls": [
+                    {
+                        "id": tool_call['id'],
+                        "type": "function",
+                        "function": {"name": tool_call['name'], "arguments": tool_call['arguments']},
+                    }
+                ],
+            }
+        )
+        message_chain.append(
+            {
+                "tool_call_id": tool_call['id'],
+                "role": "tool",
+                "name": "fetch_article_chunks_for_rag",
+                "content": combined_content,
+            }
+        )
+        answer_parts = []
+        second_start = time.perf_counter()
+        second_response = await get_async_openai_client().chat.completions.create(
+            model=openai_model,
+            messages=message_chain,
+            stream=True,
+            **STREAM_USAGE_OPTIONS
+        )
+        first_chunk = True
+        async for chunk in second_response:
+            if first_chunk:
+                METRICS.observe('second_completion_ttft', elapsed_ms(second_start), model=openai_model)
+                first_chunk = False
+            if chunk.usage:
+                METRICS.record_usage(chunk.usage, openai_model, 'second')
+            if chunk.choices and chunk.choices[0].delta.content:
+                if first_token_at is None:
+                    first_token_at = elapsed_ms(request_start)
+                answer_parts.append(chunk.choices[0].delta.content)
+                yield chunk.choices[0].delta.content
+        METRICS.observe('second_completion', elapsed_ms(second_start), model=openai_model)
+
+    if first_token_at is not None:
+        METRICS.observe('ttft', first_token_at, model=openai_model)
+    METRICS.observe('request_total', elapsed_ms(request_start), model=openai_model, answer_cache_hit=False,
+                    routed=routed_retrieval)
+
+    if use_answer_cache:
+        answer_cache.set(query_embedding, openai_model, version, ''.join(answer_parts))
+
+
+_event_loop = None
+_event_loop_lock = threading.Lock()
+
+
+def get_event_loop():
+    """Returns the background event loop the async pipeline runs on, starting it on first use"""
+    global _event_loop
+    with _event_loop_lock:
+        if _event_loop is None:
+            _event_loop = asyncio.new_event_loop()
+            threading.Thread(target=_event_loop.run_forever, name='chat-event-loop', daemon=True).start()
+    return _event_loop
+
+
+def stream_chat_completion_with_rag(query_text, message_chain, openai_model):
+    """Runs astream_chat_completion_with_rag on the background event loop and yields its text deltas,
+    so it can be passed straight to st.write_stream"""
+    loop = get_event_loop()
+    stream = astream_chat_completion_with_rag(query_text, message_chain, openai_model)
+    # Each step runs as its own task, scheduling them from one context keeps the request id across steps
+    context = contextvars.copy_context()
+    context.run(METRICS.start_request)
+    try:
+        while True:
+            try:
+                yield context.run(asyncio.run_coroutine_threadsafe, stream.__anext__(), loop).result()
+            except StopAsyncIteration:
+                break
+    finally:
+        context.run(asyncio.run_coroutine_threadsafe, stream.aclose(), loop).result()
+
+
+_warm_up = None
+
+
+def warm_up(queries=()):
+    """Loads the embedding model, opens the vector store and builds the prompts, then runs the given
+    queries through retrieval so their results are cached"""
+    try:
+        with METRICS.span('warm_up'):
+            get_openai_client()
+            get_async_openai_client()
+            get_event_loop()
+            get_system_message()
+            get_tools()
+            get_bm25_index()
+            vector_query_articles('Wolf Street', 1)
+            for query_text in queries:
+                query_articles(query_text)
+            if ARTICLE_WINDOW_ENABLED:
+                title_index.matrix()
+            if ROUTER_ENABLED:
+                article_index.matrix()
+    except Exception as e:
+        print(f"Warm-up failed: {e}")
+
+
+def start_warm_up(queries=()):
+    """Runs warm_up on a background thread, once per process, and returns its future"""
+    global _warm_up
+    # Called on every Streamlit rerun, so once started it returns without taking the lock
+    if _warm_up is not None:
+        return _warm_up
+    with _resource_lock:
+        if _warm_up is None:
+            executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='warm-up')
+            _warm_up = executor.submit(warm_up, list(queries))
+            executor.shutdown(wait=False)
+    return _warm_up
+
+
 if __name__ == '__main__':
     test_messages = [
-        {'role': 'system', 'content': SYSTEM_MESSAGE}
+        {'role': 'system', 'content': get_system_message()}
     ]
 
     print(create_chat_completion_with_rag("Who is Wolf Richter?", test_messages, 'gpt-4o-mini'))
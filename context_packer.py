@@ -0,0 +1,93 @@
+import re
+from functools import lru_cache
+
+try:
+    import tiktoken
+except ImportError:  # pragma: no cover - tiktoken is a declared dependency
+    tiktoken = None
+
+WORD_PATTERN = re.compile(r"\w+")
+
+
+@lru_cache(maxsize=None)
+def _encoding_for_model(model):
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        # The BPE files are downloaded on first use, fall back to an estimate when that is not possible
+        return None
+
+
+def count_tokens(text, model="gpt-4o"):
+    """Returns the number of tokens text takes up for a model, or a 4 characters per token estimate"""
+    encoding = _encoding_for_model(model)
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def _word_set(text):
+    return frozenset(WORD_PATTERN.findall(text.lower()))
+
+
+def _similarity(words_a, words_b):
+    if not words_a or not words_b:
+        return 0.0
+    return len(words_a & words_b) / len(words_a | words_b)
+
+
+def pack_context(
+    candidates,
+    token_budget,
+    model="gpt-4o",
+    diversity=0.3,
+    duplicate_threshold=0.8,
+):
+    """Selects candidates by maximal marginal relevance until the token budget is filled.
+
+    Each candidate is a dict with "text" and "relevance" (higher is better), and optionally a
+    "header" such as the article link, which is counted against the budget as well.
+    Near-duplicates of already selected text are dropped, and the result is in selection order.
+    """
+    remaining = []
+    for candidate in candidates:
+        words = _word_set(candidate["text"])
+        tokens = count_tokens(candidate["text"], model)
+        if candidate.get("header"):
+            tokens += count_tokens(candidate["header"], model)
+        remaining.append((candidate, words, tokens))
+
+    selected = []
+    used_tokens = 0
+    while remaining:
+        best = None
+        best_score = None
+        for i, (candidate, words, tokens) in enumerate(remaining):
+            max_similarity = max(
+                (
+                    _similarity(words, selected_words)
+                    for _, selected_words, _ in selected
+                ),
+                default=0.0,
+            )
+            if max_similarity >= duplicate_threshold:
+                continue
+            score = (1 - diversity) * candidate[
+                "relevance"
+            ] - diversity * max_similarity
+            if best_score is None or score > best_score:
+                best, best_score = i, score
+        if best is None:
+            break
+
+        candidate, words, tokens = remaining.pop(best)
+        if used_tokens + tokens > token_budget:
+            continue
+        selected.append((candidate, words, tokens))
+        used_tokens += tokens
+
+    return [candidate for candidate, _, _ in selected]
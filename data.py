@@ -1,24 +1,36 @@
-import time
 import chromadb
-import requests
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import os
 import dotenv
 import warnings
-import urllib.parse
 import feedparser
 import json
+from fetcher import ArticleFetcher, get_default_fetcher, title_from_response
+from bm25_index import BM25_INDEX_PATH, BM25Index
+from feed_index import FeedIndex
+from chart_index import ChartIndex
+from article_store import ArticleStore, publish_timestamp
+from vector_backends import active_collection_name
+from email.utils import parsedate_to_datetime
 from pprint import pprint
 import chromadb.utils.embedding_functions as embedding_functions
 from langchain_text_splitters import Language, RecursiveCharacterTextSplitter
 from summarize import summarize_article, analyze_image
 import re
+import sys
+import time
 
 warnings.filterwarnings("ignore")
 
 
 def get_articles_from_rss(rss_feed_url):
     """Returns a list of dictionaries of articles from a given RSS feed showing their url, title, and publish date"""
-    feed = feedparser.parse(rss_feed_url)
+    return articles_from_feed(feedparser.parse(rss_feed_url))
+
+
+def articles_from_feed(feed):
+    """Returns the url, title, and publish date of each entry in a parsed feed"""
     articles = []
     for entry in feed.entries:
         article_url = entry.id
@@ -39,17 +51,7 @@ def get_articles_from_rss(rss_feed_url):
 
 def fetch_latest_rss_as_json(rss_feed_url, json_file_name=None):
     """Fetches the latest RSS feed as a JSON file and optionally saves it"""
-    list_of_articles = get_articles_from_rss(rss_feed_url)
-    article_json = []
-    for article in list_of_articles:
-        article_json.append(
-            {
-                "title": article["title"],
-                "public_url": article["public_url"],
-                "publish_date": article["date"],
-                "file_location": f'./data/{article["title"]}.md',
-            }
-        )
+    article_json = article_records(get_articles_from_rss(rss_feed_url))
     if json_file_name:
         with open(json_file_name, "w") as file:
             json.dump(article_json, file)
@@ -57,89 +59,169 @@ def fetch_latest_rss_as_json(rss_feed_url, json_file_name=None):
     return article_json
 
 
+def article_records(list_of_articles):
+    """Converts articles from the RSS feed into article records"""
+    return [
+        {
+            "title": article["title"],
+            "public_url": article["public_url"],
+            "publish_date": article["date"],
+            "file_location": f'./data/{article["title"]}.md',
+        }
+        for article in list_of_articles
+    ]
+
+
+def fetch_rss_if_changed(rss_feed_url, feed_index):
+    """Fetches the feed with the ETag and Last-Modified validators from its previous poll.
+    Returns (article records, parsed feed), with None for the records if the feed has not changed.
+    """
+    etag, modified = feed_index.validators(rss_feed_url)
+    feed = feedparser.parse(rss_feed_url, etag=etag, modified=modified)
+    if feed.get("status") == 304:
+        return None, feed
+    return article_records(articles_from_feed(feed)), feed
+
+
+FEED_PAGE_WORKERS = 4
+FEED_PAGE_RETRIES = 3
+
+
+def fetch_feed_page(rss_feed_url, page, retries=FEED_PAGE_RETRIES, backoff=1.0):
+    """Fetches one page of a paged feed, retrying failed requests with backoff. Returns the parsed feed,
+    which has no entries past the last page, or None if the page could not be fetched."""
+    for attempt in range(retries + 1):
+        feed = feedparser.parse(feed_page_url(rss_feed_url, page))
+        status = feed.get("status")
+        # WordPress answers 404 past the last page. Without a status the request itself failed, and an
+        # unparseable page is a truncated or error response, not the end of the feed.
+        if status == 404:
+            return feed
+        complete = all(
+            "id" in entry and "title" in entry and "published" in entry for entry in feed.entries
+        )
+        if status is not None and status < 400 and complete and (feed.entries or not feed.get("bozo")):
+            return feed
+        reason = f"HTTP {status}" if status else feed.get("bozo_exception")
+        print(f"Feed page {page} failed: {reason or 'incomplete entries'}")
+        if attempt < retries:
+            time.sleep(backoff * 2**attempt)
+    return None
+
+
+def feed_page_url(rss_feed_url, page):
+    separator = "&" if "?" in rss_feed_url else "?"
+    return f"{rss_feed_url}{separator}paged={page}"
+
+
+def fetch_feed_pages(rss_feed_url, max_pages=None, max_workers=FEED_PAGE_WORKERS):
+    """Fetches the pages of a paged WordPress feed concurrently, max_workers pages at a time, until the end
+    of the feed or max_pages is reached. Returns (article records in feed order, page numbers that failed).
+    """
+    article_json = []
+    failed_pages = []
+    seen_urls = set()
+    page = 1
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while max_pages is None or page <= max_pages:
+            last_page = page + max_workers - 1
+            if max_pages is not None:
+                last_page = min(last_page, max_pages)
+            pages = list(range(page, last_page + 1))
+            feeds = list(executor.map(lambda n: fetch_feed_page(rss_feed_url, n), pages))
+            for number, feed in zip(pages, feeds):
+                if feed is None:
+                    failed_pages.append(number)
+                    continue
+                if not feed.entries:
+                    return article_json, failed_pages
+                for article in article_records(articles_from_feed(feed)):
+                    if article["public_url"] not in seen_urls:
+                        seen_urls.add(article["public_url"])
+                        article_json.append(article)
+            print(f"Fetched feed pages {pages[0]}-{pages[-1]}")
+            if all(feed is None for feed in feeds):
+                # The feed is down, not just one page
+                break
+            page = last_page + 1
+    return article_json, failed_pages
+
+
 def get_article_as_markdown(
-    article_url, access_token, article_title=None, save_path=None
+    article_url, access_token, article_title=None, save_path=None, fetcher=None
 ):
     """Converts a given article url to markdown and save it to the ./data folder"""
     """
     TODO: urltomarkdown is nice but it does not parse comments. This is ultimately because it's using Mozilla's readability library, which 
     emulates Firefox Reader view, which does not include the comment section. If I'm going to implement the comment sentiment stuff, 
     """
-    encoded_url = urllib.parse.quote(article_url + f"?access_token={access_token}")
-    response = requests.get(
-        f"https://urltomarkdown.herokuapp.com/?url={encoded_url}&title=true"
-    )
-    if response.status_code == 200:
+    response = (fetcher or get_default_fetcher()).fetch(article_url, access_token)
+    if response is None:
+        return
 
-        pprint(article_title)
-        if article_title == "An Interview with Arm CEO Rene Haas":
-            pprint(encoded_url)
-            pprint(response.text[:200] + "...")
+    pprint(article_title)
+    article_markdown = response.text
 
-        article_markdown = response.text
+    if article_title is None:
+        article_title = title_from_response(response)
 
-        if article_title is None:
-            article_title = (
-                urllib.parse.unquote(response.headers["X-Title"]).split("–")[0].strip()
-            )
+    if save_path:
+        with open(f"{save_path}/{article_title}.md", "w") as f:
+            f.write(article_markdown)
 
-        if save_path:
-            with open(f"{save_path}/{article_title}.md", "w") as f:
-                f.write(article_markdown)
+    return article_markdown
 
-        return article_markdown
-    else:
-        print(f"Error: {response.status_code}")
-        return
 
+IMAGE_LINK_PATTERN = re.compile(
+    r"!\[[^\]]*\]\(([^)\s]+?\.(?:png|jpe?g|gif|webp))\)", re.IGNORECASE
+)
 
-def extract_image_url(text):
-    image_link_pattern = r"![^.]+\((.*(jpg|png))\)"
-    match = re.search(image_link_pattern, text)
-    if match:
-        return match.group(1)
-    else:
-        return None
+
+def extract_image_urls(text):
+    """Returns the distinct image urls embedded in markdown, in order of appearance"""
+    return list(dict.fromkeys(IMAGE_LINK_PATTERN.findall(text)))
 
 
 def enrich_image_url(image_url, image_text, page_content):
-    # Find the Markdown link with the matching image URL
-    link_pattern = rf"\[.*?\]\({re.escape(image_url)}\)"
-    match = re.search(link_pattern, page_content)
-
-    if match:
-        # Find the end position of the matched link
-        link_end_pos = match.end()
-
-        # Insert the image_text on a new line after the matched link
-        updated_content = (
-            page_content[:link_end_pos]
-            + f"\n{image_text}"
-            + page_content[link_end_pos:]
-        )
-        return updated_content
-    else:
-        # Return the original page content if no match is found
+    """Inserts the text extracted from an image on a new line after the line that links to it"""
+    # Charts are usually wrapped in a link to the full size image, so the whole line is kept intact
+    link_pos = page_content.find(f"]({image_url})")
+    if link_pos == -1:
         return page_content
+    line_end = page_content.find("\n", link_pos)
+    if line_end == -1:
+        line_end = len(page_content)
+    return page_content[:line_end] + f"\n{image_text}" + page_content[line_end:]
 
 
-def split_article_into_chunks(article_content, article_title, chunk_size=1000):
-    """Splits the given markdown article into digestible chunks and returns them as a list"""
+def split_article_into_chunks(
+    article_content, article_title, chunk_size=1000, chart_tables=None
+):
+    """Splits the given markdown article into digestible chunks and returns them as a list.
+    Charts with a table in chart_tables, by image url, get the table inserted after their image."""
     markdown_splitter = RecursiveCharacterTextSplitter.from_language(
         language=Language.MARKDOWN, chunk_size=chunk_size, chunk_overlap=0
     )
     chunks = markdown_splitter.create_documents([article_content])
     # chunks_with_ids = [{'chunk_id': f"{i}_{article_title}", 'page_content': chunk.page_content} for i, chunk in enumerate(chunks)]
     chunks_with_ids = []
-    for i, chunk in enumerate(chunks):
-        chunk_id = f"{i}_{article_title}"
-        # image_url = extract_image_url(chunk.page_content)
-        # if not image_url is None:
-        #     image_text = analyze_image(image_url)
-        #     chunk.page_content = enrich_image_url(
-        #         image_url, image_text, chunk.page_content
-        #     )
-        chunk_data = {"chunk_id": chunk_id, "page_content": chunk.page_content}
+    id_counts = {}
+    for chunk in chunks:
+        page_content = chunk.page_content
+        for image_url in extract_image_urls(page_content):
+            if chart_tables and image_url in chart_tables:
+                page_content = enrich_image_url(
+                    image_url, chart_tables[image_url], page_content
+                )
+        # Chunk ids follow the content rather than the position, so an edit or a newly extracted chart
+        # only changes the ids of the chunks it touched. Repeated text within an article gets a numbered suffix.
+        # The NUL terminator keeps the ids of chunks that are already stored
+        content_digest = hashlib.sha256(page_content.encode("utf-8") + b"\0").hexdigest()
+        chunk_id = f"{content_digest[:16]}_{article_title}"
+        id_counts[chunk_id] = id_counts.get(chunk_id, 0) + 1
+        if id_counts[chunk_id] > 1:
+            chunk_id = f"{chunk_id}_{id_counts[chunk_id]}"
+        chunk_data = {"chunk_id": chunk_id, "page_content": page_content}
         chunks_with_ids.append(chunk_data)
 
     return chunks_with_ids
@@ -160,127 +242,482 @@ def embed_and_save_in_chroma(
     )
 
 
-def chunk_and_embed_one_article_from_json(json_file_name, article_title):
-    """Chunks and embeds the article in the given JSON file to Chroma"""
-    with open(json_file_name, "r") as file:
-        articles = json.load(file)
+EMBED_BATCH_SIZE = 256
+# Each ONNX run already spreads over every core, a second batch in flight only overlaps tokenization and
+# the Chroma upserts. More threads than that oversubscribe the CPU.
+EMBED_WORKERS = int(os.getenv("EMBED_WORKERS", 2))
+
 
-    article = next(
-        (article for article in articles if article["title"] == article_title), None
+def article_chunk_records(article, markdown_content, chart_index=None):
+    """Splits an article into chunks and returns them as records ready for batched embedding.
+    Charts already analyzed in chart_index are added to their chunks."""
+    chart_tables = None
+    if chart_index is not None:
+        chart_tables = chart_index.tables_for(extract_image_urls(markdown_content))
+    chunks = split_article_into_chunks(
+        markdown_content, article["title"], chart_tables=chart_tables
     )
+    return [
+        {
+            "chunk_id": chunk["chunk_id"],
+            "page_content": chunk["page_content"],
+            "url": article["public_url"],
+            "title": article["title"],
+            "date": article["publish_date"],
+            "timestamp": int(publish_timestamp(article)),
+        }
+        for chunk in chunks
+    ]
+
+
+def chunk_metadata(record):
+    # The numeric timestamp makes chunks filterable by publish date, the RFC 822 date string is not
+    return {
+        "url": record["url"],
+        "title": record["title"],
+        "date": record["date"],
+        "timestamp": record["timestamp"],
+    }
+
+
+def diff_chunk_records(chunk_records, page_size=EMBED_BATCH_SIZE):
+    """Compares chunk records with the chunks Chroma already holds for the same articles.
+    Returns (records to embed, records whose metadata changed, ids of orphaned chunks to delete).
+    """
+    urls = list(dict.fromkeys(record["url"] for record in chunk_records))
+    existing = {}
+    for i in range(0, len(urls), page_size):
+        stored = CHROMA_COLLECTION.get(
+            where={"url": {"$in": urls[i : i + page_size]}}, include=["metadatas"]
+        )
+        existing.update(zip(stored["ids"], stored["metadatas"]))
+
+    to_embed, metadata_changed = [], []
+    for record in chunk_records:
+        stored_metadata = existing.get(record["chunk_id"])
+        if stored_metadata is None:
+            to_embed.append(record)
+        elif stored_metadata != chunk_metadata(record):
+            metadata_changed.append(record)
+    record_ids = {record["chunk_id"] for record in chunk_records}
+    orphaned_ids = [chunk_id for chunk_id in existing if chunk_id not in record_ids]
+    return to_embed, metadata_changed, orphaned_ids
+
+
+def embed_and_save_chunks_in_chroma(
+    chunk_records, batch_size=EMBED_BATCH_SIZE, max_workers=None, diff=True
+):
+    """Embeds chunk records in parallel batches and bulk upserts them to Chroma, returning the number embedded.
 
-    with open(article["file_location"], "r") as file:
-        markdown_content = file.read()
-    chunks = split_article_into_chunks(markdown_content, article["title"])
-    for chunk in chunks:
+    With diff, chunk_records are taken as the complete set of chunks for their articles: only chunks Chroma
+    does not have yet are embedded, and chunks of those articles that are no longer produced are deleted.
+    """
+    batch_size = min(batch_size, CHROMA_CLIENT.max_batch_size)
+    orphaned_ids = []
+    if diff:
+        chunk_records, metadata_changed, orphaned_ids = diff_chunk_records(
+            chunk_records
+        )
+        for i in range(0, len(metadata_changed), batch_size):
+            batch = metadata_changed[i : i + batch_size]
+            CHROMA_COLLECTION.update(
+                ids=[record["chunk_id"] for record in batch],
+                metadatas=[chunk_metadata(record) for record in batch],
+            )
+        for i in range(0, len(orphaned_ids), batch_size):
+            CHROMA_COLLECTION.delete(ids=orphaned_ids[i : i + batch_size])
         print(
-            f"({chunk['chunk_id'].split('_')[0]}/{len(chunks) - 1}) {article['title']} - {chunk['page_content'][:50]}..."
+            f"{len(chunk_records)} chunks to embed, {len(metadata_changed)} metadata updates, "
+            f"{len(orphaned_ids)} orphaned chunks deleted"
+        )
+
+    batches = [
+        chunk_records[i : i + batch_size]
+        for i in range(0, len(chunk_records), batch_size)
+    ]
+    if not batches and not orphaned_ids:
+        return 0
+
+    def embed_batch(batch):
+        return EMBEDDING_FUNCTION([record["page_content"] for record in batch])
+
+    # Loads (and on a fresh machine downloads) the model once, before several threads could race to do it
+    EMBEDDING_FUNCTION(["warm up"])
+    saved = 0
+    with ThreadPoolExecutor(max_workers=max_workers or EMBED_WORKERS) as executor:
+        for batch, embeddings in zip(batches, executor.map(embed_batch, batches)):
+            CHROMA_COLLECTION.upsert(
+                ids=[record["chunk_id"] for record in batch],
+                embeddings=embeddings,
+                documents=[record["page_content"] for record in batch],
+                metadatas=[chunk_metadata(record) for record in batch],
+            )
+            saved += len(batch)
+            print(f"Embedded {saved}/{len(chunk_records)} chunks")
+
+    # Keep the lexical index in step with the collection for hybrid retrieval. An index built from just
+    # these chunks would boost new articles over every older one, so a missing or drifted index is
+    # rebuilt from the whole collection instead
+    if os.path.exists(BM25_INDEX_PATH):
+        bm25_index = BM25Index.load(BM25_INDEX_PATH)
+        bm25_index.remove(orphaned_ids)
+        bm25_index.upsert(
+            [record["chunk_id"] for record in chunk_records],
+            [record["page_content"] for record in chunk_records],
+        )
+        if len(bm25_index) == CHROMA_COLLECTION.count():
+            bm25_index.save(BM25_INDEX_PATH)
+            return saved
+        print(f"BM25 index holds {len(bm25_index)} chunks, the collection {CHROMA_COLLECTION.count()}")
+    print("Building the BM25 index from the collection")
+    build_bm25_index_from_chroma()
+
+    return saved
+
+
+def build_bm25_index_from_chroma(page_size=EMBED_BATCH_SIZE * 4):
+    """Rebuilds the BM25 index from every chunk in the Chroma collection"""
+    bm25_index = BM25Index()
+    offset = 0
+    while True:
+        page = CHROMA_COLLECTION.get(
+            include=["documents"], limit=page_size, offset=offset
         )
-        embed_and_save_in_chroma(
-            chunk["chunk_id"],
-            chunk["page_content"],
-            article["public_url"],
-            article["title"],
-            article["publish_date"],
+        if not page["ids"]:
+            break
+        bm25_index.upsert(page["ids"], page["documents"])
+        offset += len(page["ids"])
+        print(f"Indexed {offset} chunks")
+    bm25_index.save()
+    return bm25_index
+
+
+def add_chunk_timestamps(page_size=EMBED_BATCH_SIZE * 4):
+    """Adds the numeric publish timestamp to chunks stored before it was part of their metadata.
+    Only metadata is updated, nothing is re-embedded. Returns the number of chunks updated."""
+    updated = offset = 0
+    while True:
+        page = CHROMA_COLLECTION.get(
+            include=["metadatas"], limit=page_size, offset=offset
         )
+        if not page["ids"]:
+            break
+        stale = [
+            (chunk_id, metadata)
+            for chunk_id, metadata in zip(page["ids"], page["metadatas"])
+            if "timestamp" not in metadata
+        ]
+        if stale:
+            CHROMA_COLLECTION.update(
+                ids=[chunk_id for chunk_id, _ in stale],
+                metadatas=[
+                    {
+                        **metadata,
+                        "timestamp": int(parsedate_to_datetime(metadata["date"]).timestamp()),
+                    }
+                    for _, metadata in stale
+                ],
+            )
+        updated += len(stale)
+        offset += len(page["ids"])
+        print(f"Checked {offset} chunks, {updated} timestamps added")
+    return updated
+
+
+def chunk_and_embed_one_article(article_title, store=None):
+    """Chunks and embeds the stored article with the given title to Chroma"""
+    store = ArticleStore() if store is None else store
+    article = store.get(article_title)
+
+    with open(article["file_location"], "r") as file:
+        markdown_content = file.read()
+    embed_and_save_chunks_in_chroma(
+        article_chunk_records(article, markdown_content, ChartIndex.load_or_create())
+    )
     print("Done!")
 
 
-def chunk_and_embed_articles_from_json(file_name):
-    """Chunks and embeds the articles in the given JSON file to Chroma"""
-    with open(file_name, "r") as file:
-        articles = json.load(file)
+def chunk_and_embed_articles(store=None):
+    """Chunks and embeds every stored article to Chroma"""
+    store = ArticleStore() if store is None else store
+    chart_index = ChartIndex.load_or_create()
+    total = len(store)
 
-    for article in articles:
-        print(f"ARTICLE {articles.index(article)}/{len(articles)} - {article['title']}")
+    # Collect chunks across all articles first so they can be embedded in large batches
+    chunk_records = []
+    for i, article in enumerate(store):
+        print(f"ARTICLE {i}/{total} - {article['title']}")
         with open(article["file_location"], "r") as file:
             markdown_content = file.read()
-        chunks = split_article_into_chunks(markdown_content, article["title"])
-        for chunk in chunks:
-            print(
-                f"({chunk['chunk_id'].split('_')[0]}/{len(chunks) - 1}) {article['title']} - {chunk['page_content'][:50]}..."
-            )
-            embed_and_save_in_chroma(
-                chunk["chunk_id"],
-                chunk["page_content"],
-                article["public_url"],
-                article["title"],
-                article["publish_date"],
-            )
+        chunk_records.extend(
+            article_chunk_records(article, markdown_content, chart_index)
+        )
+
+    embed_and_save_chunks_in_chroma(chunk_records)
     print("Done!")
 
 
-def summarize_articles_in_json(json_file_name):
-    with open(json_file_name, "r") as file:
-        articles = json.load(file)
+SUMMARIZE_ARTICLE_WORKERS = 3
 
-    for i, article in enumerate(articles):
-        print(f"({i+1}/{len(articles)}) - SUMMARIZING {article['title']}")
-        markdown_content = get_article_as_markdown(
-            article["public_url"], None, article["title"]
-        )
-        summary = summarize_article(article["title"], markdown_content)
-        article["summary"] = summary
-        if i % 10 == 0 and i != 0:
-            print("Sleeping for 60 seconds to avoid rate limiting...")
-            time.sleep(60)
-
-    with open(json_file_name, "w") as file:
-        json.dump(articles, file, indent=4)
-    return articles
+
+def fetch_and_summarize_articles(articles, fetcher=None, max_workers=None):
+    """Fetches and summarizes articles concurrently, yielding (article, markdown) pairs once each summary is set.
+    Markdown already on disk is reused, and fetched markdown is saved for the chart stage and rebuilds."""
+    with ThreadPoolExecutor(
+        max_workers=max_workers or SUMMARIZE_ARTICLE_WORKERS
+    ) as executor:
+        # Articles are handed to the summarizers as soon as the fetcher streams them out
+        futures = {}
+        for article, markdown_content in read_or_fetch_markdown(articles, fetcher):
+            print(f"SUMMARIZING {article['title']}")
+            future = executor.submit(
+                summarize_article, article["title"], markdown_content
+            )
+            futures[future] = (article, markdown_content)
+
+        for future in as_completed(futures):
+            article, markdown_content = futures[future]
+            article["summary"] = future.result()
+            # Lets extract_charts find the article's charts without reading every markdown file
+            article["image_urls"] = extract_image_urls(markdown_content)
+            yield article, markdown_content
 
 
-def check_for_latest_articles(rss_feed_url, json_file_name, embed=True):
-    """Returns a list of new articles that do not exist in the ChromaDB"""
-    # Retrieve existing article titles from ChromaDB
-    all_metadatas = CHROMA_COLLECTION.get(include=["metadatas"]).get("metadatas")
-    existing_articles = set([x["title"] for x in all_metadatas])
+def summarize_articles_in_store(store=None, fetcher=None):
+    """Summarizes every stored article again, appending each record to the store as soon as its summary is set"""
+    store = ArticleStore() if store is None else store
+    articles = list(store)
 
-    # Fetch the latest RSS feed
-    article_json = fetch_latest_rss_as_json(rss_feed_url)
-    new_articles = []
+    for i, (article, _) in enumerate(fetch_and_summarize_articles(articles, fetcher)):
+        store.append([article])
+        print(f"({i+1}/{len(articles)}) - SUMMARIZED {article['title']}")
 
-    # Go through each article in the latest RSS pull and check if their title exists in the ChromaDB
-    for article in article_json:
-        if article["title"] not in existing_articles:
-            print(f"NEW ARTICLE: {article['title']}")
+    # Every summarized article left an outdated line behind
+    store.maybe_compact()
+    return articles
 
-            markdown_content = get_article_as_markdown(
-                article["public_url"], None, article["title"]
+
+def ingest_articles(articles, store, embed=True):
+    """Fetches, summarizes and embeds articles and appends the ones that succeeded to the article store.
+    Returns those articles in the order given."""
+    # Only charts analyzed before are added here, new ones are left to extract_charts
+    chart_index = ChartIndex.load_or_create()
+    chunk_records = []
+    fetched_titles = set()
+    for article, markdown_content in fetch_and_summarize_articles(articles):
+        print(f"NEW ARTICLE: {article['title']}")
+        if embed:
+            chunk_records.extend(
+                article_chunk_records(article, markdown_content, chart_index)
             )
+        fetched_titles.add(article["title"])
+
+    new_articles = [
+        article for article in articles if article["title"] in fetched_titles
+    ]
+    if not new_articles:
+        return new_articles
+
+    if chunk_records:
+        embed_and_save_chunks_in_chroma(chunk_records)
 
-            summary = summarize_article(article["title"], markdown_content)
-            article["summary"] = summary
-
-            if embed:
-                chunks = split_article_into_chunks(markdown_content, article["title"])
-                for chunk in chunks:
-                    print(
-                        f"({chunk['chunk_id'].split('_')[0]}/{len(chunks) - 1}) {article['title']} - {chunk['page_content'][:50]}..."
-                    )
-                    embed_and_save_in_chroma(
-                        chunk["chunk_id"],
-                        chunk["page_content"],
-                        article["public_url"],
-                        article["title"],
-                        article["publish_date"],
-                    )
-            new_articles.append(article)
-
-    # Read existing data from the file
-    with open(json_file_name, "r") as file:
-        all_articles = json.load(file)
-
-    # Append new articles at the beginning of the list
-    all_articles[:0] = new_articles
-
-    # Write all the articles back to the json file
-    with open(json_file_name, "w") as file:
-        json.dump(all_articles, file, indent=4)
+    # Oldest first, so polling keeps the log in publish order
+    store.append(sorted(new_articles, key=publish_timestamp))
 
     return new_articles
 
 
+def check_for_latest_articles(rss_feed_url, store=None, embed=True, feed_index=None):
+    """Ingests the articles in the RSS feed that have not been seen before and returns them.
+    The feed is fetched conditionally, so a poll with nothing new costs one 304 response.
+    """
+    store = ArticleStore.load_or_create() if store is None else store
+    feed_index = feed_index or FeedIndex.load_or_create()
+    article_json, feed = fetch_rss_if_changed(rss_feed_url, feed_index)
+    if article_json is None:
+        print("Feed not modified since the last poll")
+        return []
+
+    unseen_articles = store.unstored(article_json)
+    new_articles = ingest_articles(unseen_articles, store, embed)
+
+    # Articles that failed to fetch are retried on the next poll, which needs the full feed again
+    if len(new_articles) == len(unseen_articles):
+        feed_index.set_validators(rss_feed_url, feed.get("etag"), feed.get("modified"))
+    else:
+        feed_index.clear_validators(rss_feed_url)
+    feed_index.save()
+    return new_articles
+
+
+def backfill_articles(rss_feed_url, store=None, max_pages=None, embed=True):
+    """Ingests unseen articles from every page of a paged WordPress feed and returns them.
+    The store indexes articles by publish date, so older articles can be appended in any order.
+    Raises RuntimeError after ingesting what it could if any feed page failed to fetch."""
+    store = ArticleStore.load_or_create() if store is None else store
+    article_json, failed_pages = fetch_feed_pages(rss_feed_url, max_pages)
+    unseen_articles = store.unstored(article_json)
+    print(f"Backfilling {len(unseen_articles)} of {len(article_json)} articles")
+    new_articles = ingest_articles(unseen_articles, store, embed)
+    if failed_pages:
+        raise RuntimeError(
+            f"Backfilled {len(new_articles)} articles, but feed pages {failed_pages} could not be "
+            "fetched. Run the backfill again to retry them."
+        )
+    return new_articles
+
+
+CHART_WORKERS = int(os.getenv("CHART_WORKERS", 4))
+# Caps the vision calls of one extract_charts run, a full-store run works through the rest on later runs
+CHART_MAX_IMAGES = int(os.getenv("CHART_MAX_IMAGES", 100))
+IMAGE_REQUESTS_PER_MINUTE = int(os.getenv("IMAGE_REQUESTS_PER_MINUTE", 120))
+
+
+def save_markdown(article, markdown_content):
+    """Keeps fetched markdown at the article's file_location, so later stages don't fetch it again"""
+    path = article["file_location"]
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as file:
+        file.write(markdown_content)
+    os.replace(tmp_path, path)
+
+
+def read_or_fetch_markdown(articles, fetcher=None):
+    """Yields (article, markdown) pairs, reading the local markdown file where there is one and fetching
+    and saving it otherwise. Articles that fail to fetch are skipped."""
+    to_fetch = []
+    for article in articles:
+        if os.path.exists(article["file_location"]):
+            with open(article["file_location"], "r") as file:
+                yield article, file.read()
+        else:
+            to_fetch.append(article)
+    if to_fetch:
+        fetcher = fetcher or get_default_fetcher()
+        for article, markdown_content in fetcher.fetch_all(to_fetch):
+            if markdown_content is not None:
+                save_markdown(article, markdown_content)
+                yield article, markdown_content
+
+
+def record_image_urls(store, fetcher=None, articles=None):
+    """Adds the image urls to the stored articles (or the given ones) ingested before they were recorded,
+    reading each article's markdown once. Returns the number of articles updated."""
+    articles = [
+        article for article in (store if articles is None else articles) if "image_urls" not in article
+    ]
+    if not articles:
+        return 0
+    print(f"Recording the image urls of {len(articles)} articles")
+    updated = [
+        dict(article, image_urls=extract_image_urls(markdown_content))
+        for article, markdown_content in read_or_fetch_markdown(articles, fetcher)
+    ]
+    store.append(updated)
+    store.maybe_compact()
+    return len(updated)
+
+
+def extract_chart(image_url, chart_index, fetcher):
+    """Downloads an image and extracts its chart as a table, reusing the cached download and table.
+    Returns whether the url has a chart table afterwards."""
+    cached = chart_index.read_image(image_url)
+    if cached is None:
+        response = fetcher.get(image_url)
+        if response is None:
+            return False
+        content_type = response.headers.get("Content-Type", "image/png").split(";")[0]
+        chart_index.add_image(image_url, response.content, content_type)
+        cached = response.content, content_type
+    if chart_index.table(image_url) is None:
+        table = analyze_image(image_url, *cached)
+        if table is None:
+            return False
+        # Images that are not charts are recorded as "" so they are not analyzed again
+        chart_index.set_table(chart_index.image_hash(image_url), table)
+    return bool(chart_index.table(image_url))
+
+
+def extract_charts(
+    store=None,
+    chart_index=None,
+    fetcher=None,
+    max_workers=None,
+    embed=True,
+    text_fetcher=None,
+    titles=None,
+    max_images=CHART_MAX_IMAGES,
+):
+    """Extracts the charts of the stored articles with the given titles, or of every stored article, that
+    have not been analyzed yet, at most max_images of them, then re-chunks the articles that gained charts
+    so their chart tables are embedded. Runs apart from text ingestion, finding the charts from the image
+    urls recorded in the article store. Markdown that is not on disk is fetched again with text_fetcher.
+    Returns the number of chart tables extracted."""
+    store = ArticleStore() if store is None else store
+    chart_index = ChartIndex.load_or_create() if chart_index is None else chart_index
+    max_workers = max_workers or CHART_WORKERS
+    fetcher = fetcher or ArticleFetcher(
+        max_workers=max_workers,
+        requests_per_minute=IMAGE_REQUESTS_PER_MINUTE,
+        burst=max_workers,
+    )
+
+    if titles is None:
+        record_image_urls(store, text_fetcher)
+        articles = store
+    else:
+        record_image_urls(store, text_fetcher, filter(None, map(store.get, titles)))
+        # Read after recording, which may have updated them
+        articles = [store.get(title) for title in titles]
+    # The same chart is often linked from several articles, each url is handled once
+    urls_by_article = {
+        article["title"]: (article, article["image_urls"])
+        for article in articles
+        if article is not None and article.get("image_urls")
+    }
+    image_urls = list(
+        dict.fromkeys(url for _, urls in urls_by_article.values() for url in urls)
+    )
+    pending = [url for url in image_urls if chart_index.table(url) is None]
+    print(
+        f"{len(image_urls)} images in {len(urls_by_article)} articles, {len(pending)} to analyze"
+    )
+    if max_images is not None and len(pending) > max_images:
+        print(f"Analyzing the first {max_images}, the rest are left for later runs")
+        pending = pending[:max_images]
+
+    analyzed = set()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(extract_chart, url, chart_index, fetcher): url
+            for url in pending
+        }
+        for i, future in enumerate(as_completed(futures), 1):
+            if future.result():
+                analyzed.add(futures[future])
+            print(f"({i}/{len(pending)}) images, {len(analyzed)} charts")
+            # Saved as it goes so an interrupted run keeps the images it paid for
+            if i % 20 == 0:
+                chart_index.save()
+    chart_index.save()
+
+    if embed and analyzed:
+        enriched = [
+            article
+            for article, urls in urls_by_article.values()
+            if analyzed.intersection(urls)
+        ]
+        chunk_records = []
+        for article, markdown_content in read_or_fetch_markdown(enriched, text_fetcher):
+            chunk_records.extend(
+                article_chunk_records(article, markdown_content, chart_index)
+            )
+        # Enriched chunks get new ids, so only they are embedded and their plain versions deleted
+        embed_and_save_chunks_in_chroma(chunk_records)
+    return len(analyzed)
+
+
 if __name__ == "__main__":
     dotenv.load_dotenv()
     # TODO: try using Claude instead
@@ -289,11 +726,23 @@ if __name__ == "__main__":
     # STRATECHERY_ACCESS_TOKEN = os.getenv('STRATECHERY_ACCESS_TOKEN')
 
     CHROMA_CLIENT = chromadb.PersistentClient("./chroma.db")
+    EMBEDDING_FUNCTION = embedding_functions.DefaultEmbeddingFunction()
     CHROMA_COLLECTION = CHROMA_CLIENT.get_or_create_collection(
-        name="wolfstreet_articles",
-        embedding_function=embedding_functions.DefaultEmbeddingFunction(),
+        name=active_collection_name(),
+        embedding_function=EMBEDDING_FUNCTION,
     )
 
     # TODO: Retrieve comments from https://wolfstreet.com/comments/feed/, perform sentiment analysis and summarize common themes
     # also weight comments based on Wolf's response, if he responds with "RTGDFA" or "clickbait BS" to a comment, that comment should be regarded as lower quality.
-    check_for_latest_articles("https://wolfstreet.com/feed/", "data.json", embed=True)
+    if "--all-charts" in sys.argv:
+        # Every stored article, CHART_MAX_IMAGES images per run
+        extract_charts(embed=True)
+    elif "--timestamps" in sys.argv:
+        add_chunk_timestamps()
+    elif "--backfill" in sys.argv:
+        backfill_articles("https://wolfstreet.com/feed/", embed=True)
+    else:
+        new_articles = check_for_latest_articles("https://wolfstreet.com/feed/", embed=True)
+        # --charts also extracts the charts of the articles this run ingested
+        if "--charts" in sys.argv and new_articles:
+            extract_charts(embed=True, titles=[article["title"] for article in new_articles])
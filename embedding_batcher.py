@@ -0,0 +1,81 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from metrics import METRICS
+
+
+class EmbeddingBatcher:
+    """Collects query embedding requests from concurrent sessions into micro-batches for one model call.
+
+    A single background thread takes the first waiting request together with everything queued behind it.
+    Requests that arrive while a batch is being embedded are picked up by the next batch, so nobody waits
+    on a timer when the process is idle; only when the previous batch was shared does the worker hold a
+    batch open for up to max_wait_ms to let more requests join."""
+
+    def __init__(self, embed, max_batch_size=32, max_wait_ms=2.0):
+        self.embed_batch = embed
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._requests = queue.Queue()
+        self._worker = None
+        self._lock = threading.Lock()
+        self._last_batch_size = 0
+
+    def embed(self, text):
+        """Returns the embedding of one text, blocking until its batch has been embedded"""
+        return self.submit(text).result()
+
+    def submit(self, text):
+        """Queues a text for embedding and returns a future for its embedding"""
+        future = Future()
+        self._requests.put((text, future))
+        self._ensure_worker()
+        return future
+
+    def _ensure_worker(self):
+        if self._worker is not None:
+            return
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(
+                    target=self._run, name="embedding-batcher", daemon=True
+                )
+                self._worker.start()
+
+    def _next_batch(self):
+        batch = [self._requests.get()]
+        while len(batch) < self.max_batch_size:
+            try:
+                batch.append(self._requests.get_nowait())
+            except queue.Empty:
+                break
+        if self._last_batch_size > 1 and self.max_wait > 0:
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._requests.get(timeout=timeout))
+                except queue.Empty:
+                    break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            self._last_batch_size = len(batch)
+            # Identical texts, like a starter question clicked in several sessions, are embedded once
+            texts = list(dict.fromkeys(text for text, _ in batch))
+            try:
+                with METRICS.span("embedding_batch") as span:
+                    embeddings = dict(zip(texts, self.embed_batch(texts)))
+                    span.set(requests=len(batch), texts=len(texts))
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for text, future in batch:
+                future.set_result(embeddings[text])
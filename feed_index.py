@@ -0,0 +1,51 @@
+import json
+import os
+import threading
+
+FEED_INDEX_PATH = os.getenv("FEED_INDEX_PATH", "./feed_index.json")
+
+
+class FeedIndex:
+    """Persistent record of the ETag and Last-Modified validators each feed last answered with, so polls
+    can use conditional requests. Which articles were already ingested is looked up in the article store.
+    """
+
+    def __init__(self, path=FEED_INDEX_PATH):
+        self.path = path
+        self.feeds = {}
+        self._lock = threading.Lock()
+
+    def validators(self, feed_url):
+        """Returns the (etag, modified) pair last stored for a feed, either of which may be None"""
+        validators = self.feeds.get(feed_url, {})
+        return validators.get("etag"), validators.get("modified")
+
+    def set_validators(self, feed_url, etag, modified):
+        with self._lock:
+            self.feeds[feed_url] = {"etag": etag, "modified": modified}
+
+    def clear_validators(self, feed_url):
+        """Forgets a feed's validators so its next poll downloads the full feed"""
+        with self._lock:
+            self.feeds.pop(feed_url, None)
+
+    def save(self):
+        with self._lock:
+            data = {"feeds": self.feeds}
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(data, file, indent=1)
+        os.replace(tmp_path, self.path)
+
+    @classmethod
+    def load(cls, path=FEED_INDEX_PATH):
+        with open(path, "r") as file:
+            data = json.load(file)
+        index = cls(path)
+        # Files from before the article store kept seen urls and titles too, which are ignored
+        index.feeds = data["feeds"]
+        return index
+
+    @classmethod
+    def load_or_create(cls, path=FEED_INDEX_PATH):
+        return cls.load(path) if os.path.exists(path) else cls(path)
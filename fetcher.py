@@ -0,0 +1,107 @@
+import os
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from ratelimit import TokenBucket
+
+URLTOMARKDOWN_URL = os.getenv(
+    "URLTOMARKDOWN_URL", "https://urltomarkdown.herokuapp.com/"
+)
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class ArticleFetcher:
+    """Fetches articles as markdown from urltomarkdown over pooled, rate limited connections"""
+
+    def __init__(
+        self,
+        base_url=URLTOMARKDOWN_URL,
+        max_workers=4,
+        requests_per_minute=10,
+        burst=5,
+        max_retries=4,
+        backoff=2.0,
+        timeout=60,
+    ):
+        self.base_url = base_url
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        # urltomarkdown allows roughly 5 requests per 30 seconds per client
+        self.rate_limiter = TokenBucket.per_minute(requests_per_minute, burst)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def fetch(self, article_url, access_token=None):
+        """Returns the urltomarkdown response for an article url, retrying with backoff, or None on failure"""
+        if access_token:
+            article_url += f"?access_token={access_token}"
+        return self.get(self.base_url, {"url": article_url, "title": "true"}, article_url)
+
+    def get(self, url, params=None, label=None):
+        """GETs a url through the pool within the rate limit, retrying with backoff. Returns the response, or None on failure"""
+        label = label or url
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire()
+            retry_after = None
+            try:
+                response = self.session.get(url, params=params, timeout=self.timeout)
+                if response.status_code == 200:
+                    return response
+                if response.status_code not in RETRY_STATUS_CODES:
+                    print(f"Error: {response.status_code} for {label}")
+                    return None
+                print(f"Retryable error: {response.status_code} for {label}")
+                retry_after = response.headers.get("Retry-After")
+            except requests.RequestException as e:
+                print(f"Request failed for {label}: {e}")
+
+            if attempt < self.max_retries:
+                delay = self.backoff * 2**attempt
+                if retry_after and retry_after.isdigit():
+                    delay = max(delay, int(retry_after))
+                time.sleep(delay)
+
+        print(f"Giving up on {label} after {self.max_retries + 1} attempts")
+        return None
+
+    def fetch_markdown(self, article_url, access_token=None):
+        """Returns the markdown for an article url, or None on failure"""
+        response = self.fetch(article_url, access_token)
+        return response.text if response is not None else None
+
+    def fetch_all(self, articles, access_token=None):
+        """Fetches articles concurrently, yielding (article, markdown) pairs as each one finishes"""
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {
+                executor.submit(
+                    self.fetch_markdown, article["public_url"], access_token
+                ): article
+                for article in articles
+            }
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+
+
+_default_fetcher = None
+
+
+def get_default_fetcher():
+    """Returns a process-wide fetcher so every caller shares one connection pool and rate limit"""
+    global _default_fetcher
+    if _default_fetcher is None:
+        _default_fetcher = ArticleFetcher()
+    return _default_fetcher
+
+
+def title_from_response(response):
+    """Extracts the article title urltomarkdown returns in the X-Title header"""
+    return urllib.parse.unquote(response.headers["X-Title"]).split("–")[0].strip()
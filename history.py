@@ -0,0 +1,81 @@
+import threading
+
+from context_packer import count_tokens
+
+SUMMARY_MESSAGE_NAME = "conversation_summary"
+
+
+def message_role(message):
+    return message["role"] if isinstance(message, dict) else message.role
+
+
+def message_content(message):
+    content = message["content"] if isinstance(message, dict) else message.content
+    return content or ""
+
+
+class ConversationHistory:
+    """Keeps the system message and recent turns verbatim and folds older turns into a rolling summary.
+
+    The summary is computed in the background after a response, so building the next request never
+    waits on it. Turns that are not summarized yet stay verbatim until the summary catches up.
+    """
+
+    def __init__(self, summarize, keep_messages=6):
+        # summarize(previous_summary, messages) returns the new summary text
+        self.summarize = summarize
+        self.keep_messages = keep_messages
+        self.summary = ""
+        self.summarized_count = 0
+        self._future = None
+        self._lock = threading.Lock()
+
+    def messages_for_model(self, messages, model, token_ceiling):
+        """Returns the messages to send: system messages, the summary and as many recent turns as fit"""
+        system_messages = [m for m in messages if message_role(m) == "system"]
+        conversation = [m for m in messages if message_role(m) != "system"]
+        with self._lock:
+            summary, summarized_count = self.summary, self.summarized_count
+
+        used_tokens = count_tokens(summary, model) if summary else 0
+        recent = []
+        for message in reversed(conversation[summarized_count:]):
+            tokens = count_tokens(message_content(message), model)
+            if recent and used_tokens + tokens > token_ceiling:
+                break
+            recent.append(message)
+            used_tokens += tokens
+        recent.reverse()
+
+        if summary:
+            system_messages = system_messages + [
+                {
+                    "role": "system",
+                    "name": SUMMARY_MESSAGE_NAME,
+                    "content": f"Summary of the earlier conversation: {summary}",
+                }
+            ]
+        return system_messages + recent
+
+    def compact_in_background(self, messages, executor):
+        """Schedules folding the turns older than keep_messages into the summary, if there are any"""
+        conversation = [m for m in messages if message_role(m) != "system"]
+        with self._lock:
+            if self._future is not None and not self._future.done():
+                return None
+            fold_until = len(conversation) - self.keep_messages
+            if fold_until <= self.summarized_count:
+                return None
+            previous_summary = self.summary
+            to_fold = conversation[self.summarized_count : fold_until]
+            self._future = executor.submit(
+                self._fold, previous_summary, to_fold, fold_until
+            )
+            return self._future
+
+    def _fold(self, previous_summary, to_fold, fold_until):
+        summary = self.summarize(previous_summary, to_fold)
+        with self._lock:
+            self.summary = summary
+            self.summarized_count = fold_until
+        return summary
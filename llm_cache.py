@@ -0,0 +1,124 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "./llm_cache.db")
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+
+
+def content_hash(*parts):
+    """Returns a stable sha256 hex digest over the given strings"""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        # Separator so ("ab", "c") and ("a", "bc") hash differently
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class LLMCache:
+    """Persistent, size-bounded LRU cache of model results keyed by model, prompt template and content hash"""
+
+    def __init__(self, path=LLM_CACHE_PATH, max_bytes=LLM_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS llm_cache_last_access ON llm_cache (last_access)"
+        )
+        self._conn.commit()
+        self._total_bytes = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM llm_cache"
+        ).fetchone()[0]
+
+    @staticmethod
+    def key(model, prompt_template, content):
+        """Builds the cache key for a model call"""
+        return content_hash(model, prompt_template, content_hash(content))
+
+    def get(self, key):
+        """Returns the cached value for a key, or None on a miss"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM llm_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute(
+                "UPDATE llm_cache SET last_access = ? WHERE key = ?",
+                (time.time(), key),
+            )
+            self._conn.commit()
+            return row[0]
+
+    def set(self, key, value):
+        """Stores a value, evicting the least recently used entries when over the size bound"""
+        size = len(value.encode("utf-8"))
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size FROM llm_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None:
+                self._total_bytes -= row[0]
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, value, size, time.time()),
+            )
+            self._total_bytes += size
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        while self._total_bytes > self.max_bytes:
+            rows = self._conn.execute(
+                "SELECT key, size FROM llm_cache ORDER BY last_access LIMIT 64"
+            ).fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if self._total_bytes <= self.max_bytes:
+                    break
+                self._conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                self._total_bytes -= size
+
+    def get_or_compute(self, model, prompt_template, content, compute):
+        """Returns the cached result for a model call, calling compute() and storing its result on a miss"""
+        key = self.key(model, prompt_template, content)
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            if value is not None:
+                self.set(key, value)
+        return value
+
+    def stats(self):
+        """Returns hit/miss counters and current size"""
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "entries": entries,
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def clear(self):
+        """Removes every cached entry"""
+        with self._lock:
+            self._conn.execute("DELETE FROM llm_cache")
+            self._conn.commit()
+            self._total_bytes = 0
@@ -0,0 +1,238 @@
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "false").lower() == "true"
+METRICS_JSONL_PATH = os.getenv("METRICS_JSONL_PATH")
+METRICS_PREFIX = "wolfstreet"
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+request_id = contextvars.ContextVar("request_id", default=None)
+
+
+class _NoopSpan:
+    """Returned by span() when metrics are disabled, so instrumented code pays for one attribute lookup"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set(self, **fields):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class _Span:
+    def __init__(self, registry, stage, labels):
+        self.registry = registry
+        self.stage = stage
+        self.labels = labels
+        self.fields = {}
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        duration_ms = (time.perf_counter() - self.start) * 1000
+        self.registry.observe(
+            self.stage,
+            duration_ms,
+            error=exc_type is not None,
+            **self.labels,
+            **self.fields,
+        )
+        return False
+
+    def set(self, **fields):
+        """Adds fields to the JSONL event written when the span ends"""
+        self.fields.update(fields)
+
+
+class MetricsRegistry:
+    """Local timing spans, counters and gauges, exported as JSONL events and Prometheus text"""
+
+    def __init__(self, enabled=METRICS_ENABLED, jsonl_path=METRICS_JSONL_PATH):
+        self.enabled = enabled
+        self.jsonl_path = jsonl_path
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+        self._jsonl_file = None
+        self._http_server = None
+
+    def start_request(self):
+        """Starts a new request id for the spans recorded in the current context"""
+        new_id = uuid.uuid4().hex[:12]
+        request_id.set(new_id)
+        return new_id
+
+    def span(self, stage, **labels):
+        """Times a block of code as one stage of a request"""
+        if not self.enabled:
+            return NOOP_SPAN
+        return _Span(self, stage, labels)
+
+    def observe(self, stage, duration_ms, error=False, **fields):
+        """Records a stage duration that was measured elsewhere, such as a time to first token"""
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self._histograms.setdefault(
+                stage,
+                {"buckets": [0] * len(LATENCY_BUCKETS_MS), "count": 0, "sum": 0.0},
+            )
+            for i, bound in enumerate(LATENCY_BUCKETS_MS):
+                if duration_ms <= bound:
+                    histogram["buckets"][i] += 1
+            histogram["count"] += 1
+            histogram["sum"] += duration_ms
+        self.write_event(
+            {
+                "type": "span",
+                "stage": stage,
+                "duration_ms": round(duration_ms, 3),
+                "error": error,
+                **fields,
+            }
+        )
+
+    def increment(self, name, value=1, **labels):
+        """Adds to a counter identified by name and labels"""
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def record_usage(self, usage, model, call):
+        """Counts prompt and completion tokens from an OpenAI usage object"""
+        if not self.enabled or usage is None:
+            return
+        self.increment(
+            "tokens_total", usage.prompt_tokens, model=model, call=call, kind="prompt"
+        )
+        self.increment(
+            "tokens_total",
+            usage.completion_tokens,
+            model=model,
+            call=call,
+            kind="completion",
+        )
+        self.write_event(
+            {
+                "type": "usage",
+                "model": model,
+                "call": call,
+                "prompt_tokens": usage.prompt_tokens,
+                "completion_tokens": usage.completion_tokens,
+            }
+        )
+
+    def register_gauges(self, name, callback):
+        """Registers a callback returning {label dict as tuple of pairs: value}, evaluated on export"""
+        self._gauges[name] = callback
+
+    def write_event(self, event):
+        if not self.jsonl_path:
+            return
+        event = {"ts": round(time.time(), 3), "request_id": request_id.get(), **event}
+        line = json.dumps(event, default=str)
+        with self._lock:
+            if self._jsonl_file is None:
+                self._jsonl_file = open(self.jsonl_path, "a", buffering=1)
+            self._jsonl_file.write(line + "\n")
+
+    def render_prometheus(self):
+        """Returns every metric in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            histograms = {
+                stage: dict(h, buckets=list(h["buckets"]))
+                for stage, h in self._histograms.items()
+            }
+            counters = dict(self._counters)
+
+        name = f"{METRICS_PREFIX}_stage_latency_ms"
+        lines.append(f"# TYPE {name} histogram")
+        for stage, histogram in sorted(histograms.items()):
+            for bound, count in zip(LATENCY_BUCKETS_MS, histogram["buckets"]):
+                lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {count}')
+            lines.append(
+                f'{name}_bucket{{stage="{stage}",le="+Inf"}} {histogram["count"]}'
+            )
+            lines.append(f'{name}_sum{{stage="{stage}"}} {histogram["sum"]:.3f}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {histogram["count"]}')
+
+        for counter_name in sorted({key[0] for key in counters}):
+            lines.append(f"# TYPE {METRICS_PREFIX}_{counter_name} counter")
+            for (key_name, labels), value in sorted(counters.items()):
+                if key_name == counter_name:
+                    lines.append(
+                        f"{METRICS_PREFIX}_{counter_name}{_format_labels(labels)} {value}"
+                    )
+
+        for gauge_name, callback in sorted(self._gauges.items()):
+            lines.append(f"# TYPE {METRICS_PREFIX}_{gauge_name} gauge")
+            for labels, value in sorted(callback().items()):
+                lines.append(
+                    f"{METRICS_PREFIX}_{gauge_name}{_format_labels(labels)} {value}"
+                )
+
+        return "\n".join(lines) + "\n"
+
+    def start_http_server(self, port, host="0.0.0.0"):
+        """Serves render_prometheus() at /metrics from a daemon thread, once per registry.
+        Returns the server, or None if the port is taken, such as by a module reloaded in the same process."""
+        with self._lock:
+            if self._http_server is not None:
+                return self._http_server
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render_prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        try:
+            server = ThreadingHTTPServer((host, port), Handler)
+        except OSError as e:
+            print(f"Not serving metrics on port {port}: {e}")
+            return None
+        with self._lock:
+            if self._http_server is not None:
+                server.server_close()
+                return self._http_server
+            self._http_server = server
+        threading.Thread(
+            target=server.serve_forever, name="metrics-http", daemon=True
+        ).start()
+        return server
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+METRICS = MetricsRegistry()
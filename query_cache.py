@@ -0,0 +1,135 @@
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+class TTLCache:
+    """Thread-safe in-memory LRU cache whose entries also expire after a time-to-live"""
+
+    def __init__(self, max_entries=512, ttl_seconds=3600):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the cached value for a key, or None if it is missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        """Stores a value, evicting the least recently used entry when full"""
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get_or_compute(self, key, compute):
+        """Returns the cached value for a key, calling compute() and storing its result on a miss"""
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.set(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Returns hit/miss counters and the current number of entries"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "entries": len(self._entries),
+            }
+
+
+class SemanticAnswerCache:
+    """Caches answers to questions and serves them for near-duplicate questions by embedding similarity"""
+
+    def __init__(
+        self, similarity_threshold=0.95, max_entries=256, ttl_seconds=6 * 3600
+    ):
+        self.similarity_threshold = similarity_threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._entries = []
+        self._corpus_version = None
+        self._lock = threading.Lock()
+
+    def _check_version(self, corpus_version):
+        # Answers are only valid for the articles that were known when they were generated
+        if corpus_version != self._corpus_version:
+            self._entries = []
+            self._corpus_version = corpus_version
+
+    def get(self, embedding, model, corpus_version):
+        """Returns the answer to the most similar cached question above the threshold, or None"""
+        query = _normalize(embedding)
+        with self._lock:
+            self._check_version(corpus_version)
+            now = time.monotonic()
+            self._entries = [e for e in self._entries if e["expires"] > now]
+            candidates = [e for e in self._entries if e["model"] == model]
+            if candidates:
+                similarities = np.stack([e["embedding"] for e in candidates]) @ query
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.similarity_threshold:
+                    self.hits += 1
+                    return candidates[best]["answer"]
+            self.misses += 1
+            return None
+
+    def set(self, embedding, model, corpus_version, answer):
+        """Stores an answer, dropping the oldest entry when full"""
+        with self._lock:
+            self._check_version(corpus_version)
+            self._entries.append(
+                {
+                    "embedding": _normalize(embedding),
+                    "model": model,
+                    "answer": answer,
+                    "expires": time.monotonic() + self.ttl_seconds,
+                }
+            )
+            del self._entries[: -self.max_entries]
+
+    def clear(self):
+        with self._lock:
+            self._entries = []
+
+    def stats(self):
+        """Returns hit/miss counters and the current number of entries"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "entries": len(self._entries),
+            }
+
+
+def _normalize(embedding):
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
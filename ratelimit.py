@@ -0,0 +1,34 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """Thread-safe token bucket that blocks callers until a token is available"""
+
+    def __init__(self, rate, capacity=1):
+        # rate is in tokens per second, capacity is the largest burst allowed
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def per_minute(cls, requests_per_minute, capacity=1):
+        """Builds a bucket from a requests-per-minute limit"""
+        return cls(requests_per_minute / 60, capacity)
+
+    def acquire(self, tokens=1):
+        """Blocks until the requested number of tokens can be taken from the bucket"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
@@ -0,0 +1,290 @@
+"""Rebuilds the vector index from scratch into a fresh versioned collection.
+
+The articles are split into shards that a process pool chunks and embeds in parallel, while this
+process writes the results into a new collection and a new BM25 index. The serving app keeps using
+the current collection until the new one has passed validation, then the active collection pointer
+is switched over in one atomic rename. Run from the repo root:
+
+    python rebuild.py --workers 8
+"""
+
+import argparse
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timezone
+
+import numpy as np
+
+import data
+from article_store import ARTICLE_STORE_PATH, ArticleStore
+from bm25_index import BM25_INDEX_PATH, BM25Index
+from chart_index import ChartIndex
+from vector_backends import (
+    ACTIVE_COLLECTION_PATH,
+    CHROMA_PATH,
+    ChromaBackend,
+    active_collection_name,
+    set_active_collection,
+)
+from vector_snapshot import COLLECTION_NAME
+
+REBUILD_SHARD_SIZE = int(os.getenv("REBUILD_SHARD_SIZE", 16))
+# Each worker's ONNX runs already use every core, so a couple of processes keep the CPU busy and more
+# only oversubscribe it, see data.EMBED_WORKERS
+REBUILD_WORKERS = int(os.getenv("REBUILD_WORKERS", 2))
+REBUILD_KEEP_VERSIONS = int(os.getenv("REBUILD_KEEP_VERSIONS", 2))
+
+# Set in each pool worker by init_worker, so the model is loaded once per process rather than per shard
+_embedding_function = None
+_chart_index = None
+
+
+def default_embedding_function():
+    import chromadb.utils.embedding_functions as embedding_functions
+
+    return embedding_functions.DefaultEmbeddingFunction()
+
+
+def init_worker(embedding_function_factory):
+    global _embedding_function, _chart_index
+    _embedding_function = embedding_function_factory()
+    _chart_index = ChartIndex.load_or_create()
+
+
+def chunk_and_embed_shard(articles, batch_size=data.EMBED_BATCH_SIZE):
+    """Runs in a pool worker: chunks a shard of (article, markdown) pairs and embeds the chunks.
+    Returns the chunk records and their embeddings as a float32 array."""
+    records = []
+    for article, markdown_content in articles:
+        records.extend(
+            data.article_chunk_records(article, markdown_content, _chart_index)
+        )
+    embeddings = [
+        _embedding_function(
+            [record["page_content"] for record in records[i : i + batch_size]]
+        )
+        for i in range(0, len(records), batch_size)
+    ]
+    return records, np.asarray(
+        [embedding for batch in embeddings for embedding in batch], dtype=np.float32
+    )
+
+
+def versioned_collection_name():
+    return f"{COLLECTION_NAME}_v{datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S')}"
+
+
+def load_articles(articles, fetcher=None):
+    """Returns (article, markdown) pairs for the articles, fetching the markdown that is not on disk"""
+    return list(data.read_or_fetch_markdown(articles, fetcher))
+
+
+def collection_articles(collection, page_size=data.EMBED_BATCH_SIZE * 4):
+    """Returns the urls of the articles that have chunks in a collection"""
+    urls = set()
+    offset = 0
+    while True:
+        page = collection.get(include=["metadatas"], limit=page_size, offset=offset)
+        if not page["ids"]:
+            return urls
+        urls.update(metadata["url"] for metadata in page["metadatas"])
+        offset += len(page["ids"])
+
+
+def validate_collection(
+    collection,
+    records,
+    embeddings,
+    expected_articles,
+    serving=None,
+    samples=50,
+    n_results=5,
+    min_self_recall=0.9,
+    min_chunk_ratio=0.9,
+):
+    """Checks the new collection before it is served: every chunk is stored, every stored article is
+    present, it holds no fewer articles and not many fewer chunks than the collection being served,
+    and a sample of chunks finds itself among its own nearest neighbours.
+    Returns a summary of the checks or raises RuntimeError."""
+    problems = []
+    count = collection.count()
+    expected = len({record["chunk_id"] for record in records})
+    if count != expected:
+        problems.append(f"holds {count} chunks, expected {expected}")
+
+    stored_urls = collection_articles(collection)
+    if len(stored_urls) < expected_articles:
+        problems.append(f"holds {len(stored_urls)} of the {expected_articles} stored articles")
+
+    # Chunking changes can shrink the chunk count a little, losing articles never is
+    if serving is not None:
+        serving_count = serving.count()
+        serving_urls = collection_articles(serving)
+        if len(stored_urls) < len(serving_urls):
+            problems.append(
+                f"holds {len(stored_urls)} articles, {serving.name} {len(serving_urls)}"
+            )
+        if count < min_chunk_ratio * serving_count:
+            problems.append(f"holds {count} chunks, {serving.name} {serving_count}")
+
+    sample = random.Random(0).sample(range(len(records)), min(samples, len(records)))
+    self_recall = 1.0
+    if sample:
+        results = collection.query(
+            query_embeddings=embeddings[sample].tolist(),
+            n_results=n_results,
+            include=["documents"],
+        )
+        # Chunks with identical text are interchangeable, so a matching document counts as found
+        found = sum(
+            records[row]["chunk_id"] in ids or records[row]["page_content"] in documents
+            for row, ids, documents in zip(sample, results["ids"], results["documents"])
+        )
+        self_recall = found / len(sample)
+        # Approximate search misses a few, misaligned ids and embeddings miss nearly all
+        if self_recall < min_self_recall:
+            problems.append(f"found only {self_recall:.0%} of sampled chunks by their own embedding")
+
+    if problems:
+        raise RuntimeError(f"Collection {collection.name} failed validation: it " + "; ".join(problems))
+    return {"chunks": count, "articles": len(stored_urls), "self_recall": self_recall}
+
+
+def prune_collections(
+    client, keep=REBUILD_KEEP_VERSIONS, active_collection_path=ACTIVE_COLLECTION_PATH, replaced=None
+):
+    """Deletes all but the newest keep rebuilt versions of the collection. Never deletes the one being
+    served, the one it replaced or the original unversioned collection."""
+    protected = {active_collection_name(active_collection_path), replaced, COLLECTION_NAME}
+    names = sorted(
+        collection.name
+        for collection in client.list_collections()
+        if collection.name.startswith(f"{COLLECTION_NAME}_v")
+    )
+    deleted = [name for name in names[: max(len(names) - keep, 0)] if name not in protected]
+    for name in deleted:
+        client.delete_collection(name)
+    return deleted
+
+
+def rebuild(
+    store_path=ARTICLE_STORE_PATH,
+    workers=REBUILD_WORKERS,
+    shard_size=REBUILD_SHARD_SIZE,
+    chroma_path=CHROMA_PATH,
+    bm25_index_path=BM25_INDEX_PATH,
+    active_collection_path=ACTIVE_COLLECTION_PATH,
+    embedding_function_factory=default_embedding_function,
+    keep=REBUILD_KEEP_VERSIONS,
+    switch=True,
+):
+    """Chunks and embeds every article into a new collection, validates it and makes it the active one"""
+    start = time.perf_counter()
+    store = ArticleStore(store_path)
+    client = ChromaBackend(chroma_path).client
+    replaced = active_collection_name(active_collection_path)
+    try:
+        serving = client.get_collection(replaced)
+    except ValueError:
+        serving = None
+    name = versioned_collection_name()
+    collection = client.create_collection(name)
+    batch_size = client.max_batch_size
+    bm25_index = BM25Index()
+    records, embeddings = [], []
+    print(f"Building {name}")
+
+    def save_shard(shard_records, shard_embeddings):
+        for i in range(0, len(shard_records), batch_size):
+            batch = shard_records[i : i + batch_size]
+            collection.upsert(
+                ids=[record["chunk_id"] for record in batch],
+                embeddings=shard_embeddings[i : i + batch_size].tolist(),
+                documents=[record["page_content"] for record in batch],
+                metadatas=[data.chunk_metadata(record) for record in batch],
+            )
+        bm25_index.upsert(
+            [record["chunk_id"] for record in shard_records],
+            [record["page_content"] for record in shard_records],
+        )
+        if shard_records:
+            records.extend(shard_records)
+            embeddings.append(shard_embeddings)
+
+    done = set()
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=init_worker,
+        initargs=(embedding_function_factory,),
+    ) as executor:
+        # Articles ingested while the rebuild runs would otherwise only reach the old collection,
+        # so the store is read again until a pass finds nothing new
+        while True:
+            articles = [article for article in store if article["title"] not in done]
+            if not articles:
+                break
+            done.update(article["title"] for article in articles)
+            # Markdown that has to be fetched again is saved, so it is only fetched once
+            articles = load_articles(articles)
+            shards = [articles[i : i + shard_size] for i in range(0, len(articles), shard_size)]
+            futures = [executor.submit(chunk_and_embed_shard, shard) for shard in shards]
+            for finished, future in enumerate(as_completed(futures), 1):
+                save_shard(*future.result())
+                print(f"Shard {finished}/{len(shards)}: {len(records)} chunks embedded")
+
+    embeddings = np.concatenate(embeddings) if embeddings else np.zeros((0, 0), np.float32)
+    # Every article seen in the store, including any whose markdown could not be fetched
+    try:
+        checks = validate_collection(collection, records, embeddings, len(done), serving)
+    except RuntimeError:
+        client.delete_collection(name)
+        raise
+    elapsed = time.perf_counter() - start
+    print(
+        f"Built {name}: {checks['chunks']} chunks from {checks['articles']} articles "
+        f"in {elapsed:.1f}s, self-recall {checks['self_recall']:.0%}"
+    )
+    if not switch:
+        return name
+
+    # The BM25 file is replaced first: chunk ids are content hashes, so the ids the two indexes
+    # share still resolve during the moment between the two renames
+    bm25_index.save(bm25_index_path)
+    set_active_collection(
+        name,
+        active_collection_path,
+        built_at=datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        chunks=checks["chunks"],
+        articles=checks["articles"],
+    )
+    print(f"Now serving {name}")
+    for deleted in prune_collections(client, keep, active_collection_path, replaced):
+        print(f"Deleted old collection {deleted}")
+    return name
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--store", default=ARTICLE_STORE_PATH)
+    parser.add_argument("--workers", type=int, default=REBUILD_WORKERS)
+    parser.add_argument("--shard-size", type=int, default=REBUILD_SHARD_SIZE)
+    parser.add_argument("--keep", type=int, default=REBUILD_KEEP_VERSIONS)
+    parser.add_argument(
+        "--no-switch",
+        action="store_true",
+        help="build and validate the collection without serving it",
+    )
+    args = parser.parse_args()
+    rebuild(
+        args.store,
+        workers=args.workers,
+        shard_size=args.shard_size,
+        keep=args.keep,
+        switch=not args.no_switch,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+import re
+from collections import namedtuple
+
+RouteDecision = namedtuple(
+    "RouteDecision", ["needs_retrieval", "titles", "confident", "reason"]
+)
+
+# Questions about the bot itself, Wolf or Wolf Street are answered from the system message
+NO_RETRIEVAL_PATTERNS = [
+    re.compile(pattern, re.IGNORECASE)
+    for pattern in [
+        r"^\s*(hi|hello|hey|thanks|thank you|ok|okay)\b[\s!.?]*$",
+        r"\bwho (are|made|built|created|wrote) you\b",
+        r"\bwhat (can|do) you (do|know)\b",
+        # The whole question, so "What is Wolf Street saying about the Fed?" still gets the articles
+        r"^\s*who is wolf( richter)?[\s!.?]*$",
+        r"^\s*what is wolf ?street[\s!.?]*$",
+        r"\bhow (do|can) i (donate|support)\b",
+    ]
+]
+
+# Terms specific to what Wolf writes about. Everyday words like "rate", "home" or "think" show up in
+# unrelated questions too, so those are left to the similarity of the question to the articles.
+RETRIEVAL_KEYWORDS = {
+    "inflation",
+    "cpi",
+    "ppi",
+    "pce",
+    "fed",
+    "fomc",
+    "federal reserve",
+    "interest rates",
+    "balance sheet",
+    "qt",
+    "treasury",
+    "treasuries",
+    "yield curve",
+    "10-year yield",
+    "mortgage rates",
+    "mortgages",
+    "housing market",
+    "home sales",
+    "home prices",
+    "payrolls",
+    "unemployment",
+    "jobless claims",
+    "gdp",
+    "recession",
+    "deficit",
+    "national debt",
+    "consumer spending",
+    "retail sales",
+    "tariffs",
+    "trade deficit",
+    "cre",
+    "cmbs",
+    "office vacancies",
+    "delinquencies",
+    "delinquency",
+    "wolf street",
+    "wolf's",
+}
+
+RETRIEVAL_KEYWORD_PATTERN = re.compile(
+    r"(?<![\w'-])("
+    + "|".join(re.escape(keyword) for keyword in sorted(RETRIEVAL_KEYWORDS, key=len, reverse=True))
+    + r")(?![\w'-])",
+    re.IGNORECASE,
+)
+
+# Short follow-ups on later turns usually refer to the previous answer, so the model decides
+FOLLOW_UP_PATTERN = re.compile(
+    r"\b(it|that|this|those|these|them|more|else|why|elaborate|explain)\b",
+    re.IGNORECASE,
+)
+
+
+class RetrievalRouter:
+    """Decides locally whether a question needs retrieval and which articles are likely relevant"""
+
+    def __init__(
+        self,
+        article_index,
+        embed_query,
+        high_similarity=0.55,
+        low_similarity=0.35,
+        max_titles=3,
+        title_margin=0.08,
+    ):
+        # article_index is a CatalogEmbeddings over article titles and summaries
+        self.article_index = article_index
+        self.embed_query = embed_query
+        self.high_similarity = high_similarity
+        self.low_similarity = low_similarity
+        self.max_titles = max_titles
+        self.title_margin = title_margin
+
+    def route(self, query_text, first_turn=True):
+        """Returns a RouteDecision, only confident ones should skip the model's tool decision"""
+        if any(pattern.search(query_text) for pattern in NO_RETRIEVAL_PATTERNS):
+            return RouteDecision(False, [], True, "about the bot")
+
+        words = re.findall(r"[\w']+", query_text.lower())
+        if not first_turn and len(words) < 8 and FOLLOW_UP_PATTERN.search(query_text):
+            return RouteDecision(None, [], False, "follow-up")
+
+        ranked = self.article_index.rank(self.embed_query(query_text))
+        top_similarity = ranked[0][1] if ranked else 0.0
+        titles = [
+            title
+            for title, similarity in ranked[: self.max_titles]
+            if similarity >= top_similarity - self.title_margin
+        ]
+        has_keyword = RETRIEVAL_KEYWORD_PATTERN.search(query_text) is not None
+
+        if top_similarity >= self.high_similarity:
+            return RouteDecision(True, titles, True, "similar articles")
+        if has_keyword and top_similarity >= self.low_similarity:
+            return RouteDecision(True, titles, True, "topic keyword")
+        return RouteDecision(None, titles, False, "uncertain")
@@ -1,12 +1,53 @@
 from langchain_text_splitters import MarkdownHeaderTextSplitter
 from openai import OpenAI
 from pprint import pprint
+from concurrent.futures import ThreadPoolExecutor
+import base64
+import hashlib
+import os
+import threading
 import dotenv
+from llm_cache import LLMCache
+from ratelimit import TokenBucket
 
 dotenv.load_dotenv()
 
 MODEL = "gpt-4o"  # "gpt-4-turbo"
 
+# Caps shared by every summarization and image call in the process, so summarizing several
+# articles at once cannot exceed them
+MAX_CONCURRENT_REQUESTS = int(os.getenv("SUMMARIZE_MAX_CONCURRENT_REQUESTS", 8))
+REQUESTS_PER_MINUTE = int(os.getenv("SUMMARIZE_REQUESTS_PER_MINUTE", 300))
+
+_openai_client = None
+_client_lock = threading.Lock()
+_request_slots = threading.BoundedSemaphore(MAX_CONCURRENT_REQUESTS)
+_rate_limiter = TokenBucket.per_minute(REQUESTS_PER_MINUTE, MAX_CONCURRENT_REQUESTS)
+
+# Prompt templates are part of the cache key, so editing one only invalidates its own results
+SECTION_SUMMARY_PROMPT = (
+    "Summarize the following snippet of a Wolf Street article in markdown. "
+    "Be concise and objective, with 3-5 sentences per section. Return a plain text paragraph, no formatting or new lines: {content}"
+)
+ARTICLE_SUMMARY_PROMPT = (
+    "The following is a set of summaries from a Wolf Street article split by its sections: {content} "
+    "Take these and place it in a packaged, paragraph summary about the article. "
+    "In the event of an interview, intuit what the name abbreviations are from the section headers and use their names. "
+    "Mention the name of every section. The summary should use all the points mentioned below. "
+    "Return plain text paragraph, no formatting and no new lines."
+)
+NOT_A_CHART = "NO CHART"
+IMAGE_ANALYSIS_PROMPT = (
+    "The image in this link may contain a graph. If it does, extract the data from"
+    "this image into a table. Create a row for each label on the Y axis. Do not"
+    "interpolate any rows that are not indicated on the X axis. Use the text"
+    "embedded in the image to extract a title for the graph and units for the Y axis."
+    "Do not include any other explanatory information. If the image is not a chart or"
+    f"graph of data, reply with only {NOT_A_CHART}"
+)
+
+_llm_cache = None
+
 headers_to_split_on = [
     ("#", "Header 1"),
     ("##", "Header 2"),
@@ -15,7 +56,67 @@ headers_to_split_on = [
 ]
 
 
-def summarize_article(article_title, markdown_content):
+def get_openai_client():
+    """Returns the OpenAI client shared by all summarization calls"""
+    global _openai_client
+    with _client_lock:
+        if _openai_client is None:
+            _openai_client = OpenAI()
+    return _openai_client
+
+
+def get_llm_cache():
+    """Returns the on-disk cache of summarization and image analysis results"""
+    global _llm_cache
+    with _client_lock:
+        if _llm_cache is None:
+            _llm_cache = LLMCache()
+    return _llm_cache
+
+
+def set_request_limits(max_concurrent_requests=None, requests_per_minute=None):
+    """Changes the concurrency cap and rate limit applied to OpenAI calls made from this module"""
+    global _request_slots, _rate_limiter, MAX_CONCURRENT_REQUESTS, REQUESTS_PER_MINUTE
+    if max_concurrent_requests is not None:
+        MAX_CONCURRENT_REQUESTS = max_concurrent_requests
+        _request_slots = threading.BoundedSemaphore(max_concurrent_requests)
+    if requests_per_minute is not None:
+        REQUESTS_PER_MINUTE = requests_per_minute
+    _rate_limiter = TokenBucket.per_minute(REQUESTS_PER_MINUTE, MAX_CONCURRENT_REQUESTS)
+
+
+def create_completion(messages, model=MODEL):
+    """Creates a chat completion through the shared client, within the concurrency cap and rate limit"""
+    _rate_limiter.acquire()
+    with _request_slots:
+        completion = get_openai_client().chat.completions.create(
+            model=model, messages=messages
+        )
+    return completion.choices[0].message.content
+
+
+def cached_completion(prompt_template, content, messages, model=MODEL):
+    """Returns the completion for a prompt template applied to content, reusing earlier results from the cache"""
+    return get_llm_cache().get_or_compute(
+        model, prompt_template, content, lambda: create_completion(messages, model)
+    )
+
+
+def summarize_section(section_content):
+    """Summarizes one section of an article, the map step of summarize_article"""
+    return cached_completion(
+        SECTION_SUMMARY_PROMPT,
+        section_content,
+        [
+            {
+                "role": "system",
+                "content": SECTION_SUMMARY_PROMPT.format(content=section_content),
+            }
+        ],
+    )
+
+
+def summarize_article(article_title, markdown_content, max_workers=None):
     """Summarizes the content of a given markdown string using OpenAI's GPT-4 model and map-reduce approach"""
     if "* * *" in markdown_content:
         markdown_content = "".join(markdown_content.split("* * *")[:-1])
@@ -25,66 +126,59 @@ def summarize_article(article_title, markdown_content):
     )
     section_splits = markdown_splitter.split_text(markdown_content)
 
-    openai_client = OpenAI()
-
-    section_summaries = []
-    for i, section in enumerate(section_splits):
-        section_content = section.page_content
-        section_header = list(section.metadata.values())[-1]
-        section_completion = openai_client.chat.completions.create(
-            model=MODEL,
-            messages=[
-                {
-                    "role": "system",
-                    "content": f"Summarize the following snippet of a Wolf Street article in markdown. "
-                    f"Be concise and objective, with 3-5 sentences per section. Return a plain text paragraph, no formatting or new lines: {section_content}",
-                }
-            ],
-        )
-        section_summary = (
-            section_header + ": " + section_completion.choices[0].message.content
+    # Map: summarize every section concurrently, executor.map keeps the section order
+    with ThreadPoolExecutor(
+        max_workers=max_workers or MAX_CONCURRENT_REQUESTS
+    ) as executor:
+        section_completions = executor.map(
+            summarize_section, [section.page_content for section in section_splits]
         )
-        section_summaries.append(section_summary)
-        print(f"({i + 1}/{len(section_splits)}): {section_summary}")
+        section_summaries = []
+        for i, (section, section_completion) in enumerate(
+            zip(section_splits, section_completions)
+        ):
+            section_header = list(section.metadata.values())[-1]
+            section_summary = section_header + ": " + section_completion
+            section_summaries.append(section_summary)
+            print(f"({i + 1}/{len(section_splits)}): {section_summary}")
 
+    # Reduce: combine the section summaries into one article summary
     section_summaries = "\n".join(section_summaries)
-    article_completion = openai_client.chat.completions.create(
-        model=MODEL,
-        messages=[
+    article_summary = cached_completion(
+        ARTICLE_SUMMARY_PROMPT,
+        section_summaries,
+        [
             {
                 "role": "system",
-                "content": f"The following is a set of summaries from a Wolf Street article split by its sections: {section_summaries} "
-                f"Take these and place it in a packaged, paragraph summary about the article. "
-                f"In the event of an interview, intuit what the name abbreviations are from the section headers and use their names. "
-                f"Mention the name of every section. The summary should use all the points mentioned below. "
-                f"Return plain text paragraph, no formatting and no new lines.",
+                "content": ARTICLE_SUMMARY_PROMPT.format(content=section_summaries),
             }
         ],
     )
-    print("Full summary: " + article_completion.choices[0].message.content + "\n\n")
-    return article_completion.choices[0].message.content
+    print("Full summary: " + article_summary + "\n\n")
+    return article_summary
 
 
-def analyze_image(image_url):
-    # call_openai()
-    openai_client = OpenAI()
-    img_sum = openai_client.chat.completions.create(
-        model=MODEL,
-        messages=[
+def analyze_image(image_url, image_content=None, content_type="image/png"):
+    """Extracts the data in a chart image as a table. Given the downloaded image, it is sent inline and the
+    result is cached by its content hash, so the same chart linked from another url is analyzed once.
+    Returns "" for images that are not charts, such as photos and logos."""
+    cache_content = image_url
+    if image_content is not None:
+        cache_content = f"sha256:{hashlib.sha256(image_content).hexdigest()}"
+        image_url = f"data:{content_type};base64,{base64.b64encode(image_content).decode()}"
+    table = cached_completion(
+        IMAGE_ANALYSIS_PROMPT,
+        cache_content,
+        [
             {
                 "role": "user",
                 "content": [
-                    {
-                        "type": "text",
-                        "text": f"The image in this link may contain a graph. If it does, extract the data from"
-                        f"this image into a table. Create a row for each label on the Y axis. Do not"
-                        f"interpolate any rows that are not indicated on the X axis. Use the text"
-                        f"embedded in the image to extract a title for the graph and units for the Y axis."
-                        f"Do not include any other explanatory information",
-                    },
+                    {"type": "text", "text": IMAGE_ANALYSIS_PROMPT},
                     {"type": "image_url", "image_url": {"url": f"{image_url}"}},
                 ],
             }
         ],
     )
-    return img_sum.choices[0].message.content
+    if table is not None and table.strip().strip(".").upper() == NOT_A_CHART:
+        return ""
+    return table
@@ -0,0 +1,126 @@
+import re
+import time
+from collections import namedtuple
+from datetime import datetime, timezone
+
+TimeScope = namedtuple("TimeScope", ["start", "end", "reason"])
+
+DAY_SECONDS = 24 * 3600
+
+# Phrases relative to now, with how many days of articles they reach back. Reports on a month's data are
+# published during the following month, so "last month" covers two months of articles.
+RELATIVE_PATTERNS = [
+    (re.compile(pattern, re.IGNORECASE), days)
+    for pattern, days in [
+        (r"\b(today|tonight|yesterday|this morning)\b", 3),
+        (r"\b(this|last|past|previous) week('?s)?\b", 14),
+        (r"\b(this|last|past|previous) month('?s)?\b", 62),
+        (r"\b(this|last|past|previous) quarter('?s)?\b", 125),
+        (r"\b(this|last|past|previous) year('?s)?\b|\blast 12 months\b", 400),
+        # Not "recent" alone: "in recent years" is not about the last few weeks
+        (r"\b(latest|most recent|newest|recently|lately|currently)\b", 45),
+    ]
+]
+LAST_N_PATTERN = re.compile(
+    r"\b(?:last|past|previous) (\d{1,3}) (day|week|month|year)s?\b", re.IGNORECASE
+)
+UNIT_DAYS = {"day": 1, "week": 7, "month": 31, "year": 366}
+MONTH_NAMES = [
+    "january", "february", "march", "april", "may", "june",
+    "july", "august", "september", "october", "november", "december",
+]  # fmt: skip
+MONTHS = {name: i for i, name in enumerate(MONTH_NAMES, 1)}
+MONTHS.update({name[:3]: i for i, name in enumerate(MONTH_NAMES, 1)})
+MONTHS["sept"] = 9
+# Only full month names and their exact abbreviations, so words like "market" or "separate" never match
+MONTH_YEAR_PATTERN = re.compile(
+    rf"\b({'|'.join(sorted(MONTHS, key=len, reverse=True))})\.?,? (\d{{4}})\b",
+    re.IGNORECASE,
+)
+# "March and April 2024", "Dec to Jan 2024"
+MONTH_RANGE_PATTERN = re.compile(
+    rf"\b({'|'.join(sorted(MONTHS, key=len, reverse=True))})\.?"
+    rf"(?: (?:and|or|to|through|vs\.?|versus|&) | ?- ?)"
+    rf"({'|'.join(sorted(MONTHS, key=len, reverse=True))})\.?,? (\d{{4}})\b",
+    re.IGNORECASE,
+)
+YEAR_PATTERN = re.compile(r"\b(?:in|during|for|of|since) ((?:19|20)\d\d)\b")
+# Only counted next to another period, as in "in 2023 vs 2024"
+BARE_YEAR_PATTERN = re.compile(r"\b((?:19|20)\d\d)\b")
+
+
+def month_start(year, month):
+    year, month = year + (month - 1) // 12, (month - 1) % 12 + 1
+    return datetime(year, month, 1, tzinfo=timezone.utc).timestamp()
+
+
+def year_scope(year, reason):
+    return TimeScope(month_start(year, 1), month_start(year + 1, 2), reason)
+
+
+def detect_time_scope(query_text, reference=None):
+    """Returns the range of publish timestamps a question is about, or None if it is not time-bound.
+
+    Named months and years give calendar ranges, extended by a month so articles reporting on them are
+    included. Relative phrases like "last month" or "most recent" count back from reference, which should
+    be the newest article's publish time: the corpus is only as current as its last article. A question
+    naming several periods ("2023 vs 2024") gets the range spanning all of them."""
+    reference = time.time() if reference is None else reference
+    scopes = []
+    matched = []
+
+    def add(scope, match):
+        scopes.append(scope)
+        matched.append(match.span())
+
+    for match in MONTH_RANGE_PATTERN.finditer(query_text):
+        first, last = MONTHS[match.group(1).lower()], MONTHS[match.group(2).lower()]
+        year = int(match.group(3))
+        # "Dec to Jan 2024" starts in the year before
+        start = month_start(year - 1 if first > last else year, first)
+        add(TimeScope(start, month_start(year, last + 2), match.group(0)), match)
+    for match in MONTH_YEAR_PATTERN.finditer(query_text):
+        year, month = int(match.group(2)), MONTHS[match.group(1).lower()]
+        add(TimeScope(month_start(year, month), month_start(year, month + 2), match.group(0)), match)
+    for match in YEAR_PATTERN.finditer(query_text):
+        year = int(match.group(1))
+        if match.group(0).lower().startswith("since"):
+            add(TimeScope(month_start(year, 1), None, match.group(0)), match)
+        else:
+            add(year_scope(year, match.group(0)), match)
+    if scopes:
+        for match in BARE_YEAR_PATTERN.finditer(query_text):
+            if not any(start <= match.start() < end for start, end in matched):
+                add(year_scope(int(match.group(1)), match.group(0)), match)
+
+    for match in LAST_N_PATTERN.finditer(query_text):
+        days = int(match.group(1)) * UNIT_DAYS[match.group(2).lower()]
+        # A day of slack so an article from the morning of the first day is still in range
+        add(TimeScope(reference - (days + 1) * DAY_SECONDS, None, match.group(0)), match)
+    for pattern, days in RELATIVE_PATTERNS:
+        for match in pattern.finditer(query_text):
+            add(TimeScope(reference - days * DAY_SECONDS, None, match.group(0)), match)
+
+    if not scopes:
+        return None
+    if len(scopes) == 1:
+        return scopes[0]
+    matched_text = [scope.reason for scope in scopes]
+    ends = [scope.end for scope in scopes]
+    return TimeScope(
+        min(scope.start for scope in scopes),
+        None if None in ends else max(ends),
+        ", ".join(
+            reason
+            for reason in dict.fromkeys(scope.reason for scope in scopes)
+            if not any(reason != other and reason in other for other in matched_text)
+        ),
+    )
+
+
+def in_time_scope(metadata, scope):
+    """Whether a chunk's metadata falls in the scope. Chunks stored without a timestamp always do."""
+    timestamp = (metadata or {}).get("timestamp")
+    if timestamp is None:
+        return True
+    return timestamp >= scope.start and (scope.end is None or timestamp < scope.end)
@@ -0,0 +1,188 @@
+import json
+import os
+import sys
+import threading
+
+from vector_snapshot import COLLECTION_NAME, SNAPSHOT_PATH, SNAPSHOT_POINTER, VectorSnapshot
+
+RETRIEVAL_BACKEND = os.getenv("RETRIEVAL_BACKEND", "chroma")
+CHROMA_PATH = os.getenv("CHROMA_PATH", "./chroma.db")
+CHROMADB_MIN_SQLITE_VERSION = (3, 35, 0)
+# Names the versioned collection the app serves from, switched by rebuild.py once a rebuild validates
+ACTIVE_COLLECTION_PATH = os.getenv("ACTIVE_COLLECTION_PATH", "./active_collection.json")
+
+
+def use_compatible_sqlite():
+    """Swaps in pysqlite3 for the sqlite3 module when the system SQLite is too old for chromadb.
+    Has to run before chromadb is first imported."""
+    import sqlite3
+
+    if sqlite3.sqlite_version_info < CHROMADB_MIN_SQLITE_VERSION:
+        __import__("pysqlite3")
+        sys.modules["sqlite3"] = sys.modules.pop("pysqlite3")
+
+
+def active_collection_name(path=ACTIVE_COLLECTION_PATH):
+    """Returns the name of the collection being served, the original collection if none was ever switched to"""
+    try:
+        with open(path, "r") as file:
+            return json.load(file)["collection"]
+    except FileNotFoundError:
+        return COLLECTION_NAME
+
+
+def set_active_collection(name, path=ACTIVE_COLLECTION_PATH, **details):
+    """Atomically points the serving app at another collection"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as file:
+        json.dump({"collection": name, **details}, file, indent=1)
+    os.replace(tmp_path, path)
+
+
+def published_between(start=None, end=None):
+    """Returns a Chroma where clause for chunks published from start up to but excluding end, or None"""
+    conditions = []
+    if start is not None:
+        conditions.append({"timestamp": {"$gte": start}})
+    if end is not None:
+        conditions.append({"timestamp": {"$lt": end}})
+    if len(conditions) > 1:
+        return {"$and": conditions}
+    return conditions[0] if conditions else None
+
+
+class ChromaBackend:
+    """Serves vector queries from the Chroma collection, opening the PersistentClient on first use.
+    Without a collection_name it follows the active collection pointer, so a rebuild can be switched in
+    while the app is running."""
+
+    name = "chroma"
+
+    def __init__(
+        self,
+        path=CHROMA_PATH,
+        collection_name=None,
+        client=None,
+        active_collection_path=ACTIVE_COLLECTION_PATH,
+    ):
+        self.path = path
+        self._collection_name = collection_name
+        self.active_collection_path = active_collection_path
+        self._client = client
+        self._lock = threading.Lock()
+        self._active = (None, None)
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                use_compatible_sqlite()
+                import chromadb
+
+                self._client = chromadb.PersistentClient(self.path)
+            return self._client
+
+    @client.setter
+    def client(self, client):
+        self._client = client
+
+    @property
+    def collection_name(self):
+        if self._collection_name is not None:
+            return self._collection_name
+        try:
+            mtime = os.stat(self.active_collection_path).st_mtime_ns
+        except FileNotFoundError:
+            return COLLECTION_NAME
+        with self._lock:
+            if self._active[0] != mtime:
+                self._active = (mtime, active_collection_name(self.active_collection_path))
+            return self._active[1]
+
+    def collection(self):
+        return self.client.get_collection(self.collection_name)
+
+    @property
+    def version(self):
+        """Changes when a rebuilt collection is switched in"""
+        return self.collection_name
+
+    def query(self, query_embeddings, n_results=10, start=None, end=None):
+        """Returns the closest chunks for each query embedding, one result list per query.
+        start and end limit the search to chunks published in that range of timestamps."""
+        return self.collection().query(
+            query_embeddings=query_embeddings,
+            n_results=n_results,
+            where=published_between(start, end),
+        )
+
+    def get(self, ids, include=("documents", "metadatas")):
+        return self.collection().get(ids=ids, include=list(include))
+
+    def count(self):
+        return self.collection().count()
+
+
+class NumpyBackend:
+    """Exact cosine search over a memory-mapped snapshot written by vector_snapshot.py.
+    The snapshot is mapped on first use and remapped when it is exported again."""
+
+    name = "numpy"
+
+    def __init__(self, path=SNAPSHOT_PATH):
+        self.path = path
+        self._snapshot = None
+        self._manifest_mtime = None
+        self._lock = threading.Lock()
+
+    @property
+    def snapshot(self):
+        # current.json is replaced in one rename when a new version is exported. A snapshot written
+        # before versioning has only its manifest.
+        try:
+            mtime = os.stat(os.path.join(self.path, SNAPSHOT_POINTER)).st_mtime_ns
+        except FileNotFoundError:
+            try:
+                mtime = os.stat(os.path.join(self.path, "manifest.json")).st_mtime_ns
+            except FileNotFoundError:
+                # Mid-replacement, or removed: keep serving what is loaded
+                if self._snapshot is None:
+                    raise
+                return self._snapshot
+        with self._lock:
+            if self._snapshot is None or mtime != self._manifest_mtime:
+                self._snapshot = VectorSnapshot.load(self.path, mmap=True)
+                self._manifest_mtime = mtime
+            return self._snapshot
+
+    @property
+    def version(self):
+        """Changes when a new snapshot is exported"""
+        self.snapshot
+        return self._manifest_mtime
+
+    def query(self, query_embeddings, n_results=10, start=None, end=None):
+        """Returns the closest chunks for each query embedding, one result list per query.
+        A batch of queries is scored with a single pass over the embedding matrix, or over the
+        rows published between start and end, which are contiguous in the snapshot."""
+        return self.snapshot.query(query_embeddings, n_results, start=start, end=end)
+
+    def get(self, ids, include=("documents", "metadatas")):
+        return self.snapshot.get(ids, include)
+
+    def count(self):
+        return len(self.snapshot)
+
+
+BACKENDS = {backend.name: backend for backend in (ChromaBackend, NumpyBackend)}
+
+
+def create_backend(name=RETRIEVAL_BACKEND, **kwargs):
+    """Returns a retrieval backend by name, "chroma" or "numpy" """
+    try:
+        backend = BACKENDS[name]
+    except KeyError:
+        raise ValueError(
+            f"Unknown retrieval backend {name!r}, expected one of {sorted(BACKENDS)}"
+        )
+    return backend(**kwargs)
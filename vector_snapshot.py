@@ -0,0 +1,460 @@
+"""Compact, quantized snapshots of the wolfstreet_articles Chroma collection.
+
+A snapshot is a directory of flat files: unit-normalized embeddings stored as float16 or
+row-scaled int8, each distinct chunk text stored once, and metadata stored column by column
+with every distinct value written once. Rows are ordered by publish timestamp, so the chunks
+published in a date range are one contiguous block that can be searched on its own. It can be served directly by VectorSnapshot, which
+does an exact cosine search and answers query/get calls in the same shape as a Chroma collection.
+Each export is written to a new version directory under the snapshot path, and current.json is then
+switched to it in one atomic rename, so a serving process never sees a half-written snapshot.
+
+    python vector_snapshot.py export --dtype int8 --output ./vector_snapshot
+"""
+
+import argparse
+import json
+import mmap as _mmap
+import os
+import shutil
+import time
+
+import numpy as np
+
+SNAPSHOT_PATH = os.getenv("VECTOR_SNAPSHOT_PATH", "./vector_snapshot")
+SNAPSHOT_DTYPES = ("float32", "float16", "int8")
+SNAPSHOT_FORMAT_VERSION = 1
+COLLECTION_NAME = "wolfstreet_articles"
+SEARCH_BLOCK_ROWS = 8192
+SNAPSHOT_POINTER = "current.json"
+# The replaced version is kept so a process still loading it can finish
+SNAPSHOT_KEEP_VERSIONS = 2
+
+
+def current_snapshot_dir(path=SNAPSHOT_PATH):
+    """Returns the directory of the snapshot being served at path. A snapshot exported before versioning
+    is the path itself."""
+    try:
+        with open(os.path.join(path, SNAPSHOT_POINTER), "r") as file:
+            return os.path.join(path, json.load(file)["version"])
+    except FileNotFoundError:
+        return path
+
+
+def set_current_snapshot(path, version, keep=SNAPSHOT_KEEP_VERSIONS):
+    """Atomically points path at a version directory and deletes all but the newest keep versions"""
+    tmp_path = os.path.join(path, f"{SNAPSHOT_POINTER}.tmp")
+    with open(tmp_path, "w") as file:
+        json.dump({"version": version}, file)
+    os.replace(tmp_path, os.path.join(path, SNAPSHOT_POINTER))
+    versions = []
+    for name in os.listdir(path):
+        entry = os.path.join(path, name)
+        if os.path.isdir(entry):
+            if name.startswith("v") and not name.endswith(".tmp"):
+                versions.append(name)
+        elif name != SNAPSHOT_POINTER:
+            # The files of a snapshot exported before versioning, no longer served
+            os.remove(entry)
+    for name in sorted(versions)[: max(len(versions) - keep, 0)]:
+        if name != version:
+            shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+
+
+def write_json(path, data):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(data, file, indent=2)
+    os.replace(tmp_path, path)
+
+
+def normalize_rows(embeddings):
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings / np.maximum(norms, 1e-12)
+
+
+def quantize(embeddings, dtype):
+    """Returns (matrix, scales) for normalized float32 embeddings. scales is only used for int8"""
+    if dtype == "float32":
+        return embeddings.astype(np.float32), None
+    if dtype == "float16":
+        return embeddings.astype(np.float16), None
+    if dtype == "int8":
+        scales = np.abs(embeddings).max(axis=1) / 127
+        scales = np.maximum(scales, 1e-12).astype(np.float32)
+        matrix = np.round(embeddings / scales[:, None]).astype(np.int8)
+        return matrix, scales
+    raise ValueError(
+        f"Unsupported snapshot dtype {dtype!r}, expected one of {SNAPSHOT_DTYPES}"
+    )
+
+
+def read_collection(collection, page_size=1000):
+    """Reads every id, embedding, document and metadata from a Chroma collection a page at a time"""
+    ids, embeddings, documents, metadatas = [], [], [], []
+    offset = 0
+    while True:
+        page = collection.get(
+            include=["embeddings", "documents", "metadatas"],
+            limit=page_size,
+            offset=offset,
+        )
+        if not page["ids"]:
+            break
+        ids.extend(page["ids"])
+        embeddings.extend(page["embeddings"])
+        documents.extend(page["documents"])
+        metadatas.extend(page["metadatas"])
+        offset += len(page["ids"])
+    return ids, np.asarray(embeddings, dtype=np.float32), documents, metadatas
+
+
+def timestamp_order(metadatas):
+    """Returns the row order that sorts chunks by publish timestamp, chunks without one first"""
+    return sorted(
+        range(len(metadatas)),
+        key=lambda i: (metadatas[i] or {}).get("timestamp", float("-inf")),
+    )
+
+
+def recall_at_k(embeddings, snapshot, query_embeddings, k=7):
+    """Fraction of the snapshot's top-k results that are within the exact float32 top-k for each query.
+    Results tied with the k-th best float32 score count as hits."""
+    exact_scores = normalize_rows(query_embeddings) @ embeddings.T
+    k = min(k, exact_scores.shape[1])
+    hits = 0
+    for scores, rows in zip(exact_scores, snapshot.top_k(query_embeddings, k)):
+        kth_score = -np.partition(-scores, k - 1)[k - 1]
+        hits += int(np.sum(scores[rows] >= kth_score - 1e-6))
+    return hits / (k * len(exact_scores))
+
+
+def write_snapshot(
+    path, ids, embeddings, documents, metadatas, dtype="int8", source=None, switch=True
+):
+    """Writes normalized embeddings, documents and metadata as a new snapshot version under path and, with
+    switch, serves it in place of the current one. The manifest's "version" names the directory.
+    Rows given in timestamp_order can be searched by date range."""
+    matrix, scales = quantize(embeddings, dtype)
+    timestamps = np.array(
+        [(metadata or {}).get("timestamp", -np.inf) for metadata in metadatas],
+        dtype=np.float64,
+    )
+    time_ordered = bool(
+        np.isfinite(timestamps).any() and np.all(timestamps[1:] >= timestamps[:-1])
+    )
+
+    document_numbers = {}
+    document_index = np.empty(len(documents), dtype=np.int32)
+    for i, document in enumerate(documents):
+        document_index[i] = document_numbers.setdefault(document, len(document_numbers))
+    encoded = [document.encode("utf-8") for document in document_numbers]
+    document_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    document_offsets[1:] = np.cumsum([len(document) for document in encoded])
+
+    column_names = sorted({key for metadata in metadatas for key in metadata or {}})
+    columns = {name: {} for name in column_names}
+    metadata_codes = np.full((len(metadatas), len(column_names)), -1, dtype=np.int32)
+    for i, metadata in enumerate(metadatas):
+        for j, name in enumerate(column_names):
+            if metadata and name in metadata:
+                values = columns[name]
+                metadata_codes[i, j] = values.setdefault(metadata[name], len(values))
+
+    version = f"v{time.time_ns()}"
+    tmp_path = os.path.join(path, f"{version}.tmp")
+    os.makedirs(tmp_path)
+    np.save(os.path.join(tmp_path, "embeddings.npy"), matrix)
+    if scales is not None:
+        np.save(os.path.join(tmp_path, "scales.npy"), scales)
+    np.save(os.path.join(tmp_path, "document_index.npy"), document_index)
+    np.save(os.path.join(tmp_path, "document_offsets.npy"), document_offsets)
+    with open(os.path.join(tmp_path, "documents.bin"), "wb") as file:
+        file.write(b"".join(encoded))
+    np.save(os.path.join(tmp_path, "metadata_codes.npy"), metadata_codes)
+    if time_ordered:
+        np.save(os.path.join(tmp_path, "timestamps.npy"), timestamps)
+    with open(os.path.join(tmp_path, "metadata.json"), "w") as file:
+        json.dump({name: list(columns[name]) for name in column_names}, file)
+    with open(os.path.join(tmp_path, "ids.json"), "w") as file:
+        json.dump(ids, file)
+    manifest = {
+        "format_version": SNAPSHOT_FORMAT_VERSION,
+        "dtype": dtype,
+        "count": len(ids),
+        "dimension": int(matrix.shape[1]) if len(ids) else 0,
+        "unique_documents": len(encoded),
+        "metadata_columns": column_names,
+        "time_ordered": time_ordered,
+        "source": source,
+        "created": time.time(),
+        "version": version,
+    }
+    write_json(os.path.join(tmp_path, "manifest.json"), manifest)
+
+    os.replace(tmp_path, os.path.join(path, version))
+    if switch:
+        set_current_snapshot(path, version)
+    return manifest
+
+
+def export_snapshot(
+    collection, path=SNAPSHOT_PATH, dtype="int8", recall_queries=200, k=7
+):
+    """Exports a Chroma collection as a snapshot and checks its recall against the float32 embeddings.
+    A sample of the stored chunk embeddings is used as queries. Returns the snapshot manifest.
+    """
+    ids, embeddings, documents, metadatas = read_collection(collection)
+    order = timestamp_order(metadatas)
+    ids = [ids[i] for i in order]
+    embeddings = normalize_rows(embeddings)[order]
+    documents = [documents[i] for i in order]
+    metadatas = [metadatas[i] for i in order]
+    manifest = write_snapshot(
+        path, ids, embeddings, documents, metadatas, dtype, source=collection.name, switch=False
+    )
+    version_path = os.path.join(path, manifest["version"])
+
+    if len(ids) and recall_queries:
+        rng = np.random.default_rng(0)
+        sample = rng.choice(len(ids), size=min(recall_queries, len(ids)), replace=False)
+        snapshot = VectorSnapshot.load(version_path)
+        manifest["recall_at_k"] = {
+            str(k): recall_at_k(embeddings, snapshot, embeddings[sample], k)
+        }
+        manifest["float32_bytes"] = int(embeddings.nbytes)
+        manifest["embedding_bytes"] = snapshot.embedding_nbytes
+        write_json(os.path.join(version_path, "manifest.json"), manifest)
+    set_current_snapshot(path, manifest["version"])
+    return manifest
+
+
+class VectorSnapshot:
+    """Exact cosine search over a snapshot, with query and get results shaped like a Chroma collection's"""
+
+    def __init__(
+        self,
+        path,
+        manifest,
+        ids,
+        matrix,
+        scales,
+        document_index,
+        document_offsets,
+        documents,
+        columns,
+        metadata_codes,
+        timestamps=None,
+    ):
+        self.path = path
+        self.manifest = manifest
+        self.ids = ids
+        self.matrix = matrix
+        self.scales = scales
+        self.document_index = document_index
+        self.document_offsets = document_offsets
+        self.documents = documents
+        self.columns = columns
+        self.column_names = manifest["metadata_columns"]
+        self.metadata_codes = metadata_codes
+        self.timestamps = timestamps
+        self.positions = {chunk_id: i for i, chunk_id in enumerate(ids)}
+
+    @classmethod
+    def load(cls, path=SNAPSHOT_PATH, mmap=False):
+        """Reads the snapshot being served at path, or a version directory. With mmap the arrays and
+        documents are memory-mapped rather than read, so pages are only loaded when a search touches
+        them and are shared between processes
+        """
+        path = current_snapshot_dir(path)
+        with open(os.path.join(path, "manifest.json"), "r") as file:
+            manifest = json.load(file)
+        if manifest["format_version"] != SNAPSHOT_FORMAT_VERSION:
+            raise ValueError(
+                f"Unsupported snapshot format version {manifest['format_version']} in {path}"
+            )
+        with open(os.path.join(path, "ids.json"), "r") as file:
+            ids = json.load(file)
+        with open(os.path.join(path, "metadata.json"), "r") as file:
+            columns = json.load(file)
+        with open(os.path.join(path, "documents.bin"), "rb") as file:
+            if mmap and os.fstat(file.fileno()).st_size:
+                documents = _mmap.mmap(file.fileno(), 0, access=_mmap.ACCESS_READ)
+            else:
+                documents = file.read()
+        mmap_mode = "r" if mmap else None
+
+        def load_array(name):
+            return np.load(os.path.join(path, name), mmap_mode=mmap_mode)
+
+        return cls(
+            path,
+            manifest,
+            ids,
+            load_array("embeddings.npy"),
+            (
+                load_array("scales.npy")
+                if os.path.exists(os.path.join(path, "scales.npy"))
+                else None
+            ),
+            load_array("document_index.npy"),
+            load_array("document_offsets.npy"),
+            documents,
+            columns,
+            load_array("metadata_codes.npy"),
+            (
+                load_array("timestamps.npy")
+                if os.path.exists(os.path.join(path, "timestamps.npy"))
+                else None
+            ),
+        )
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def embedding_nbytes(self):
+        return int(
+            self.matrix.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+        )
+
+    def row_range(self, start=None, end=None):
+        """Returns the (first, last + 1) rows of the chunks published from the start timestamp up to but
+        excluding end. Snapshots written without timestamps always return every row."""
+        if self.timestamps is None:
+            return 0, len(self.ids)
+        first = 0 if start is None else int(np.searchsorted(self.timestamps, start))
+        last = len(self.ids) if end is None else int(np.searchsorted(self.timestamps, end))
+        return first, max(first, last)
+
+    def scores(self, query_embeddings, first=0, last=None):
+        """Returns the cosine similarity of each query to the chunks in rows first to last, one row per query"""
+        last = len(self.ids) if last is None else last
+        queries = normalize_rows(query_embeddings)
+        scores = np.empty((len(queries), last - first), dtype=np.float32)
+        # Dequantized a block at a time so search never holds a float32 copy of the whole matrix
+        for start in range(first, last, SEARCH_BLOCK_ROWS):
+            stop = min(start + SEARCH_BLOCK_ROWS, last)
+            block = np.asarray(self.matrix[start:stop], dtype=np.float32)
+            block_scores = queries @ block.T
+            if self.scales is not None:
+                block_scores *= self.scales[start:stop]
+            scores[:, start - first : stop - first] = block_scores
+        return scores
+
+    def top_k(self, query_embeddings, k, scores=None):
+        """Returns the row numbers of the k best matching chunks for each query, best first"""
+        if scores is None:
+            scores = self.scores(query_embeddings)
+        k = min(k, scores.shape[1])
+        results = []
+        for row in scores:
+            candidates = (
+                np.argpartition(-row, k - 1)[:k] if k else np.empty(0, dtype=np.int64)
+            )
+            results.append(list(candidates[np.argsort(-row[candidates])]))
+        return results
+
+    def document(self, row):
+        number = self.document_index[row]
+        start, end = self.document_offsets[number], self.document_offsets[number + 1]
+        return self.documents[start:end].decode("utf-8")
+
+    def metadata(self, row):
+        return {
+            name: self.columns[name][code]
+            for name, code in zip(self.column_names, self.metadata_codes[row])
+            if code >= 0
+        }
+
+    def query(
+        self,
+        query_embeddings,
+        n_results=10,
+        include=("documents", "metadatas", "distances"),
+        start=None,
+        end=None,
+    ):
+        """Same shape as Collection.query. Distances are squared L2 between unit vectors, the scale Chroma
+        reports for the normalized MiniLM embeddings. start and end only search the chunks published in
+        that range of timestamps."""
+        first, last = self.row_range(start, end)
+        scores = self.scores(query_embeddings, first, last)
+        result = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+        for row_scores, top in zip(
+            scores, self.top_k(query_embeddings, n_results, scores)
+        ):
+            rows = [first + row for row in top]
+            result["ids"].append([self.ids[row] for row in rows])
+            result["documents"].append(
+                [self.document(row) for row in rows] if "documents" in include else None
+            )
+            result["metadatas"].append(
+                [self.metadata(row) for row in rows] if "metadatas" in include else None
+            )
+            result["distances"].append(
+                [float(2 - 2 * row_scores[row]) for row in top]
+                if "distances" in include
+                else None
+            )
+        return result
+
+    def get(self, ids, include=("documents", "metadatas")):
+        """Same shape as Collection.get for a list of ids, skipping ids that are not in the snapshot"""
+        rows = [
+            self.positions[chunk_id] for chunk_id in ids if chunk_id in self.positions
+        ]
+        return {
+            "ids": [self.ids[row] for row in rows],
+            "documents": (
+                [self.document(row) for row in rows] if "documents" in include else None
+            ),
+            "metadatas": (
+                [self.metadata(row) for row in rows] if "metadatas" in include else None
+            ),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Export the Chroma collection as a compact vector snapshot"
+    )
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    export = subcommands.add_parser("export")
+    export.add_argument("--chroma-path", default="./chroma.db")
+    export.add_argument(
+        "--collection", default=None, help="defaults to the collection being served"
+    )
+    export.add_argument("--output", default=SNAPSHOT_PATH)
+    export.add_argument("--dtype", choices=SNAPSHOT_DTYPES, default="int8")
+    export.add_argument("--recall-queries", type=int, default=200)
+    export.add_argument("-k", type=int, default=7)
+    args = parser.parse_args()
+
+    from vector_backends import ChromaBackend
+
+    collection = ChromaBackend(args.chroma_path, args.collection).collection()
+    manifest = export_snapshot(
+        collection, args.output, args.dtype, args.recall_queries, args.k
+    )
+    version_path = os.path.join(args.output, manifest["version"])
+    size = sum(
+        os.path.getsize(os.path.join(version_path, name))
+        for name in os.listdir(version_path)
+    )
+    print(
+        f"Wrote {manifest['count']} chunks ({manifest['unique_documents']} unique documents) "
+        f"to {args.output}: {size / 1e6:.1f} MB on disk"
+    )
+    if "recall_at_k" in manifest:
+        print(
+            f"Embeddings: {manifest['embedding_bytes'] / 1e6:.1f} MB as {args.dtype}, "
+            f"{manifest['float32_bytes'] / 1e6:.1f} MB as float32"
+        )
+        print(
+            f"Recall@{args.k} against float32: {manifest['recall_at_k'][str(args.k)]:.4f}"
+        )
+
+
+if __name__ == "__main__":
+    main()